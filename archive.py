@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Streaming export/import of storage layers, behind `main.py export` and
+# `main.py import`.
+#
+# An export is a PAX tar, compressed on the fly and written straight to a file
+# or stdout; file data goes through a fixed buffer and nothing is staged. The
+# members are lower/... and upper/...: whiteouts stay 0/0 char devices, xattrs
+# (overlay opaque/redirect markers among them) are SCHILY.xattr.* records as
+# in GNU tar, ownership is numeric, and hard links inside the tree stay links.
+#
+# Each export carries a manifest, one JSON line per entry with
+# [path, kind, size, mtime_ns, ctime_ns, hash], in walk order. The walk visits
+# children sorted by name, so the previous manifest is read alongside it as a
+# merge join and memory does not grow with the tree. An incremental export
+# only sends entries whose size, mtime or ctime changed, plus the paths that
+# are gone. Every export has an id and the id of the export it builds on;
+# imports apply a chain in order.
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+import time
+import uuid
+
+import layers
+
+META_DIR = ".desktop-export"
+HEADER_MEMBER = f"{META_DIR}/export.json"
+MANIFEST_MEMBER = f"{META_DIR}/manifest.jsonl"
+DELETED_MEMBER = f"{META_DIR}/deleted.jsonl"
+LAYERS = ("lower", "upper")
+COMPRESSION = {"gz": "w|gz", "xz": "w|xz", "bz2": "w|bz2", "none": "w|"}
+BUFSIZE = 1 << 20
+XATTR_PREFIX = "SCHILY.xattr."
+
+
+def compression_for(path):
+    for ext, kind in ((".xz", "xz"), (".txz", "xz"), (".bz2", "bz2"), (".tar", "none")):
+        if path and path.endswith(ext):
+            return kind
+    return "gz"
+
+
+class _HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.h = hashlib.blake2b(digest_size=32)
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.h.update(data)
+        return data
+
+
+def _kind(st):
+    mode = st.st_mode
+    if stat.S_ISDIR(mode):
+        return "d"
+    if stat.S_ISREG(mode):
+        return "f"
+    if stat.S_ISLNK(mode):
+        return "l"
+    if layers.is_whiteout(st):
+        return "w"
+    return "o"
+
+
+def _key(path):
+    return path.split("/")
+
+
+def _walk(root, prefix):
+    # (arcname, path, st) in preorder with children sorted by name, which is
+    # the order of _key()
+    stack = [(prefix, root)]
+    while stack:
+        arc, path = stack.pop()
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISSOCK(st.st_mode):
+            continue
+        yield arc, path, st
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                names = sorted(os.listdir(path), reverse=True)
+            except OSError:
+                continue
+            stack.extend((f"{arc}/{n}", os.path.join(path, n)) for n in names)
+
+
+def _manifest_lines(path):
+    # -> (header, iterator of entries); an empty manifest if there is none
+    if not path:
+        return None, iter(())
+    f = open(path)
+    header = json.loads(f.readline())
+
+    def entries():
+        with f:
+            for line in f:
+                yield json.loads(line)
+    return header, entries()
+
+
+def _xattr_headers(path):
+    out = {}
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return out
+    for name in names:
+        try:
+            value = os.getxattr(path, name, follow_symlinks=False)
+        except OSError:
+            continue
+        # tarfile writes undecodable values back out byte for byte
+        out[XATTR_PREFIX + name] = value.decode("utf-8", "surrogateescape")
+    return out
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def export(storage_path, out, compression="gz", previous=None, manifest_out=None, storage=None):
+    # Streams the storage's layers to the binary file `out`. previous: the
+    # manifest of the export to build on (None for a full export). The new
+    # manifest is written to manifest_out. Returns the header plus counters.
+    prev_header, prev_entries = _manifest_lines(previous)
+    header = {"version": 1, "id": uuid.uuid4().hex, "base": prev_header["id"] if prev_header else None,
+              "storage": storage, "created": time.time()}
+    totals = {"entries": 0, "sent": 0, "bytes": 0, "deleted": 0}
+    deleted_tmp = f"{manifest_out}.deleted"
+    with tarfile.open(fileobj=out, mode=COMPRESSION[compression], format=tarfile.PAX_FORMAT,
+                      bufsize=BUFSIZE) as tar, open(manifest_out, 'w') as manifest, \
+            open(deleted_tmp, 'w+') as deleted:
+        _add_bytes(tar, HEADER_MEMBER, json.dumps(header).encode())
+        manifest.write(json.dumps(header) + "\n")
+        old = next(prev_entries, None)
+        for layer in LAYERS:
+            root = os.path.join(storage_path, layer)
+            if not os.path.isdir(root):
+                continue
+            for arc, path, st in _walk(root, layer):
+                while old is not None and _key(old[0]) < _key(arc):
+                    deleted.write(json.dumps(old[0]) + "\n")
+                    totals["deleted"] += 1
+                    old = next(prev_entries, None)
+                same = old is not None and old[0] == arc
+                entry = [arc, _kind(st), st.st_size, st.st_mtime_ns, st.st_ctime_ns, None]
+                totals["entries"] += 1
+                if same and old[1:5] == entry[1:5]:
+                    manifest.write(json.dumps(old) + "\n")
+                    old = next(prev_entries, None)
+                    continue
+                if same:
+                    old = next(prev_entries, None)
+                info = tar.gettarinfo(path, arc)
+                info.pax_headers.update(_xattr_headers(path))
+                info.pax_headers["mtime"] = f"{st.st_mtime_ns // 10**9}.{st.st_mtime_ns % 10**9:09d}"
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        reader = _HashingReader(f)
+                        tar.addfile(info, reader)
+                    entry[5] = reader.h.hexdigest()
+                    totals["bytes"] += info.size
+                else:
+                    tar.addfile(info)
+                totals["sent"] += 1
+                manifest.write(json.dumps(entry) + "\n")
+        while old is not None:
+            deleted.write(json.dumps(old[0]) + "\n")
+            totals["deleted"] += 1
+            old = next(prev_entries, None)
+        manifest.flush()
+        deleted.flush()
+        tar.add(deleted_tmp, DELETED_MEMBER)
+        tar.add(manifest_out, MANIFEST_MEMBER)
+    os.unlink(deleted_tmp)
+    return {**header, **totals}
+
+
+def _safe_target(root, name):
+    # Imports run as root: besides absolute and ".." names, refuse anything
+    # whose parent resolves outside its layer, e.g. through a symlink that is
+    # already in the storage or came earlier in the same stream.
+    parts = name.split("/")
+    if name.startswith("/") or ".." in parts or parts[0] not in LAYERS:
+        raise ValueError(f"refusing archive member {name!r}")
+    target = os.path.join(root, *parts)
+    if len(parts) > 1:
+        layer = os.path.join(os.path.realpath(root), parts[0])
+        parent = os.path.realpath(os.path.dirname(target))
+        if parent != layer and not parent.startswith(layer + os.sep):
+            raise ValueError(f"refusing archive member {name!r}: its parent leads outside {parts[0]}/")
+    return target
+
+
+def _mtime_ns(info):
+    # the pax record keeps nanoseconds that the float info.mtime rounds off
+    secs, _, frac = info.pax_headers.get("mtime", str(int(info.mtime))).partition(".")
+    return int(secs) * 10**9 + int((frac + "000000000")[:9])
+
+
+def _apply_metadata(path, info):
+    try:
+        os.chown(path, info.uid, info.gid, follow_symlinks=False)
+    except OSError:
+        pass
+    if not info.issym():
+        os.chmod(path, info.mode)
+    for key, value in info.pax_headers.items():
+        if key.startswith(XATTR_PREFIX):
+            os.setxattr(path, key[len(XATTR_PREFIX):], value.encode("utf-8", "surrogateescape"),
+                        follow_symlinks=False)
+    os.utime(path, ns=(_mtime_ns(info), _mtime_ns(info)), follow_symlinks=False)
+
+
+def _extract(tar, info, target, root):
+    # Existing entries are unlinked first, never rewritten: files may be hard
+    # links shared with other layers (clones, dedup).
+    try:
+        st = os.lstat(target)
+        if not (info.isdir() and stat.S_ISDIR(st.st_mode)):
+            layers._remove(target)
+    except FileNotFoundError:
+        pass
+    if info.isdir():
+        os.makedirs(target, 0o700, exist_ok=True)
+    elif info.isreg():
+        with tar.extractfile(info) as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BUFSIZE)
+    elif info.issym():
+        os.symlink(info.linkname, target)
+    elif info.islnk():
+        # the link itself, never what a symlink of that name points to
+        os.link(_safe_target(root, info.linkname), target, follow_symlinks=False)
+        return
+    elif info.ischr() or info.isblk() or info.isfifo():
+        kind = stat.S_IFCHR if info.ischr() else stat.S_IFBLK if info.isblk() else stat.S_IFIFO
+        os.mknod(target, kind | info.mode, os.makedev(info.devmajor, info.devminor))
+    else:
+        return
+    _apply_metadata(target, info)
+
+
+def import_(storage_path, src, expect_base=None):
+    # Applies an export stream from the binary file `src` to storage_path.
+    # The archive must build on expect_base (None: a full export into an empty
+    # storage). Returns the export's header plus counters.
+    totals = {"entries": 0, "bytes": 0, "deleted": 0}
+    dirs = []
+    header = None
+    with tarfile.open(fileobj=src, mode="r|*", bufsize=BUFSIZE) as tar:
+        for info in tar:
+            if header is None:
+                if info.name != HEADER_MEMBER:
+                    raise ValueError("not a storage export")
+                header = json.load(tar.extractfile(info))
+                if header.get("base") != expect_base:
+                    raise ValueError(f"export builds on {header.get('base') or 'nothing (full export)'}, "
+                                     f"storage is at {expect_base or 'nothing (empty)'}")
+                continue
+            if info.name == DELETED_MEMBER:
+                for line in tar.extractfile(info):
+                    target = _safe_target(storage_path, json.loads(line))
+                    layers._remove(target)
+                    totals["deleted"] += 1
+                continue
+            if info.name.startswith(META_DIR + "/"):
+                continue
+            target = _safe_target(storage_path, info.name)
+            if "/" not in info.name and not info.isdir():
+                raise ValueError(f"refusing archive member {info.name!r}: a layer must be a directory")
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _extract(tar, info, target, storage_path)
+            if info.isdir():
+                dirs.append((target, info))
+            totals["entries"] += 1
+            totals["bytes"] += info.size if info.isreg() else 0
+    if header is None:
+        raise ValueError("not a storage export")
+    # children changed the directories' mtimes; put them back last
+    for target, info in reversed(dirs):
+        if os.path.isdir(target):
+            os.utime(target, ns=(_mtime_ns(info), _mtime_ns(info)))
+    return {**header, **totals}
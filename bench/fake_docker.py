@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# Scriptable stand-in for the `docker` CLI, used by bench/run.py.
+#
+# It implements just enough of the commands main.py issues (ps, run, stop, rm,
+# exec, rename, inspect, stats, events, images, build, version) on top of a
+# JSON state file, so StorageManager can be driven at scale without a daemon.
+#
+#   FAKE_DOCKER_STATE      state file (default ./fake-docker.json)
+#   FAKE_DOCKER_LOG        append one line per invocation (argv), for call counts
+#   FAKE_DOCKER_LATENCY    seconds slept on every call (default 0)
+#   FAKE_DOCKER_LATENCY_<CMD>  per-command override, e.g. FAKE_DOCKER_LATENCY_STATS=2
+
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+STATE = os.environ.get("FAKE_DOCKER_STATE", "fake-docker.json")
+
+# run/create options that take a value
+VALUE_FLAGS = {
+    "-p", "--publish", "-v", "--volume", "--name", "--hostname", "-h", "--entrypoint",
+    "-e", "--env", "--cpus", "--memory", "-m", "--memory-swap", "--shm-size", "--tmpfs",
+    "--network", "--label", "-l", "--mount", "--cpu-quota", "--cpu-period", "--ulimit",
+    "--format", "--filter", "-f", "-t", "--tag", "--target", "--build-arg", "--time",
+    "-u", "--user", "-w", "--workdir", "--since", "--until",
+}
+EVENT_LOG = 1000  # container events kept in the state file for `events`
+
+
+def load():
+    try:
+        with open(STATE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"containers": {}, "images": {}, "seq": 0}
+
+
+def save(state):
+    tmp = f"{STATE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, STATE)
+
+
+def split_opts(args, value_flags=VALUE_FLAGS):
+    opts, rest, i = [], [], 0
+    while i < len(args):
+        a = args[i]
+        if rest:
+            rest.append(a)
+        elif a.startswith("-") and "=" in a:
+            opts.append(tuple(a.split("=", 1)))
+        elif a in value_flags and i + 1 < len(args):
+            opts.append((a, args[i + 1]))
+            i += 1
+        elif a.startswith("-"):
+            opts.append((a, None))
+        else:
+            rest.append(a)
+        i += 1
+    return opts, rest
+
+
+def emit(state, c, *actions):
+    for action in actions:
+        state.setdefault("events", []).append({
+            "Type": "container", "Action": action, "status": action, "id": c["id"], "time": int(time.time()),
+            "timeNano": time.time_ns(), "Actor": {"ID": c["id"], "Attributes": {"name": c["name"], "image": c["image"]}},
+        })
+    del state["events"][:-EVENT_LOG]
+
+
+def find(state, ref):
+    if ref in state["containers"]:
+        return ref
+    for name, c in state["containers"].items():
+        if c["id"].startswith(ref):
+            return name
+    return None
+
+
+def ports_str(c):
+    return ", ".join(f"0.0.0.0:{hp}->{cp}/tcp" for hp, cp in c.get("ports", []))
+
+
+def fmt_bytes(n):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024 or unit == "GiB":
+            return f"{n:.1f}{unit}" if unit != "B" else f"{n}B"
+        n /= 1024.0
+
+
+def render(template, fields):
+    if template.strip() == "{{json .}}":
+        return json.dumps(fields)
+    return re.sub(r"\{\{\s*\.(\w+)\s*\}\}", lambda m: str(fields.get(m.group(1), "")), template)
+
+
+def ps_fields(c):
+    return {
+        "ID": c["id"], "Names": c["name"], "Image": c["image"],
+        "State": c["state"], "Status": c["state"], "Ports": ports_str(c) if c["state"] == "running" else "",
+    }
+
+
+def stats_fields(c):
+    seed = int(c["id"][:6], 16)
+    mem = (seed % 900 + 100) * 1024 * 1024
+    return {
+        "ID": c["id"][:12], "Name": c["name"], "Container": c["name"],
+        "CPUPerc": f"{(seed % 400) / 100:.2f}%",
+        "MemUsage": f"{fmt_bytes(mem)} / 15.5GiB",
+        "MemPerc": f"{mem / (15.5 * 1024 ** 3) * 100:.2f}%",
+        "NetIO": f"{seed % 999}kB / {seed % 777}kB",
+        "BlockIO": "0B / 0B",
+        "PIDs": str(seed % 50 + 10),
+    }
+
+
+def inspect_doc(c):
+    hp = {f"{cp}/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(p)}] for p, cp in c.get("ports", [])}
+    return {
+        "Id": c["id"],
+        "Name": "/" + c["name"],
+        "Image": c["image"],
+        "State": {
+            "Status": c["state"],
+            "Running": c["state"] == "running",
+            "Paused": c["state"] == "paused",
+            "Pid": 0,
+            "StartedAt": c["started"],
+        },
+        "Config": {"Env": c.get("env", []), "Image": c["image"]},
+        "HostConfig": {"Binds": c.get("binds", [])},
+        "NetworkSettings": {"IPAddress": c.get("ip", ""), "Ports": hp},
+    }
+
+
+def main(argv):
+    cmd = argv[0] if argv else ""
+    if os.environ.get("FAKE_DOCKER_LOG"):
+        with open(os.environ["FAKE_DOCKER_LOG"], "a") as f:
+            f.write(" ".join(argv) + "\n")
+    delay = os.environ.get(f"FAKE_DOCKER_LATENCY_{cmd.upper()}", os.environ.get("FAKE_DOCKER_LATENCY", "0"))
+    time.sleep(float(delay))
+
+    lock = open(STATE + ".lock", "a")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    state = load()
+    # -f is --force for rm, --filter/--format elsewhere
+    opts, rest = split_opts(argv[1:], VALUE_FLAGS - {"-f"} if cmd == "rm" else VALUE_FLAGS)
+    flags = dict(opts)
+    fmt = flags.get("--format")
+    rc = 0
+
+    if cmd == "version":
+        print("24.0.0-fake")
+
+    elif cmd == "images":
+        if rest and rest[0] in state["images"]:
+            print(state["images"][rest[0]])
+
+    elif cmd == "build":
+        tag = flags.get("-t") or flags.get("--tag")
+        state["seq"] += 1
+        state["images"][tag] = f"sha256:{state['seq']:012x}"
+
+    elif cmd in ("run", "create"):
+        name = flags.get("--name") or f"fake_{state['seq']}"
+        if name in state["containers"]:
+            print(f'docker: Error response from daemon: Conflict. The container name "/{name}" is already in use.',
+                  file=sys.stderr)
+            rc = 125
+        else:
+            state["seq"] += 1
+            ports = []
+            for k, v in opts:
+                if k in ("-p", "--publish"):
+                    parts = v.split(":")
+                    ports.append([int(parts[-2]), int(parts[-1].split("/")[0])])
+            cid = f"{state['seq']:08x}" + os.urandom(28).hex()
+            state["containers"][name] = {
+                "id": cid, "name": name, "image": rest[0] if rest else "",
+                "state": "running" if cmd == "run" else "created", "ports": ports,
+                "env": [v for k, v in opts if k in ("-e", "--env")],
+                "binds": [v for k, v in opts if k in ("-v", "--volume")],
+                "ip": f"172.17.{state['seq'] // 250 % 250}.{state['seq'] % 250 + 2}",
+                "started": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            }
+            emit(state, state["containers"][name], *(("create", "start") if cmd == "run" else ("create",)))
+            print(cid)
+
+    elif cmd == "start":
+        for ref in rest:
+            n = find(state, ref)
+            if n:
+                state["containers"][n]["state"] = "running"
+                emit(state, state["containers"][n], "start")
+
+    elif cmd in ("stop", "kill"):
+        for ref in rest:
+            n = find(state, ref)
+            if n:
+                state["containers"][n]["state"] = "exited"
+                emit(state, state["containers"][n], "die", cmd)
+                print(ref)
+            else:
+                print(f"Error response from daemon: No such container: {ref}", file=sys.stderr)
+                rc = 1
+
+    elif cmd in ("pause", "unpause"):
+        for ref in rest:
+            n = find(state, ref)
+            if n:
+                state["containers"][n]["state"] = "paused" if cmd == "pause" else "running"
+                emit(state, state["containers"][n], cmd)
+            else:
+                rc = 1
+
+    elif cmd == "rm":
+        force = "-f" in flags or "--force" in flags
+        for ref in rest:
+            n = find(state, ref)
+            if not n:
+                print(f"Error response from daemon: No such container: {ref}", file=sys.stderr)
+                rc = 1
+            elif state["containers"][n]["state"] == "running" and not force:
+                print(f"Error response from daemon: cannot remove running container {ref}", file=sys.stderr)
+                rc = 1
+            else:
+                c = state["containers"].pop(n)
+                emit(state, c, *(("die", "destroy") if c["state"] == "running" else ("destroy",)))
+
+    elif cmd == "rename":
+        n = find(state, rest[0]) if rest else None
+        if not n or len(rest) < 2 or rest[1] in state["containers"]:
+            rc = 1
+        else:
+            c = state["containers"].pop(n)
+            c["name"] = rest[1]
+            state["containers"][rest[1]] = c
+            emit(state, c, "rename")
+
+    elif cmd == "exec":
+        n = find(state, rest[0]) if rest else None
+        if not n or state["containers"][n]["state"] != "running":
+            print(f"Error response from daemon: container {rest[0] if rest else ''} is not running", file=sys.stderr)
+            rc = 1
+
+    elif cmd == "ps":
+        show_all = "-a" in flags or "--all" in flags
+        name_filter = [v[5:] for k, v in opts if k in ("--filter", "-f") and v.startswith("name=")]
+        for c in state["containers"].values():
+            if not show_all and c["state"] != "running":
+                continue
+            if name_filter and not any(f in c["name"] for f in name_filter):
+                continue
+            if "-q" in flags:
+                print(c["id"][:12])
+            else:
+                print(render(fmt or "{{.ID}}  {{.Names}}  {{.Status}}  {{.Ports}}", ps_fields(c)))
+
+    elif cmd == "inspect":
+        docs = []
+        for ref in rest:
+            n = find(state, ref)
+            if n:
+                docs.append(inspect_doc(state["containers"][n]))
+            else:
+                print(f"Error: No such object: {ref}", file=sys.stderr)
+                rc = 1
+        print(json.dumps(docs, indent=4))
+
+    elif cmd == "stats":
+        stream = "--no-stream" not in flags
+        while True:
+            for c in state["containers"].values():
+                if c["state"] == "running" and (not rest or c["name"] in rest):
+                    print(render(fmt or "{{.Name}} {{.CPUPerc}} {{.MemUsage}}", stats_fields(c)))
+            sys.stdout.flush()
+            if not stream:
+                break
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            time.sleep(1)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = load()
+
+    elif cmd == "events":
+        last = int(float(flags.get("--since") or time.time()) * 1e9)
+        while True:
+            for e in state.get("events", []):
+                if e["timeNano"] > last:
+                    print(render(fmt or "{{.Action}} {{.id}}", e))
+                    last = e["timeNano"]
+            sys.stdout.flush()
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            time.sleep(0.2)
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = load()
+
+    else:
+        print(f"fake docker: unsupported command {cmd!r}", file=sys.stderr)
+        rc = 1
+
+    save(state)
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Scaling benchmark for main.py against bench/fake_docker.py.
+#
+#   python bench/run.py [--sizes 1,10,100,1000] [--running 0.5] [--latency 0.0]
+#                       [--stats-latency 2.0] [--repeat 3] [--strace]
+#                       [--out report.json] [--compare old-report.json]
+#
+# For every size N a fresh work dir is seeded with N storages, of which a
+# fraction are "running" in the fake daemon. Then create, start, stop, list,
+# rename and delete are each run as a real `python main.py ...` process.
+# For each command the report records the median wall time, how many docker
+# invocations it made and, with --strace, the syscall count. The JSON report
+# can be diffed against a previous one with --compare.
+
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+MAIN = os.path.join(REPO, "main.py")
+OPS = ["create", "start", "stop", "list", "rename", "delete"]
+USAGE = """usage: python bench/run.py [--sizes 1,10,100,1000] [--running 0.5] [--latency 0.0]
+                          [--stats-latency 2.0] [--repeat 3] [--strace]
+                          [--out report.json] [--compare old-report.json]"""
+
+
+def parse_args(argv):
+    opts = {
+        "sizes": [1, 10, 100, 1000],
+        "running": 0.5,
+        "latency": 0.0,
+        "stats_latency": 2.0,
+        "repeat": 3,
+        "strace": False,
+        "out": "bench-report.json",
+        "compare": None,
+    }
+    i = 0
+    while i < len(argv):
+        a = argv[i]
+        if a == "--strace":
+            opts["strace"] = True
+        elif a in ("--sizes", "--running", "--latency", "--stats-latency", "--repeat", "--out", "--compare"):
+            i += 1
+            v = argv[i]
+            key = a[2:].replace("-", "_")
+            if key == "sizes":
+                opts[key] = [int(x) for x in v.split(",")]
+            elif key == "repeat":
+                opts[key] = int(v)
+            elif key in ("out", "compare"):
+                opts[key] = v
+            else:
+                opts[key] = float(v)
+        else:
+            print(USAGE)
+            sys.exit(1)
+        i += 1
+    return opts
+
+
+def version():
+    r = subprocess.run(["git", "-C", REPO, "describe", "--always", "--dirty"], capture_output=True, text=True)
+    return r.stdout.strip() or "unknown"
+
+
+def make_env(work, opts):
+    bindir = os.path.join(work, "bin")
+    os.makedirs(bindir)
+    shim = os.path.join(bindir, "docker")
+    with open(shim, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(HERE, "fake_docker.py")}" "$@"\n')
+    os.chmod(shim, 0o755)
+    env = dict(os.environ)
+    env.update({
+        "PATH": bindir + os.pathsep + env.get("PATH", ""),
+        "DESKTOP_DOCKER_BACKEND": "cli",
+        "FAKE_DOCKER_STATE": os.path.join(work, "fake-docker.json"),
+        "FAKE_DOCKER_LOG": os.path.join(work, "docker-calls.log"),
+        "FAKE_DOCKER_LATENCY": str(opts["latency"]),
+        "FAKE_DOCKER_LATENCY_STATS": str(opts["stats_latency"]),
+        # the fake desktops use no memory; admission would only cap N
+        "DESKTOP_MEMORY_COMMIT_RATIO": "0",
+    })
+    env.pop("DOCKER_HOST", None)
+    return env
+
+
+def seed(work, n, running):
+    # Populate state and the fake daemon directly; going through the CLI
+    # would make seeding 1000 storages the slowest part of the run.
+    sys.path.insert(0, REPO)
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        import main
+        store = main.open_state_store()
+        containers = {}
+        with store.transaction():
+            for i in range(n):
+                name = f"s{i:04d}"
+                path = os.path.join(work, "storages", name)
+                os.makedirs(os.path.join(path, "upper", "home", "user"), exist_ok=True)
+                with open(os.path.join(path, "upper", "home", "user", ".bashrc"), "w") as f:
+                    f.write("# seeded\n")
+                row = {"path": path, "container_id": None, "status": "stopped", "port": None}
+                if i < running:
+                    cname = f"{main.CONTAINER_PREFIX}{name}"
+                    cid = f"{i:08x}" + "0" * 56
+                    port = 20000 + i
+                    containers[cname] = {
+                        "id": cid, "name": cname, "image": main.IMAGE_NAME, "state": "running",
+                        "ports": [[port, 5901]], "env": [], "binds": [f"{path}:/storage"],
+                        "ip": f"172.17.{i // 250}.{i % 250 + 2}", "started": "2024-01-01T00:00:00Z",
+                    }
+                    row.update(container_id=cid, status="running", port=port)
+                store.insert(name, row)
+        with open(os.path.join(work, "fake-docker.json"), "w") as f:
+            json.dump({"containers": containers, "images": {main.IMAGE_NAME: "sha256:fake"}, "seq": n}, f)
+    finally:
+        os.chdir(cwd)
+
+
+def count_lines(path):
+    try:
+        with open(path) as f:
+            return sum(1 for _ in f)
+    except OSError:
+        return 0
+
+
+def run_op(work, env, args, stdin=None, use_strace=False):
+    log = env["FAKE_DOCKER_LOG"]
+    before = count_lines(log)
+    cmd = [sys.executable, MAIN] + args
+    trace_file = os.path.join(work, "strace.out")
+    if use_strace:
+        cmd = ["strace", "-f", "-c", "-o", trace_file] + cmd
+    t0 = time.perf_counter()
+    r = subprocess.run(cmd, cwd=work, env=env, input=stdin, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    syscalls = None
+    if use_strace and os.path.exists(trace_file):
+        with open(trace_file) as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[-1] == "total":
+                    syscalls = int(parts[3] if len(parts) >= 5 else parts[2])
+    return {
+        "wall_s": wall,
+        "docker_calls": count_lines(log) - before,
+        "syscalls": syscalls,
+        "rc": r.returncode,
+        "stderr": r.stderr[-500:],
+    }
+
+
+def bench_size(n, opts):
+    running = int(n * opts["running"])
+    work = tempfile.mkdtemp(prefix=f"desktop-bench-{n}-")
+    try:
+        env = make_env(work, opts)
+        seed(work, n, running)
+        use_strace = opts["strace"] and shutil.which("strace") is not None
+        results = []
+        for op in OPS:
+            samples = []
+            for r in range(opts["repeat"]):
+                tag = f"b{r}"
+                if op == "create":
+                    s = run_op(work, env, ["create", f"new-{tag}"], use_strace=use_strace)
+                elif op == "start":
+                    s = run_op(work, env, ["start", f"new-{tag}", "auto"], use_strace=use_strace)
+                elif op == "stop":
+                    s = run_op(work, env, ["stop", f"new-{tag}"], use_strace=use_strace)
+                elif op == "list":
+                    s = run_op(work, env, ["list"], use_strace=use_strace)
+                elif op == "rename":
+                    s = run_op(work, env, ["rename", f"new-{tag}:renamed-{tag}"], use_strace=use_strace)
+                else:
+                    s = run_op(work, env, ["delete", f"renamed-{tag}"], stdin="DELETE\n", use_strace=use_strace)
+                samples.append(s)
+            failed = [s for s in samples if s["rc"] != 0]
+            results.append({
+                "storages": n,
+                "running": running,
+                "op": op,
+                "wall_s": round(statistics.median(s["wall_s"] for s in samples), 4),
+                "wall_samples": [round(s["wall_s"], 4) for s in samples],
+                "docker_calls": max(s["docker_calls"] for s in samples),
+                "syscalls": samples[-1]["syscalls"],
+                "failures": len(failed),
+                "error": failed[0]["stderr"] if failed else None,
+            })
+            print(f"  N={n:<5} {op:<7} {results[-1]['wall_s']:8.3f}s  "
+                  f"docker calls {results[-1]['docker_calls']:<4}"
+                  + (f" syscalls {results[-1]['syscalls']}" if results[-1]["syscalls"] is not None else "")
+                  + (f"  ({len(failed)} failed)" if failed else ""))
+            sys.stdout.flush()
+        return results
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def compare(report, old_path):
+    with open(old_path) as f:
+        old = {(r["storages"], r["op"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {old_path}:")
+    for r in report["results"]:
+        o = old.get((r["storages"], r["op"]))
+        if not o or not o["wall_s"]:
+            continue
+        ratio = r["wall_s"] / o["wall_s"]
+        flag = "  REGRESSION" if ratio > 1.2 else ""
+        print(f"  N={r['storages']:<5} {r['op']:<7} {o['wall_s']:8.3f}s -> {r['wall_s']:8.3f}s "
+              f"(x{ratio:.2f}, docker calls {o['docker_calls']} -> {r['docker_calls']}){flag}")
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    report = {
+        "version": version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": {k: v for k, v in opts.items() if k not in ("out", "compare")},
+        "results": [],
+    }
+    for n in opts["sizes"]:
+        report["results"] += bench_size(n, opts)
+    with open(opts["out"], "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {opts['out']}")
+    if opts["compare"]:
+        compare(report, opts["compare"])
+
+
+if __name__ == "__main__":
+    main()
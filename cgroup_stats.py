@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Container metrics read straight from cgroup v2 files.
+#
+# `docker stats --no-stream` blocks for a CPU sample and reports rounded,
+# human-readable strings. Here every counter is read as an exact integer from
+# the container's cgroup (memory.current, memory.stat, cpu.stat, io.stat,
+# pids.current) and CPU% is the usage_usec delta between two reads. Network
+# counters are not part of the cgroup; they come from /proc/<pid>/net/dev,
+# which shows the container's network namespace. Samples use the same dict
+# shape as DockerCLI.stats() so callers can mix both sources.
+
+import os
+import time
+
+CGROUP_ROOT = os.environ.get("DESKTOP_CGROUP_ROOT", "/sys/fs/cgroup")
+PROC_ROOT = "/proc"
+CPU_SAMPLE_INTERVAL = 0.25  # seconds between the two cpu.stat reads
+
+# Where docker puts container cgroups: systemd driver, then cgroupfs driver.
+CGROUP_LAYOUTS = ("system.slice/docker-{id}.scope", "docker/{id}")
+
+
+def available(root: str = CGROUP_ROOT) -> bool:
+    # cgroup.controllers only exists on the unified (v2) hierarchy
+    return os.path.exists(os.path.join(root, "cgroup.controllers"))
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _read_int(path, default=0):
+    text = _read(path)
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return default
+
+
+def _read_keyed(path) -> dict:
+    # "key value" per line, as in memory.stat and cpu.stat
+    out = {}
+    for line in (_read(path) or "").splitlines():
+        k, _, v = line.partition(" ")
+        if v.strip().isdigit():
+            out[k] = int(v)
+    return out
+
+
+def host_mem_total() -> int:
+    for line in (_read(os.path.join(PROC_ROOT, "meminfo")) or "").splitlines():
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) * 1024
+    return 0
+
+
+def reclaim(path: str) -> int:
+    # Ask the kernel to reclaim everything it can from the cgroup (anon pages
+    # go to swap/zswap, page cache is dropped); memory.reclaim needs 5.19+.
+    # Returns the bytes freed.
+    before = _read_int(os.path.join(path, "memory.current"))
+    try:
+        with open(os.path.join(path, "memory.reclaim"), "w") as f:
+            f.write(str(before))
+    except OSError:
+        # EAGAIN when less than asked could be reclaimed, which is expected
+        pass
+    return max(before - _read_int(os.path.join(path, "memory.current"), before), 0)
+
+
+class CgroupSampler:
+    def __init__(self, root: str = CGROUP_ROOT):
+        self.root = root
+        self._paths = {}
+        self._mem_total = None
+
+    def cgroup_path(self, cid: str, pid: int = 0):
+        if cid in self._paths:
+            return self._paths[cid]
+        path = None
+        if pid:
+            # "0::/system.slice/docker-<id>.scope" on a v2-only host
+            for line in (_read(os.path.join(PROC_ROOT, str(pid), "cgroup")) or "").splitlines():
+                if line.startswith("0::"):
+                    candidate = os.path.join(self.root, line[3:].lstrip("/"))
+                    if os.path.isfile(os.path.join(candidate, "cpu.stat")):
+                        path = candidate
+                    break
+        if path is None:
+            for layout in CGROUP_LAYOUTS:
+                candidate = os.path.join(self.root, layout.format(id=cid))
+                if os.path.isfile(os.path.join(candidate, "cpu.stat")):
+                    path = candidate
+                    break
+        if path:
+            self._paths[cid] = path
+        return path
+
+    def _mem_limit(self, path) -> int:
+        text = (_read(os.path.join(path, "memory.max")) or "").strip()
+        if text.isdigit():
+            return int(text)
+        if self._mem_total is None:
+            self._mem_total = host_mem_total()
+        return self._mem_total
+
+    def _io(self, path):
+        rbytes = wbytes = 0
+        # "8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0" per device
+        for line in (_read(os.path.join(path, "io.stat")) or "").splitlines():
+            for field in line.split()[1:]:
+                k, _, v = field.partition("=")
+                if k == "rbytes":
+                    rbytes += int(v)
+                elif k == "wbytes":
+                    wbytes += int(v)
+        return rbytes, wbytes
+
+    def _net(self, pid):
+        rx = tx = 0
+        if not pid:
+            return rx, tx
+        lines = (_read(os.path.join(PROC_ROOT, str(pid), "net", "dev")) or "").splitlines()[2:]
+        for line in lines:
+            iface, _, data = line.partition(":")
+            fields = data.split()
+            if iface.strip() == "lo" or len(fields) < 9:
+                continue
+            rx += int(fields[0])
+            tx += int(fields[8])
+        return rx, tx
+
+    def _read_sample(self, cid, pid, path):
+        mem_current = _read_int(os.path.join(path, "memory.current"))
+        mem_stat = _read_keyed(os.path.join(path, "memory.stat"))
+        blk_read, blk_write = self._io(path)
+        net_rx, net_tx = self._net(pid)
+        return {
+            "id": cid[:12],
+            "cpu_percent": 0.0,
+            # what docker reports as "used": page cache that can be dropped is not counted
+            "mem_used": max(mem_current - mem_stat.get("inactive_file", 0), 0),
+            "mem_limit": self._mem_limit(path),
+            "mem_current": mem_current,
+            "mem_anon": mem_stat.get("anon", 0),
+            "mem_file": mem_stat.get("file", 0),
+            "net_rx": net_rx,
+            "net_tx": net_tx,
+            "blk_read": blk_read,
+            "blk_write": blk_write,
+            "pids": _read_int(os.path.join(path, "pids.current")),
+        }
+
+    def sample(self, containers, interval: float = CPU_SAMPLE_INTERVAL):
+        # containers: {name: (container_id, pid)}. Returns {name: sample} for the
+        # ones whose cgroup was found; the rest are left to the caller.
+        found = {}
+        for name, (cid, pid) in containers.items():
+            path = self.cgroup_path(cid, pid) if cid else None
+            if path:
+                found[name] = (cid, pid, path)
+        if not found:
+            return {}
+        first = {name: _read_keyed(os.path.join(path, "cpu.stat")).get("usage_usec")
+                 for name, (_, _, path) in found.items()}
+        t0 = time.monotonic()
+        time.sleep(interval)
+        out = {}
+        for name, (cid, pid, path) in found.items():
+            usage = _read_keyed(os.path.join(path, "cpu.stat")).get("usage_usec")
+            if usage is None or first[name] is None:
+                # the container went away between the reads
+                continue
+            elapsed_usec = (time.monotonic() - t0) * 1e6
+            sample = self._read_sample(cid, pid, path)
+            # 100% = one full core, as in docker stats
+            sample["cpu_percent"] = max(usage - first[name], 0) / elapsed_usec * 100 if elapsed_usec else 0.0
+            out[name] = sample
+        return out
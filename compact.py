@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Shrinking a stopped storage's overlay, behind `main.py compact`.
+#
+# The upper/ tree is walked once against the layers below it (the storage's
+# own lower/, then the image's layer dirs, topmost first) and entries go in
+# four categories:
+#
+#   cache          paths matching CACHE_GLOBS; removed, or replaced by a
+#                  whiteout when the layers below have something there
+#   same_as_lower  files, symlinks and (emptied) directories identical to what
+#                  the layers below already show: same type, owner, mode,
+#                  xattrs and contents. Removing them changes nothing visible
+#   whiteouts      whiteouts hiding nothing, or inside an opaque directory
+#   work           leftovers in work/ from an unclean stop
+#
+# Lookups below follow overlay rules: a whiteout, a non-directory or an opaque
+# directory in a layer stops the search for everything under it. Without the
+# image's layer dirs (not overlay2, or docker on another machine) only the
+# cache, work and opaque-whiteout parts are done.
+
+import filecmp
+import fnmatch
+import os
+import stat
+
+import layers
+
+# matched against the path inside upper/; ':'-separated in the environment
+CACHE_GLOBS = tuple(filter(None, os.environ.get("DESKTOP_COMPACT_CACHE", ":".join((
+    "home/*/.cache/google-chrome/*/Cache",
+    "home/*/.cache/google-chrome/*/Code Cache",
+    "home/*/.config/google-chrome/*/GPUCache",
+    "home/*/.config/google-chrome/*/Service Worker/CacheStorage",
+    "home/*/.cache/mozilla/firefox/*/cache2",
+    "home/*/.cache/thumbnails",
+    "home/*/.thumbnails",
+    "home/*/.config/Code/Cache",
+    "home/*/.config/Code/CachedData",
+    "home/*/.config/Code/logs",
+    "root/.cache/*",
+    "var/lib/apt/lists/*_*",
+    "var/cache/apt/*.bin",
+    "var/cache/apt/archives/*.deb",
+    "var/log/journal/*",
+))).split(":")))
+CATEGORIES = ("cache", "same_as_lower", "whiteouts", "work")
+REDIRECT_XATTRS = ("trusted.overlay.redirect", "user.overlay.redirect")
+OVERLAY_XATTR_PREFIXES = ("trusted.overlay.", "user.overlay.")
+
+
+def _has_xattr(path, names):
+    for name in names:
+        try:
+            os.getxattr(path, name, follow_symlinks=False)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def _xattrs(path):
+    # overlay's own markers differ between layers and say nothing about content
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return {}
+    out = {}
+    for name in names:
+        if name.startswith(OVERLAY_XATTR_PREFIXES):
+            continue
+        try:
+            out[name] = os.getxattr(path, name, follow_symlinks=False)
+        except OSError:
+            pass
+    return out
+
+
+def _tree_bytes(path, st):
+    # bytes actually freed by removing path: files with no other links
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size if st.st_nlink == 1 or not stat.S_ISREG(st.st_mode) else 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for n in dirs + files:
+            try:
+                s = os.lstat(os.path.join(root, n))
+            except OSError:
+                continue
+            if not stat.S_ISDIR(s.st_mode) and (s.st_nlink == 1 or not stat.S_ISREG(s.st_mode)):
+                total += s.st_size
+    return total
+
+
+class Lowers:
+    # What the layers under upper/ show at a path.
+    def __init__(self, roots):
+        self.roots = list(roots)
+        self._blocked = {}
+
+    def _blocks(self, root, rel_dir):
+        # True if something at rel_dir in this layer hides all layers below it
+        key = (root, rel_dir)
+        if key not in self._blocked:
+            try:
+                st = os.lstat(os.path.join(root, rel_dir))
+                self._blocked[key] = not stat.S_ISDIR(st.st_mode) or layers.is_opaque(os.path.join(root, rel_dir))
+            except OSError:
+                self._blocked[key] = False
+        return self._blocked[key]
+
+    def lookup(self, rel):
+        # -> (path, st) of the entry visible at rel, or None
+        parts = rel.split("/")
+        for root in self.roots:
+            path = os.path.join(root, rel)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                st = None
+            if st is not None:
+                return None if layers.is_whiteout(st) else (path, st)
+            if any(self._blocks(root, "/".join(parts[:k])) for k in range(1, len(parts))):
+                return None
+        return None
+
+
+def _same(path, st, lower):
+    lpath, lst = lower
+    if stat.S_IFMT(st.st_mode) != stat.S_IFMT(lst.st_mode):
+        return False
+    if (st.st_uid, st.st_gid, st.st_mode) != (lst.st_uid, lst.st_gid, lst.st_mode):
+        return False
+    if stat.S_ISREG(st.st_mode):
+        if st.st_size != lst.st_size or _has_xattr(path, ("trusted.overlay.metacopy", "user.overlay.metacopy")):
+            return False
+    elif stat.S_ISLNK(st.st_mode):
+        if os.readlink(path) != os.readlink(lpath):
+            return False
+    elif not stat.S_ISDIR(st.st_mode):
+        return False
+    if _xattrs(path) != _xattrs(lpath):
+        return False
+    return not stat.S_ISREG(st.st_mode) or filecmp.cmp(path, lpath, shallow=False)
+
+
+def compact(storage_path, lower_roots, image_known=True, cache_globs=CACHE_GLOBS, dry_run=False):
+    # Returns {category: [entries, bytes]}.
+    totals = {c: [0, 0] for c in CATEGORIES}
+    upper = os.path.join(storage_path, "upper")
+    lowers = Lowers(lower_roots)
+
+    def drop(category, path, st, whiteout=False):
+        totals[category][0] += 1
+        # an emptied directory's children were counted on their own
+        totals[category][1] += 0 if category == "same_as_lower" and stat.S_ISDIR(st.st_mode) else _tree_bytes(path, st)
+        if not dry_run:
+            layers._remove(path)
+            if whiteout:
+                os.mknod(path, stat.S_IFCHR | 0o000, 0)
+
+    def walk(rel, opaque, known):
+        # -> True if the directory ends up empty
+        path = os.path.join(upper, rel) if rel else upper
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return False
+        left = len(entries)
+        for e in entries:
+            crel = f"{rel}/{e.name}" if rel else e.name
+            try:
+                st = e.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if any(fnmatch.fnmatchcase(crel, g) for g in cache_globs):
+                if not layers.is_whiteout(st):
+                    # as with rm: where a layer below has something here, hide it
+                    hide = not opaque and (not known or lowers.lookup(crel) is not None)
+                    drop("cache", e.path, st, whiteout=hide)
+                    left -= 0 if hide else 1
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dir_opaque = layers.is_opaque(e.path)
+                # redirected dirs look their lower half up somewhere else
+                dir_known = known and not _has_xattr(e.path, REDIRECT_XATTRS)
+                emptied = walk(crel, opaque or dir_opaque, dir_known)
+                if emptied and dir_known and not opaque and not dir_opaque:
+                    lower = lowers.lookup(crel)
+                    if lower and _same(e.path, st, lower):
+                        drop("same_as_lower", e.path, st)
+                        left -= 1
+                continue
+            if layers.is_whiteout(st):
+                if opaque or (known and lowers.lookup(crel) is None):
+                    drop("whiteouts", e.path, st)
+                    left -= 1
+                continue
+            if known and not opaque:
+                lower = lowers.lookup(crel)
+                if lower and _same(e.path, st, lower):
+                    drop("same_as_lower", e.path, st)
+                    left -= 1
+        return left == 0
+
+    if os.path.isdir(upper):
+        walk("", layers.is_opaque(upper), image_known)
+    work = os.path.join(storage_path, "work")
+    if os.path.isdir(work):
+        with os.scandir(work) as it:
+            for e in list(it):
+                drop("work", e.path, e.stat(follow_symlinks=False))
+    return totals
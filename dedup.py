@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Content deduplication across storage layers, behind `main.py dedup`.
+#
+# Every regular file of MIN_SIZE or more in the storages' upper/ and lower/
+# layers (and in snapshots) is grouped by size. Only sizes seen on more than
+# one inode are hashed. Hashes live in a SQLite index keyed by path, together
+# with the (inode, size, mtime, ctime) they were computed for, so a later run
+# only reads files that changed since. Identical files are then made to share
+# their data:
+#
+#   reflink  FIDEDUPERANGE; the kernel compares the data again under lock and
+#            shares the extents. Every file keeps its own inode, so a later
+#            write only unshares that one file. Safe on running storages.
+#   link     hard links, for files nobody writes in place: whole layers that
+#            are read-only (lower/ of stopped storages, snapshots) and paths
+#            matching IMMUTABLE_GLOBS (caches that only ever replace whole
+#            files by rename).
+#            Links share ownership, mode and xattrs, so those must match.
+#
+# Files that can be neither (no reflink support, not immutable) are reported
+# as duplicates but left alone.
+
+import hashlib
+import os
+import sqlite3
+import stat
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+import layers
+
+INDEX_DB = "dedup.db"
+MIN_SIZE = int(os.environ.get("DESKTOP_DEDUP_MIN_SIZE", str(64 * 1024)))
+HASH_CHUNK = 1 << 20
+HASH_WORKERS = 4
+# matched against the path inside the layer (`*` crosses '/'); ':'-separated in
+# the environment. Only stores whose files are written once to a temporary name
+# and renamed into place: anything a program might open for writing again
+# (installed packages, editor extensions, downloads) would change every link.
+# chattr +i files would be safe too, but the kernel refuses to link them.
+IMMUTABLE_GLOBS = tuple(filter(None, os.environ.get("DESKTOP_DEDUP_IMMUTABLE", ":".join((
+    "*/.cache/pip/http*/*",
+    "*/.npm/_cacache/content-v2/*",
+))).split(":")))
+METACOPY_XATTRS = ("trusted.overlay.metacopy", "user.overlay.metacopy")
+
+
+class Layer:
+    # A tree to deduplicate. linkable: "all" when nothing writes to it, "globs"
+    # when only IMMUTABLE_GLOBS may be hard-linked, None for reflinks only.
+    def __init__(self, root, label, linkable=None):
+        self.root = root
+        self.label = label
+        self.linkable = linkable
+
+
+class HashIndex:
+    def __init__(self, path=INDEX_DB):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, "
+                        "mtime_ns INTEGER, ctime_ns INTEGER, digest TEXT, shared_with TEXT)")
+        self.rows = {r[0]: list(r[1:]) for r in self.db.execute("SELECT * FROM files")}
+
+    def lookup(self, path, st):
+        # -> (digest, shared_with) if the file is unchanged since it was hashed
+        row = self.rows.get(path)
+        if row and row[:4] == [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]:
+            return row[4], row[5]
+        return None, None
+
+    def store(self, path, st, digest, shared_with=None):
+        self.rows[path] = [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest, shared_with]
+
+    def save(self, seen):
+        # rows of files that are gone (or no longer candidates) are dropped
+        for path in set(self.rows) - seen:
+            del self.rows[path]
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                ((p, *row) for p, row in self.rows.items()))
+
+    def close(self):
+        self.db.close()
+
+
+def _hash(path):
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_metacopy(path):
+    # metadata-only copy-ups hold no data; their content lives in a lower layer
+    for attr in METACOPY_XATTRS:
+        try:
+            os.getxattr(path, attr, follow_symlinks=False)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def _xattrs(path):
+    try:
+        return {n: os.getxattr(path, n, follow_symlinks=False) for n in os.listxattr(path, follow_symlinks=False)}
+    except OSError:
+        return {}
+
+
+def _linkable(layer, rel):
+    if layer.linkable == "all":
+        return True
+    return layer.linkable == "globs" and any(fnmatch.fnmatch(rel, g) for g in IMMUTABLE_GLOBS)
+
+
+def scan(layer_list):
+    # -> [(path, st, linkable)] for every candidate file
+    out = []
+    for layer in layer_list:
+        stack = [layer.root]
+        while stack:
+            d = stack.pop()
+            try:
+                with os.scandir(d) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for e in entries:
+                try:
+                    st = e.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(e.path)
+                elif stat.S_ISREG(st.st_mode) and st.st_size >= MIN_SIZE:
+                    out.append((e.path, st, _linkable(layer, os.path.relpath(e.path, layer.root))))
+    return out
+
+
+def _replace_with_link(keeper, path):
+    tmp = os.path.join(os.path.dirname(path), f".dedup-{os.getpid()}-{os.path.basename(path)}")
+    os.link(keeper, tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def run(layer_list, index, dry_run=False, log=print):
+    # Returns counters; with dry_run nothing is written except the hash index.
+    totals = {"files": 0, "bytes": 0, "hashed": 0, "hashed_bytes": 0, "reused": 0, "groups": 0,
+              "duplicate_bytes": 0, "reflinked": 0, "reflinked_bytes": 0, "linked": 0, "linked_bytes": 0,
+              "skipped_bytes": 0, "errors": 0}
+    candidates = scan(layer_list)
+    by_size = {}
+    for path, st, linkable in candidates:
+        totals["files"] += 1
+        totals["bytes"] += st.st_size
+        by_size.setdefault(st.st_size, []).append((path, st, linkable))
+
+    todo, digests, shared = [], {}, {}
+    for size, entries in by_size.items():
+        if len({(st.st_dev, st.st_ino) for _, st, _ in entries}) < 2:
+            continue
+        for path, st, _ in entries:
+            digest, shared_with = index.lookup(path, st)
+            if digest:
+                digests[path] = digest
+                shared[path] = shared_with
+                totals["reused"] += 1
+            else:
+                todo.append((path, st))
+
+    def hash_one(item):
+        path, st = item
+        if _is_metacopy(path):
+            return path, st, None
+        try:
+            return path, st, _hash(path)
+        except OSError:
+            return path, st, None
+
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        for path, st, digest in pool.map(hash_one, todo):
+            if digest:
+                digests[path] = digest
+                index.store(path, st, digest)
+                totals["hashed"] += 1
+                totals["hashed_bytes"] += st.st_size
+
+    groups = {}
+    for path, st, linkable in candidates:
+        if path in digests:
+            groups.setdefault((st.st_dev, st.st_size, digests[path]), []).append((path, st, linkable))
+
+    reflink_ok = {}
+    for (dev, size, digest), entries in groups.items():
+        inodes = {}
+        for entry in entries:
+            inodes.setdefault(entry[1].st_ino, []).append(entry)
+        if len(inodes) < 2:
+            continue
+        totals["groups"] += 1
+        totals["duplicate_bytes"] += size * (len(inodes) - 1)
+        # The most-linked inode stays; hard links may only point at an
+        # immutable one, or a later in-place write would show up everywhere.
+        order = sorted(inodes.values(), key=lambda paths: (-paths[0][1].st_nlink, paths[0][0]))
+        link_keeper = next((p for p in order if all(linkable for _, _, linkable in p)), None)
+        keeper = link_keeper or order[0]
+        kpath, kst = keeper[0][0], keeper[0][1]
+        kmeta = None
+        if dev not in reflink_ok:
+            reflink_ok[dev] = layers.reflink_supported(os.path.dirname(kpath))
+
+        for paths in order:
+            if paths is keeper:
+                continue
+            path, st = paths[0][0], paths[0][1]
+            try:
+                if link_keeper and all(linkable for _, _, linkable in paths):
+                    if kmeta is None:
+                        kmeta = (kst.st_uid, kst.st_gid, kst.st_mode, _xattrs(kpath))
+                    if (st.st_uid, st.st_gid, st.st_mode, _xattrs(path)) == kmeta:
+                        if not dry_run:
+                            for p, _, _ in paths:
+                                _replace_with_link(kpath, p)
+                        totals["linked"] += len(paths)
+                        # the data is only freed once every name of the inode is gone
+                        if st.st_nlink <= len(paths):
+                            totals["linked_bytes"] += size
+                        continue
+                if reflink_ok[dev]:
+                    if shared.get(path) == kpath:
+                        continue
+                    done = size if dry_run else layers.dedupe(kpath, path, size)
+                    if done:
+                        totals["reflinked"] += 1
+                        totals["reflinked_bytes"] += done
+                        if not dry_run:
+                            for p, _, _ in paths:
+                                index.store(p, os.lstat(p), digest, kpath)
+                    continue
+                totals["skipped_bytes"] += size
+            except OSError as e:
+                totals["errors"] += 1
+                log(f"  {path}: {e}")
+
+    if not dry_run:
+        # links changed ctimes; keep those entries fresh for the next run
+        for (dev, size, digest), entries in groups.items():
+            for path, _, _ in entries:
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                row = index.rows.get(path)
+                index.store(path, st, digest, row[5] if row else None)
+    index.save(set(digests))
+    return totals
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Fixed-capacity storages, behind `main.py create --size` and `main.py resize`.
+#
+# A bounded storage is a sparse ext4 image, storages/<name>.img, loop-mounted
+# on storages/<name> itself. Everything that works on the storage directory
+# (init.sh, the overlay's lower/upper/work, size indexes, snapshots, exports)
+# sees the same tree as before, and the container's bind mount of that
+# directory carries the mount along. What changes:
+#
+#   - writes past the size get ENOSPC inside that one desktop, instead of
+#     filling the host's disk for all of them
+#   - usage is one statfs() of the mount point, however many files it holds
+#   - the image is mounted with discard, so space freed inside it is punched
+#     out of the sparse file and returned to the host
+#
+# Growing works online (losetup -c, resize2fs on the loop device); shrinking
+# needs the image unmounted.
+
+import os
+import re
+import subprocess
+
+MIN_SIZE = 64 << 20  # smaller ext4 filesystems are mostly metadata
+MKFS_OPTS = ["-q", "-F", "-m", "0", "-E", "nodiscard,lazy_itable_init=1,lazy_journal_init=1"]
+MOUNT_OPTS = "loop,discard,noatime"
+
+
+def image_path(storage_path):
+    return storage_path.rstrip("/") + ".img"
+
+
+def _run(argv):
+    r = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if r.returncode != 0:
+        raise OSError(f"{' '.join(argv[:2])}: {(r.stderr or r.stdout).strip() or f'exit status {r.returncode}'}")
+    return r.stdout
+
+
+def create(image, size):
+    # A sparse file of `size` bytes with an empty ext4 filesystem; nothing is
+    # allocated on the host until it is written to.
+    if size < MIN_SIZE:
+        raise ValueError(f"size must be at least {MIN_SIZE >> 20}MiB")
+    with open(image, 'xb') as f:
+        f.truncate(size)
+    try:
+        _run(["mkfs.ext4", *MKFS_OPTS, image])
+    except OSError:
+        os.unlink(image)
+        raise
+
+
+def mount(image, target):
+    os.makedirs(target, exist_ok=True)
+    _run(["mount", "-o", MOUNT_OPTS, image, target])
+
+
+def umount(target):
+    _run(["umount", target])
+
+
+def is_mounted(target):
+    return os.path.ismount(target)
+
+
+def loop_device(target):
+    # the /dev/loopN mounted on target, from the mount table
+    target = os.path.realpath(target)
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            fields = line.split()
+            # mount point is field 5, the source follows the " - fstype" separator
+            if fields[4].encode().decode("unicode_escape") == target:
+                return fields[fields.index("-") + 2]
+    return None
+
+
+def usage(target):
+    # -> {"size", "used", "free", "files"} of the mounted filesystem
+    st = os.statvfs(target)
+    return {
+        "size": st.f_blocks * st.f_frsize,
+        "used": (st.f_blocks - st.f_bfree) * st.f_frsize,
+        "free": st.f_bavail * st.f_frsize,
+        "files": st.f_files - st.f_ffree,
+    }
+
+
+def allocated(image):
+    # bytes the sparse image takes on the host's disk
+    try:
+        return os.stat(image).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def resize(image, target, size):
+    # Grows in place when mounted; shrinking needs it unmounted, and fails
+    # (leaving the image as it was) when the data does not fit.
+    if size < MIN_SIZE:
+        raise ValueError(f"size must be at least {MIN_SIZE >> 20}MiB")
+    current = os.stat(image).st_size
+    if size >= current:
+        dev = loop_device(target) if is_mounted(target) else None
+        if is_mounted(target) and not (dev and re.match(r"^/dev/loop\d+$", dev)):
+            raise OSError(f"no loop device found for {target}")
+        with open(image, 'r+b') as f:
+            f.truncate(size)
+        try:
+            if dev:
+                _run(["losetup", "-c", dev])
+                _run(["resize2fs", dev])
+            else:
+                _run(["e2fsck", "-f", "-p", image])
+                _run(["resize2fs", image])
+        except OSError:
+            # the filesystem did not grow; neither does the file
+            with open(image, 'r+b') as f:
+                f.truncate(current)
+            if dev:
+                subprocess.run(["losetup", "-c", dev], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            raise
+        return
+    if is_mounted(target):
+        raise ValueError("shrinking needs the storage unmounted")
+    _run(["e2fsck", "-f", "-p", image])
+    _run(["resize2fs", image, f"{size // 1024}K"])
+    with open(image, 'r+b') as f:
+        f.truncate(size)
@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+# Docker backends used by main.py.
+#
+# DockerAPI talks HTTP/1.1 to the Engine API over the unix socket and keeps a
+# small pool of keep-alive connections, so a call costs one request/response
+# instead of a fork+exec of the docker CLI. DockerCLI is the fallback when the
+# socket is not reachable (remote DOCKER_HOST, rootless setups, permissions)
+# and is also what DockerAPI uses for `build` and interactive `run -it`.
+
+import json
+import os
+import re
+import socket
+import subprocess
+import http.client
+import queue
+import threading
+from contextlib import nullcontext
+from urllib.parse import quote, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+POOL_SIZE = 8
+
+# Set by main.py to its Tracer when --trace is on; anything with a
+# span(name, cat, **args) context manager works.
+tracer = None
+
+
+def _span(name, cat, **args):
+    return tracer.span(name, cat, **args) if tracer else nullcontext()
+
+
+class DockerError(Exception):
+    pass
+
+
+class NotFound(DockerError):
+    pass
+
+
+def parse_human_size(s: str) -> int:
+    s = s.strip()
+    m = re.match(r'^([\d\.]+)\s*([KMGTP]?i?B)$', s, re.IGNORECASE)
+    if not m:
+        s = s.split('/')[0].strip()
+        m = re.match(r'^([\d\.]+)\s*([KMGTP]?i?B)$', s, re.IGNORECASE)
+        if not m:
+            try:
+                return int(float(s))
+            except Exception:
+                return 0
+    val = float(m.group(1))
+    unit = m.group(2).lower()
+    mult = {
+        'b': 1,
+        'kb': 1000,
+        'kib': 1024,
+        'mb': 1000**2,
+        'mib': 1024**2,
+        'gb': 1000**3,
+        'gib': 1024**3,
+        'tb': 1000**4,
+        'tib': 1024**4,
+        'pb': 1000**5,
+        'pib': 1024**5,
+    }.get(unit, 1)
+    return int(val * mult)
+
+
+def _split_pair(s: str):
+    parts = s.split('/')
+    if len(parts) != 2:
+        return 0, 0
+    return parse_human_size(parts[0]), parse_human_size(parts[1])
+
+
+def _cli_stats_sample(cid, cpu, mem, netio, blockio, pids):
+    mem_used, mem_limit = _split_pair(mem)
+    net_rx, net_tx = _split_pair(netio)
+    blk_read, blk_write = _split_pair(blockio)
+    try:
+        cpu_percent = float(cpu.rstrip('%'))
+    except ValueError:
+        cpu_percent = 0.0
+    return {
+        "id": cid,
+        "cpu_percent": cpu_percent,
+        "mem_used": mem_used,
+        "mem_limit": mem_limit,
+        "net_rx": net_rx,
+        "net_tx": net_tx,
+        "blk_read": blk_read,
+        "blk_write": blk_write,
+        "pids": int(pids) if str(pids).isdigit() else 0,
+    }
+
+
+def _overlay_dirs(graph_driver):
+    # An image's layer dirs on the host, topmost first. Only overlay2 keeps
+    # them as plain directories we can read; anything else gives [].
+    if not graph_driver or graph_driver.get("Name") != "overlay2":
+        return []
+    data = graph_driver.get("Data") or {}
+    dirs = [data["UpperDir"]] if data.get("UpperDir") else []
+    dirs += [d for d in (data.get("LowerDir") or "").split(":") if d]
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+class DockerCLI:
+    name = "cli"
+
+    def _run(self, args, **kw):
+        with _span(f"docker {args[0]}", "subprocess", argv=['docker'] + args):
+            return subprocess.run(['docker'] + args, capture_output=True, text=True, **kw)
+
+    def ping(self) -> bool:
+        return self._run(['version', '--format', '{{.Server.Version}}']).returncode == 0
+
+    def image_id(self, image: str):
+        r = self._run(['images', '-q', image])
+        return r.stdout.strip().splitlines()[0] if r.stdout.strip() else None
+
+    def image_layers(self, image: str):
+        r = self._run(['image', 'inspect', '--format', '{{json .GraphDriver}}', image])
+        try:
+            return _overlay_dirs(json.loads(r.stdout or "null"))
+        except ValueError:
+            return []
+
+    def build_image(self, tag: str, context: str, extra_args=()) -> bool:
+        argv = ['docker', 'build', '-t', tag] + list(extra_args) + [context]
+        with _span("docker build", "subprocess", argv=argv):
+            r = subprocess.run(argv)
+        return r.returncode == 0
+
+    def stop_container(self, name: str):
+        self._run(['stop', name])
+
+    def remove_container(self, name: str, force: bool = False):
+        self._run(['rm'] + (['-f'] if force else []) + [name])
+
+    def rename_container(self, name: str, new_name: str):
+        r = self._run(['rename', name, new_name])
+        if r.returncode != 0:
+            raise DockerError(r.stderr.strip())
+
+    def pause_container(self, name: str):
+        r = self._run(['pause', name])
+        if r.returncode != 0:
+            raise DockerError(r.stderr.strip())
+
+    def unpause_container(self, name: str):
+        r = self._run(['unpause', name])
+        if r.returncode != 0:
+            raise DockerError(r.stderr.strip())
+
+    def exec(self, name: str, cmd, env=None, detach=False) -> int:
+        args = ['exec'] + (['-d'] if detach else [])
+        for k, v in (env or {}).items():
+            args += ['-e', f'{k}={v}']
+        return self._run(args + [name] + list(cmd)).returncode
+
+    def run_args(self, spec, detach=True):
+        args = ['run', '-d' if detach else '-it']
+        if not detach:
+            args.insert(1, '--rm')
+        if spec.get("privileged"):
+            args.append('--privileged')
+        for host_port, container_port in spec.get("ports", {}).items():
+            args += ['-p', f'0.0.0.0:{host_port}:{container_port}']
+        for bind in spec.get("binds", []):
+            args += ['-v', bind]
+        args += ['--name', spec["name"], '--hostname', spec.get("hostname", spec["name"])]
+        if spec.get("entrypoint"):
+            args += ['--entrypoint', spec["entrypoint"]]
+        for k, v in spec.get("env", {}).items():
+            args += ['-e', f'{k}={v}']
+        if spec.get("cpus"):
+            args += ['--cpus', str(spec["cpus"])]
+        if spec.get("memory"):
+            # no swap on top of the limit, a runaway desktop should hit OOM instead
+            args += ['--memory', str(spec["memory"]), '--memory-swap', str(spec["memory"])]
+        if spec.get("shm_size"):
+            args += ['--shm-size', str(spec["shm_size"])]
+        return args + [spec["image"]] + list(spec.get("cmd", []))
+
+    def run_container(self, spec):
+        r = self._run(self.run_args(spec))
+        if r.returncode != 0:
+            raise DockerError(r.stderr.strip())
+        return r.stdout.strip()
+
+    def run_interactive(self, spec) -> int:
+        argv = ['docker'] + self.run_args(spec, detach=False)
+        with _span("docker run -it", "subprocess", argv=argv):
+            return subprocess.run(argv).returncode
+
+    def containers(self, prefix: str = "", all: bool = True):
+        args = ['ps', '--no-trunc', '--format', '{{.ID}}|{{.Names}}|{{.State}}|{{.Ports}}']
+        if all:
+            args.insert(1, '-a')
+        if prefix:
+            args += ['--filter', f'name={prefix}']
+        r = self._run(args)
+        out = []
+        if r.returncode != 0:
+            return out
+        for line in r.stdout.splitlines():
+            parts = line.split('|', 3)
+            if len(parts) != 4 or not parts[1].startswith(prefix):
+                continue
+            ports = set()
+            for m in re.finditer(r':(\d+)(?:-(\d+))?->', parts[3]):
+                lo = int(m.group(1))
+                ports.update(range(lo, int(m.group(2) or lo) + 1))
+            out.append({"id": parts[0], "name": parts[1], "state": parts[2], "ports": sorted(ports)})
+        return out
+
+    def published_ports(self):
+        ports = set()
+        for c in self.containers(all=False):
+            ports.update(c["ports"])
+        return ports
+
+    def inspect(self, names):
+        if not names:
+            return {}
+        r = self._run(['inspect'] + list(names))
+        try:
+            data = json.loads(r.stdout or "[]")
+        except ValueError:
+            return {}
+        return {d.get("Name", "").lstrip('/'): d for d in data}
+
+    def stats(self, names):
+        r = self._run([
+            'stats', '--no-stream',
+            '--format', '{{.ID}}|{{.Name}}|{{.CPUPerc}}|{{.MemUsage}}|{{.NetIO}}|{{.BlockIO}}|{{.PIDs}}'
+        ])
+        out = {}
+        if r.returncode != 0:
+            return out
+        wanted = set(names)
+        for line in r.stdout.splitlines():
+            parts = line.split('|')
+            if len(parts) != 7:
+                continue
+            cid, name, cpu, mem, netio, blockio, pids = [p.strip() for p in parts]
+            if name in wanted:
+                out[name] = _cli_stats_sample(cid, cpu, mem, netio, blockio, pids)
+        return out
+
+    def stream_stats(self, names, stop):
+        # `docker stats` without --no-stream keeps one process and one feed for
+        # every container; yields (name, sample) as refreshes arrive.
+        if not names:
+            stop.wait()
+            return
+        argv = ['docker', 'stats', '--format', '{{json .}}'] + list(names)
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        threading.Thread(target=lambda: (stop.wait(), proc.terminate()), daemon=True).start()
+        try:
+            with _span("docker stats (stream)", "subprocess", argv=argv):
+                for line in proc.stdout:
+                    # refreshes are separated by terminal clear sequences
+                    line = line[line.find('{'):] if '{' in line else ""
+                    try:
+                        d = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield d.get("Name", ""), _cli_stats_sample(
+                        d.get("ID", ""), d.get("CPUPerc", ""), d.get("MemUsage", ""),
+                        d.get("NetIO", ""), d.get("BlockIO", ""), d.get("PIDs", ""))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def events(self, stop, since=None):
+        # Container events (Engine API shape: Action, Actor.ID,
+        # Actor.Attributes.name, time) until stop is set or the stream ends.
+        argv = ['docker', 'events', '--format', '{{json .}}', '--filter', 'type=container']
+        if since:
+            argv += ['--since', str(int(since))]
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        threading.Thread(target=lambda: (stop.wait(), proc.terminate()), daemon=True).start()
+        try:
+            with _span("docker events (stream)", "subprocess", argv=argv):
+                for line in proc.stdout:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerAPI(DockerCLI):
+    name = "api"
+
+    def __init__(self, socket_path=DOCKER_SOCKET, pool_size=POOL_SIZE):
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._open < self.pool_size:
+                self._open += 1
+                return _UnixHTTPConnection(self.socket_path)
+        return self._pool.get()
+
+    def _release(self, conn, broken=False):
+        if broken:
+            conn.close()
+            conn = _UnixHTTPConnection(self.socket_path)
+        self._pool.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def request(self, method, path, params=None, body=None):
+        with _span(f"{method} {path.split('?')[0]}", "docker-api", params=params):
+            return self._request(method, path, params, body)
+
+    def _request(self, method, path, params=None, body=None):
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        conn = self._acquire()
+        # a pooled connection may have been closed by the daemon while idle;
+        # retry once on a fresh one
+        for attempt in (0, 1):
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError, BrokenPipeError) as e:
+                conn.close()
+                if attempt:
+                    self._release(conn, broken=True)
+                    raise DockerError(str(e))
+            except OSError as e:
+                self._release(conn, broken=True)
+                raise DockerError(str(e))
+        self._release(conn, broken=resp.will_close)
+        if resp.status >= 400:
+            try:
+                msg = json.loads(data).get("message", "")
+            except ValueError:
+                msg = data.decode(errors="replace")
+            if resp.status == 404:
+                raise NotFound(msg)
+            raise DockerError(msg or f"HTTP {resp.status}")
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
+
+    def ping(self) -> bool:
+        try:
+            return self.request("GET", "/_ping") in (b"OK", "OK")
+        except DockerError:
+            return False
+
+    def image_id(self, image: str):
+        try:
+            return self.request("GET", f"/images/{quote(image, safe='')}/json").get("Id")
+        except NotFound:
+            return None
+
+    def image_layers(self, image: str):
+        try:
+            info = self.request("GET", f"/images/{quote(image, safe='')}/json")
+        except DockerError:
+            return []
+        return _overlay_dirs(info.get("GraphDriver"))
+
+    def stop_container(self, name: str):
+        try:
+            self.request("POST", f"/containers/{quote(name)}/stop")
+        except NotFound:
+            pass
+
+    def remove_container(self, name: str, force: bool = False):
+        try:
+            self.request("DELETE", f"/containers/{quote(name)}", {"force": "1" if force else "0"})
+        except NotFound:
+            pass
+
+    def rename_container(self, name: str, new_name: str):
+        self.request("POST", f"/containers/{quote(name)}/rename", {"name": new_name})
+
+    def pause_container(self, name: str):
+        self.request("POST", f"/containers/{quote(name)}/pause")
+
+    def unpause_container(self, name: str):
+        self.request("POST", f"/containers/{quote(name)}/unpause")
+
+    def exec(self, name: str, cmd, env=None, detach=False) -> int:
+        try:
+            body = {"Cmd": list(cmd), "Env": [f"{k}={v}" for k, v in (env or {}).items()]}
+            ex = self.request("POST", f"/containers/{quote(name)}/exec", body=body)
+            self.request("POST", f"/exec/{ex['Id']}/start", body={"Detach": True})
+            while not detach:
+                info = self.request("GET", f"/exec/{ex['Id']}/json")
+                if not info.get("Running"):
+                    return info.get("ExitCode") or 0
+                threading.Event().wait(0.05)
+            return 0
+        except DockerError:
+            return 1
+
+    def run_container(self, spec):
+        ports = spec.get("ports", {})
+        body = {
+            "Image": spec["image"],
+            "Hostname": spec.get("hostname", spec["name"]),
+            "Env": [f"{k}={v}" for k, v in spec.get("env", {}).items()],
+            "Cmd": list(spec.get("cmd", [])),
+            "ExposedPorts": {f"{cp}/tcp": {} for cp in ports.values()},
+            "HostConfig": {
+                "Privileged": bool(spec.get("privileged")),
+                "Binds": list(spec.get("binds", [])),
+                "PortBindings": {
+                    f"{cp}/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(hp)}]
+                    for hp, cp in ports.items()
+                },
+            },
+        }
+        if spec.get("cpus"):
+            body["HostConfig"]["NanoCpus"] = int(float(spec["cpus"]) * 1e9)
+        if spec.get("memory"):
+            body["HostConfig"]["Memory"] = body["HostConfig"]["MemorySwap"] = int(spec["memory"])
+        if spec.get("shm_size"):
+            body["HostConfig"]["ShmSize"] = int(spec["shm_size"])
+        if spec.get("entrypoint"):
+            body["Entrypoint"] = [spec["entrypoint"]]
+        created = self.request("POST", "/containers/create", {"name": spec["name"]}, body)
+        cid = created["Id"]
+        try:
+            self.request("POST", f"/containers/{cid}/start")
+        except DockerError:
+            self.remove_container(cid, force=True)
+            raise
+        return cid
+
+    def containers(self, prefix: str = "", all: bool = True):
+        params = {"all": "1" if all else "0"}
+        if prefix:
+            params["filters"] = json.dumps({"name": [prefix]})
+        out = []
+        for c in self.request("GET", "/containers/json", params) or []:
+            name = (c.get("Names") or ["/"])[0].lstrip('/')
+            if not name.startswith(prefix):
+                continue
+            ports = sorted({p["PublicPort"] for p in c.get("Ports", []) if p.get("PublicPort")})
+            out.append({"id": c["Id"], "name": name, "state": c.get("State", ""), "ports": ports})
+        return out
+
+    def inspect(self, names):
+        # the Engine API inspects one container per request; like stats,
+        # fan the requests out over the keep-alive pool
+        names = list(names)
+        if not names:
+            return {}
+        out = {}
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(names))) as ex:
+            for name, doc in zip(names, ex.map(self._safe_inspect, names)):
+                if doc is not None:
+                    out[name] = doc
+        return out
+
+    def _safe_inspect(self, name):
+        try:
+            return self.request("GET", f"/containers/{quote(name)}/json")
+        except DockerError:
+            return None
+
+    def _one_stats(self, name):
+        return _api_stats_sample(self.request("GET", f"/containers/{quote(name)}/stats", {"stream": "0"}))
+
+    def stream_stats(self, names, stop):
+        # One streaming connection per container, outside the pool since each
+        # stays busy for the whole session; samples are funnelled into a queue.
+        samples = queue.Queue()
+
+        def follow(name):
+            conn = _UnixHTTPConnection(self.socket_path, timeout=None)
+            try:
+                conn.request("GET", f"/containers/{quote(name)}/stats?stream=1")
+                resp = conn.getresponse()
+                if resp.status != 200:
+                    return
+                while not stop.is_set():
+                    line = resp.readline()
+                    if not line:
+                        return
+                    if line.strip():
+                        samples.put((name, _api_stats_sample(json.loads(line))))
+            except (OSError, ValueError, http.client.HTTPException):
+                pass
+            finally:
+                conn.close()
+
+        for n in names:
+            threading.Thread(target=follow, args=(n,), daemon=True).start()
+        while not stop.is_set():
+            try:
+                yield samples.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def events(self, stop, since=None):
+        params = {"filters": json.dumps({"type": ["container"]})}
+        if since:
+            params["since"] = str(int(since))
+        conn = _UnixHTTPConnection(self.socket_path, timeout=None)
+        # closing the socket is what unblocks the readline below
+        threading.Thread(target=lambda: (stop.wait(), conn.sock and conn.sock.shutdown(socket.SHUT_RDWR)),
+                         daemon=True).start()
+        try:
+            conn.request("GET", f"/events?{urlencode(params)}")
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise DockerError(f"events: HTTP {resp.status}")
+            while not stop.is_set():
+                line = resp.readline()
+                if not line:
+                    return
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except (OSError, http.client.HTTPException) as e:
+            if not stop.is_set():
+                raise DockerError(str(e))
+        finally:
+            conn.close()
+
+    def stats(self, names):
+        names = list(names)
+        if not names:
+            return {}
+        out = {}
+        # each non-streaming sample waits ~1s for a CPU delta, so fan out over the pool
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(names))) as ex:
+            for name, res in zip(names, ex.map(self._safe_stats, names)):
+                if res is not None:
+                    out[name] = res
+        return out
+
+    def _safe_stats(self, name):
+        try:
+            return self._one_stats(name)
+        except (DockerError, KeyError, TypeError):
+            return None
+
+
+def _api_stats_sample(s):
+    cpu = s.get("cpu_stats", {})
+    pre = s.get("precpu_stats", {})
+    cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - pre.get("cpu_usage", {}).get("total_usage", 0)
+    sys_delta = cpu.get("system_cpu_usage", 0) - pre.get("system_cpu_usage", 0)
+    ncpu = cpu.get("online_cpus") or len(cpu.get("cpu_usage", {}).get("percpu_usage") or []) or 1
+    cpu_percent = (cpu_delta / sys_delta) * ncpu * 100.0 if sys_delta > 0 and cpu_delta > 0 else 0.0
+    mem = s.get("memory_stats", {})
+    mstat = mem.get("stats", {})
+    # same definition as `docker stats`: usage minus reclaimable page cache
+    cache = mstat.get("inactive_file", mstat.get("total_inactive_file", 0))
+    net_rx = sum(n.get("rx_bytes", 0) for n in (s.get("networks") or {}).values())
+    net_tx = sum(n.get("tx_bytes", 0) for n in (s.get("networks") or {}).values())
+    blk_read = blk_write = 0
+    for e in (s.get("blkio_stats", {}).get("io_service_bytes_recursive") or []):
+        op = e.get("op", "").lower()
+        if op == "read":
+            blk_read += e.get("value", 0)
+        elif op == "write":
+            blk_write += e.get("value", 0)
+    return {
+        "id": s.get("id", ""),
+        "cpu_percent": round(cpu_percent, 2),
+        "mem_used": max(mem.get("usage", 0) - cache, 0),
+        "mem_limit": mem.get("limit", 0),
+        "net_rx": net_rx,
+        "net_tx": net_tx,
+        "blk_read": blk_read,
+        "blk_write": blk_write,
+        "pids": s.get("pids_stats", {}).get("current", 0),
+    }
+
+
+def get_backend(mode=None):
+    mode = (mode or os.environ.get("DESKTOP_DOCKER_BACKEND", "auto")).lower()
+    if mode == "cli":
+        return DockerCLI()
+    host = os.environ.get("DOCKER_HOST", "")
+    path = host[len("unix://"):] if host.startswith("unix://") else DOCKER_SOCKET
+    if host and not host.startswith("unix://"):
+        if mode == "api":
+            raise DockerError(f"DOCKER_HOST={host} is not a unix socket")
+        return DockerCLI()
+    api = DockerAPI(path)
+    if mode == "api" or (os.path.exists(path) and api.ping()):
+        return api
+    return DockerCLI()
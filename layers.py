@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# Copying and merging overlay layer trees for clone/snapshot/restore.
+#
+# A storage is an overlay upper/ (plus, once cloned by hardlinks, a lower/
+# layer stacked over the image). Trees are copied entry by entry so that
+# everything overlayfs cares about survives: whiteouts (0/0 char devices),
+# opaque directories and other trusted.*/user.* xattrs, ownership, modes,
+# timestamps and hard links inside the tree.
+#
+# File contents are duplicated in one of three ways:
+#   reflink  FICLONE ioctl, shares extents copy-on-write (btrfs, xfs, bcachefs)
+#   link     hard links; only valid for read-only lower layers, where the
+#            overlay copies a file up before its first write
+#   copy     plain copy (copy_file_range/sendfile via shutil), last resort
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import struct
+import tempfile
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int)
+FIDEDUPERANGE = 0xC0189436  # _IOWR(0x94, 54, struct file_dedupe_range)
+DEDUPE_CHUNK = 16 << 20  # btrfs dedupes at most 16MiB per call
+OPAQUE_XATTRS = ("trusted.overlay.opaque", "user.overlay.opaque")
+METHODS = ("reflink", "link", "copy")
+
+
+def is_whiteout(st) -> bool:
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def is_opaque(path: str) -> bool:
+    for attr in OPAQUE_XATTRS:
+        try:
+            if os.getxattr(path, attr, follow_symlinks=False) == b"y":
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def reflink(src: str, dst: str):
+    with open(src, 'rb') as fs, open(dst, 'wb') as fd:
+        fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+
+
+def dedupe(src: str, dst: str, size: int) -> int:
+    # Makes dst share src's extents if (and only if) the contents are equal;
+    # the kernel compares under lock, so this is safe on files in use. Returns
+    # the bytes deduplicated; raises OSError where unsupported.
+    done = 0
+    with open(src, 'rb') as fs, open(dst, 'rb') as fd:
+        while done < size:
+            length = min(DEDUPE_CHUNK, size - done)
+            # struct file_dedupe_range + one file_dedupe_range_info
+            buf = bytearray(struct.pack("<QQHHI", done, length, 1, 0, 0) +
+                            struct.pack("<qQQiI", fd.fileno(), done, 0, 0, 0))
+            fcntl.ioctl(fs.fileno(), FIDEDUPERANGE, buf, True)
+            _, _, deduped, status, _ = struct.unpack_from("<qQQiI", buf, 24)
+            if status < 0:
+                raise OSError(-status, os.strerror(-status), dst)
+            if status != 0 or deduped == 0:
+                # FILE_DEDUPE_RANGE_DIFFERS: changed since it was hashed
+                break
+            done += deduped
+    return done
+
+
+def reflink_supported(directory: str) -> bool:
+    try:
+        with tempfile.TemporaryDirectory(dir=directory, prefix=".reflink-probe-") as tmp:
+            src = os.path.join(tmp, "a")
+            with open(src, 'wb') as f:
+                f.write(b"probe")
+            reflink(src, os.path.join(tmp, "b"))
+        return True
+    except OSError:
+        return False
+
+
+def copy_metadata(src: str, dst: str, st):
+    try:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except OSError:
+        pass
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    try:
+        names = os.listxattr(src, follow_symlinks=False)
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+        except OSError as e:
+            # trusted.* needs CAP_SYS_ADMIN; without it opaque dirs would be lost
+            if e.errno in (errno.EPERM, errno.EACCES) and name.startswith("trusted."):
+                raise
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def copy_tree(src: str, dst: str, method: str) -> dict:
+    # Recreates src at dst (which must not exist). Returns counters.
+    totals = {"files": 0, "dirs": 0, "bytes": 0, "whiteouts": 0}
+    inodes = {}  # (dev, ino) -> first copy, to keep hard links hard
+    dirs = []  # metadata is applied after the children so mtimes stick
+
+    def copy_entry(s, d, st):
+        mode = st.st_mode
+        if stat.S_ISDIR(mode):
+            os.mkdir(d, 0o700)
+            dirs.append((s, d, st))
+            totals["dirs"] += 1
+            with os.scandir(s) as it:
+                for e in it:
+                    copy_entry(e.path, os.path.join(d, e.name), e.stat(follow_symlinks=False))
+            return
+        key = (st.st_dev, st.st_ino)
+        if method == "link" or (st.st_nlink > 1 and key in inodes):
+            os.link(inodes.get(key, s), d, follow_symlinks=False)
+        elif stat.S_ISREG(mode):
+            if method == "reflink":
+                reflink(s, d)
+            else:
+                shutil.copyfile(s, d, follow_symlinks=False)
+            copy_metadata(s, d, st)
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(s), d)
+            copy_metadata(s, d, st)
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode) or stat.S_ISFIFO(mode):
+            os.mknod(d, mode, st.st_rdev)
+            copy_metadata(s, d, st)
+        else:
+            # sockets are meaningless once the process that bound them is gone
+            return
+        if st.st_nlink > 1:
+            inodes.setdefault(key, d)
+        if is_whiteout(st):
+            totals["whiteouts"] += 1
+        else:
+            totals["files"] += 1
+            totals["bytes"] += st.st_size
+
+    copy_entry(src, dst, os.lstat(src))
+    for s, d, st in reversed(dirs):
+        copy_metadata(s, d, st)
+    return totals
+
+
+def _remove(path: str):
+    try:
+        st = os.lstat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        # a parent that is no longer a directory took it along already
+        return
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def squash(upper: str, lower: str) -> int:
+    # Moves everything in upper/ into lower/ with overlay semantics, leaving
+    # upper/ empty: an upper entry replaces the lower one, whiteouts and opaque
+    # directories replace whatever they hide (and stay, since lower/ sits over
+    # the image). Only renames and unlinks, nothing is rewritten in lower/, so
+    # files hard-linked into other layers are left alone. Returns moved entries.
+    os.makedirs(lower, exist_ok=True)
+    moved = 0
+    with os.scandir(upper) as it:
+        entries = list(it)
+    for e in entries:
+        target = os.path.join(lower, e.name)
+        st = e.stat(follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode) and not is_opaque(e.path) and os.path.isdir(target) \
+                and not os.path.islink(target):
+            moved += squash(e.path, target)
+            copy_metadata(e.path, target, st)
+            os.rmdir(e.path)
+            continue
+        _remove(target)
+        os.rename(e.path, target)
+        moved += 1
+    return moved
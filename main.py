@@ -1,103 +1,979 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import os
+import re
 import sys
-import subprocess
 import shutil
 import socket
-import re
 import getpass
+import subprocess
+import stat
+import tarfile
+import fnmatch
+import fcntl
+import asyncio
+import selectors
+import sqlite3
+import threading
+import atexit
+import copy
+import time
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+from collections import deque
 from datetime import datetime, timezone
 
+import archive
+import cgroup_stats
+import compact
+import dedup
+import disks
+import docker_client
+import layers
+from docker_client import DockerError
+
 STATE_FILE = "storages.json"
+STATE_DB = "storages.db"
+STATE_BACKEND = os.environ.get("DESKTOP_STATE_BACKEND", "sqlite")  # sqlite | json
 IMAGE_NAME = "vnc-desktop"
 DOCKERFILE_PATH = "."
+# Images built from stages of the one Dockerfile. A storage runs "desktop"
+# unless `main.py variant` picked another; only variants with vnc serve VNC.
+IMAGE_VARIANTS = {
+    "desktop": {"image": IMAGE_NAME, "target": "desktop", "vnc": True},
+    "terminal": {"image": f"{IMAGE_NAME}-terminal", "target": "terminal", "vnc": False},
+}
+DEFAULT_VARIANT = "desktop"
 CONTAINER_PREFIX = "vnc-"  # all our containers are named vnc-<storage>
+PORT_RESERVATION_TTL = 120  # seconds a claimed port stays reserved before docker run confirms it
+LIST_WORKERS = 8  # concurrent overlay size scans in `list`
+BULK_JOBS = int(os.environ.get("DESKTOP_BULK_JOBS", "8"))  # parallel start/stop/restart in bulk mode
+DEFAULT_PORT = 2000
+STORAGES_DIR = "storages"
+SNAPSHOTS_DIR = "snapshots"  # snapshots/<storage>/<snapshot>/{lower,upper,snapshot.json}
+# Storage profile fields a clone inherits from its source
+CLONED_FIELDS = ("labels", "resources", "display", "variant")
+EXPORT_MANIFEST = ".export-manifest.jsonl"  # manifest of the last export, next to upper/
+TRASH_DIR = STORAGES_DIR + ".trash"  # deleted storages waiting for the reaper; same filesystem
+REAP_JOBS = int(os.environ.get("DESKTOP_REAP_JOBS", "4"))  # parallel unlinkers per directory
+REAP_RATE = float(os.environ.get("DESKTOP_REAP_RATE", "5000"))  # unlinks per second, 0 = unthrottled
+REAP_IONICE = os.environ.get("DESKTOP_REAP_IONICE", "3")  # ionice class for the reaper, '' = leave alone
+POOL_PREFIX = "vncpool-"  # warm pool members; deliberately not matching CONTAINER_PREFIX
+# Files read once by each pool member so the desktop stack is hot in the page cache.
+POOL_WARM_PATHS = "/usr/bin/Xtigervnc /usr/bin/xfce4-session /usr/bin/xfwm4 /usr/bin/xfdesktop " \
+                  "/usr/bin/xfce4-panel /usr/lib/x86_64-linux-gnu/xfce4 /usr/lib/x86_64-linux-gnu/libgtk-3.so.0"
+LIST_DEADLINE = float(os.environ.get("DESKTOP_LIST_DEADLINE", "30"))  # seconds for the whole report
+SIZE_INDEX_FILE = ".size-index.json"  # per-storage overlay size index, next to upper/
+# In-place writes to an existing file don't bump its directory's mtime, so the
+# index is fully re-walked at least this often (seconds) to pick those up.
+SIZE_INDEX_MAX_AGE = float(os.environ.get("DESKTOP_SIZE_INDEX_MAX_AGE", "21600"))
+# Every desktop gets a real /dev/shm (docker's default is 64MB, too small for
+# Chrome) unless its resource profile sets another size.
+DEFAULT_SHM_SIZE = 1 << 30
+RESOURCE_KEYS = ("cpus", "memory", "shm_size", "tmp_size", "run_size")
+# Admission control: refuse a start when the memory committed to running
+# desktops would exceed this fraction of host RAM (0 turns it off). Only
+# explicit --memory limits count, unless DESKTOP_UNLIMITED_MEMORY gives
+# desktops without one a size to count as.
+MEMORY_COMMIT_RATIO = float(os.environ.get("DESKTOP_MEMORY_COMMIT_RATIO", "0.9"))
+UNLIMITED_MEMORY = os.environ.get("DESKTOP_UNLIMITED_MEMORY", "0")
+# Idle watcher: a running desktop with no VNC connection and CPU below the
+# threshold for IDLE_TIMEOUT seconds is paused (or stopped, IDLE_ACTION=stop).
+IDLE_TIMEOUT = float(os.environ.get("DESKTOP_IDLE_TIMEOUT", "1800"))
+IDLE_CPU_THRESHOLD = float(os.environ.get("DESKTOP_IDLE_CPU", "5"))  # percent of one core
+IDLE_ACTION = os.environ.get("DESKTOP_IDLE_ACTION", "pause")  # pause | stop
+IDLE_INTERVAL = 30.0  # seconds between idle checks
+VNC_PORT = 5901  # VNC port inside every container
+GATEWAY_PORT = int(os.environ.get("DESKTOP_GATEWAY_PORT", "5900"))
+GATEWAY_PREAMBLE_TIMEOUT = 5.0  # seconds for a client to send its token line
+GATEWAY_SESSION_LOG = 200  # recent sessions kept in state for `gateway sessions`
+# Display profiles: Xvnc gets geometry/depth/FrameRate/ZlibLevel through the
+# entrypoint's VNC_* variables; encodings and JPEG quality are chosen by the
+# client, so those are shown as viewer flags.
+DISPLAY_KEYS = ("geometry", "depth", "fps", "encodings", "compress", "quality")
+DISPLAY_PRESETS = {
+    "lan": {"geometry": "1920x1080", "depth": 24, "fps": 60, "encodings": "Tight", "compress": 2, "quality": 8},
+    "wan": {"geometry": "1600x900", "depth": 24, "fps": 30, "encodings": "Tight", "compress": 6, "quality": 6},
+    "low": {"geometry": "1280x720", "depth": 16, "fps": 15, "encodings": "Tight", "compress": 9, "quality": 3},
+}
+DEFAULT_DISPLAY_PRESET = "lan"
+VNC_ENCODINGS = ("Tight", "ZRLE", "Hextile", "Raw")
+RECONCILE_HEARTBEAT = 10.0  # seconds between reconciler heartbeats in state
+# `list --json/--format` fields and the collector each one needs; "state" is
+# just the state store, the rest only run when one of their fields is asked for
+LIST_FIELDS = {
+    **dict.fromkeys(("name", "status", "port", "container_id", "path", "labels", "resources", "display",
+                     "gateway", "idle_since", "reclaimed", "cloned_from", "variant"), "state"),
+    **dict.fromkeys(("disk_bytes", "disk_files", "whiteouts", "opaque_dirs"), "size"),
+    **dict.fromkeys(("disk_size", "disk_free"), "disk"),
+    **dict.fromkeys(("lower_bytes", "lower_files"), "lower"),
+    **dict.fromkeys(("cpu_percent", "mem_used", "mem_limit", "net_rx", "net_tx", "blk_read", "blk_write",
+                     "pids"), "stats"),
+    **dict.fromkeys(("started_at", "uptime"), "inspect"),
+}
+DEFAULT_LIST_FIELDS = ("name", "status", "port", "container_id", "path", "labels")
+TOP_INTERVAL = 2.0  # seconds between `top` redraws
+TOP_HISTORY = 300  # seconds of samples kept per container in `top`
+TOP_RESCAN = 10.0  # seconds between checks for containers started/stopped meanwhile
+
+
+def parse_size(s) -> int:
+    # docker-style sizes: 512m, 2g, 1.5GiB, 1073741824
+    s = str(s).strip().lower()
+    m = re.match(r'^([\d.]+)\s*([kmgt]?)(i?b)?$', s)
+    if not m:
+        raise ValueError(f"Invalid size '{s}'")
+    return int(float(m.group(1)) * 1024 ** " kmgt".index(m.group(2) or " "))
+
+
+class Tracer:
+    # Records spans as Chrome trace events ("X" phase, microseconds), viewable
+    # in chrome://tracing or Perfetto. Disabled unless a path is given, in
+    # which case span() is a near no-op.
+    def __init__(self, path=None):
+        self.path = path
+        self.events = []
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @contextmanager
+    def span(self, name, cat="phase", **args):
+        if not self.path:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name, "cat": cat, "ph": "X",
+                "ts": round((start - self._t0) * 1e6, 1),
+                "dur": round((end - start) * 1e6, 1),
+                "pid": os.getpid(), "tid": threading.get_ident(),
+            }
+            if args:
+                event["args"] = {
+                    k: v if isinstance(v, (int, float, bool, type(None)))
+                    else " ".join(map(str, v)) if isinstance(v, (list, tuple)) else str(v)
+                    for k, v in args.items()
+                }
+            with self._lock:
+                self.events.append(event)
+
+    def finish(self):
+        if not self.path:
+            return
+        with open(self.path, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        totals = {}
+        for e in self.events:
+            t = totals.setdefault((e["cat"], e["name"]), [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += e["dur"] / 1000.0
+            t[2] = max(t[2], e["dur"] / 1000.0)
+        out = sys.stderr
+        print(f"\nTrace: {len(self.events)} events written to {self.path}", file=out)
+        print(f"  {'category':<11} {'name':<38} {'count':>6} {'total ms':>10} {'max ms':>9}", file=out)
+        for (cat, name), (count, total, peak) in sorted(totals.items(), key=lambda t: -t[1][1])[:25]:
+            print(f"  {cat:<11} {name[:38]:<38} {count:>6} {total:>10.1f} {peak:>9.1f}", file=out)
+
+
+TRACE = Tracer(os.environ.get("DESKTOP_TRACE") or None)
+
+
+class Throttle:
+    # Token bucket shared by threads: take(n) sleeps until n more operations
+    # fit under `rate` per second (0 disables it).
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_at = max(self.next_at, now) + n / self.rate
+            delay = self.next_at - now - n / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class PortAllocator:
+    # One byte per TCP port, non-zero when taken. Built once from a snapshot of
+    # the host sockets, Docker's published ports and the state file; lookups are
+    # a single memchr over 64 KiB instead of a bind + `docker ps` per port.
+    def __init__(self, taken=()):
+        self.bitmap = bytearray(65536)
+        for port in taken:
+            if 0 < port < 65536:
+                self.bitmap[port] = 1
+
+    def is_free(self, port: int) -> bool:
+        return 0 < port < 65536 and not self.bitmap[port]
+
+    def claim(self, port: int):
+        if 0 < port < 65536:
+            self.bitmap[port] = 1
+
+    def next_free(self, start: int = 2000, end: int = 65535) -> int:
+        start = max(start, 1)
+        end = min(end, 65535)
+        if start > end:
+            return -1
+        return self.bitmap.find(0, start, end + 1)
+
+
+class SQLiteStateStore:
+    # storages.db in WAL mode: one JSON row per storage, a key/value meta table
+    # and the port reservations. Updates touch a single row; read-modify-write
+    # sequences run inside transaction(), which takes SQLite's write lock
+    # (BEGIN IMMEDIATE) so concurrent CLI invocations serialize on it.
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._local = threading.local()
+        with self.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS storages ("
+                       "name TEXT PRIMARY KEY, seq INTEGER NOT NULL, data TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS port_reservations ("
+                       "port INTEGER PRIMARY KEY, storage TEXT NOT NULL, at REAL NOT NULL)")
+
+    @property
+    def db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            # switching a new database to WAL takes an exclusive lock without
+            # waiting on the busy timeout; concurrent first runs retry
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    break
+                except sqlite3.OperationalError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.05)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        db = self.db
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield db
+            finally:
+                self._local.depth -= 1
+            return
+        db.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def get(self, name):
+        row = self.db.execute("SELECT data FROM storages WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all(self):
+        rows = self.db.execute("SELECT name, data FROM storages ORDER BY seq").fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def insert(self, name, data) -> bool:
+        with self.transaction() as db:
+            try:
+                db.execute("INSERT INTO storages (name, seq, data) "
+                           "SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM storages",
+                           (name, json.dumps(data)))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def update(self, name, **fields):
+        with self.transaction() as db:
+            data = self.get(name)
+            if data is None:
+                return None
+            data.update(fields)
+            db.execute("UPDATE storages SET data = ? WHERE name = ?", (json.dumps(data), name))
+        return data
 
+    def delete(self, name):
+        with self.transaction() as db:
+            db.execute("DELETE FROM storages WHERE name = ?", (name,))
+
+    def rename(self, old, new) -> bool:
+        with self.transaction() as db:
+            try:
+                cur = db.execute("UPDATE storages SET name = ? WHERE name = ?", (new, old))
+            except sqlite3.IntegrityError:
+                return False
+        return cur.rowcount == 1
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def reserved_ports(self, exclude=None):
+        rows = self.db.execute("SELECT port FROM port_reservations WHERE storage IS NOT ? AND at > ?",
+                               (exclude, time.time() - PORT_RESERVATION_TTL)).fetchall()
+        return {r[0] for r in rows}
+
+    def reserve_port(self, port: int, name):
+        with self.transaction() as db:
+            db.execute("DELETE FROM port_reservations WHERE at <= ?", (time.time() - PORT_RESERVATION_TTL,))
+            db.execute("INSERT OR REPLACE INTO port_reservations (port, storage, at) VALUES (?, ?, ?)",
+                       (port, name, time.time()))
+
+    def release_port(self, port: int):
+        with self.transaction() as db:
+            db.execute("DELETE FROM port_reservations WHERE port = ?", (port,))
+
+
+class JSONStateStore:
+    # The original storages.json layout, rewritten whole on every change.
+    # Kept for people who edit the file by hand; every mutation reloads and
+    # saves under an exclusive flock so concurrent runs don't lose updates.
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._data = None
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        else:
+            data = {}
+        data.setdefault("storages", {})
+        return data
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self._data
+                finally:
+                    self._depth -= 1
+                return
+            with open(self.path + ".lock", 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._data = self._load()
+                    self._depth = 1
+                    yield self._data
+                    tmp = f"{self.path}.{os.getpid()}.tmp"
+                    with open(tmp, 'w') as f:
+                        json.dump(self._data, f, indent=2)
+                    os.replace(tmp, self.path)
+                finally:
+                    self._depth = 0
+                    self._data = None
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        with self._lock:
+            return self._data if self._depth else self._load()
+
+    def snapshot(self):
+        # the whole state (storages, meta keys, reservations) as one dict
+        return copy.deepcopy(self._read())
+
+    def get(self, name):
+        return self._read()["storages"].get(name)
+
+    def all(self):
+        return self._read()["storages"]
+
+    def insert(self, name, data) -> bool:
+        with self.transaction() as state:
+            if name in state["storages"]:
+                return False
+            state["storages"][name] = data
+        return True
+
+    def update(self, name, **fields):
+        with self.transaction() as state:
+            data = state["storages"].get(name)
+            if data is not None:
+                data.update(fields)
+        return data
 
-class StorageManager:
-    def __init__(self):
-        self.state = self.load_state()
-
-    def load_state(self):
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
-        return {"storages": {}, "image_built": False}
-
-    def save_state(self):
-        with open(STATE_FILE, 'w') as f:
-            json.dump(self.state, f, indent=2)
-
-    def ensure_image(self):
-        result = subprocess.run(['docker', 'images', '-q', IMAGE_NAME],
-                                capture_output=True, text=True)
-        if not result.stdout.strip():
-            print(f"Building image {IMAGE_NAME}...")
-            build_result = subprocess.run(
-                ['docker', 'build', '-t', IMAGE_NAME, DOCKERFILE_PATH]
-            )
-            if build_result.returncode != 0:
-                print("Error building image")
-                sys.exit(1)
-            self.state["image_built"] = True
-            self.save_state()
-            print("Image built successfully")
+    def delete(self, name):
+        with self.transaction() as state:
+            state["storages"].pop(name, None)
+
+    def rename(self, old, new) -> bool:
+        with self.transaction() as state:
+            if old not in state["storages"] or new in state["storages"]:
+                return False
+            state["storages"][new] = state["storages"].pop(old)
+        return True
+
+    def get_meta(self, key, default=None):
+        return self._read().get(key, default)
+
+    def set_meta(self, key, value):
+        with self.transaction() as state:
+            state[key] = value
+
+    def reserved_ports(self, exclude=None):
+        now = time.time()
+        return {int(p) for p, r in self._read().get("port_reservations", {}).items()
+                if r.get("storage") != exclude and now - r.get("at", 0) < PORT_RESERVATION_TTL}
+
+    def reserve_port(self, port: int, name):
+        with self.transaction() as state:
+            reservations = state.setdefault("port_reservations", {})
+            now = time.time()
+            for p in [p for p, r in reservations.items() if now - r.get("at", 0) >= PORT_RESERVATION_TTL]:
+                del reservations[p]
+            reservations[str(port)] = {"storage": name, "at": now}
+
+    def release_port(self, port: int):
+        with self.transaction() as state:
+            state.get("port_reservations", {}).pop(str(port), None)
+
+
+def open_state_store():
+    if STATE_BACKEND == "json":
+        return JSONStateStore()
+    store = SQLiteStateStore()
+    if not os.path.exists(STATE_FILE):
+        return store
+    # Decided and done under the write lock: of two first runs racing here,
+    # one imports and the other finds the file gone (or the rows there).
+    with store.transaction():
+        if not os.path.exists(STATE_FILE) or store.get_meta("migrated_from") or store.all():
+            return store
+        state = JSONStateStore().snapshot()
+        for name, data in state["storages"].items():
+            store.insert(name, data)
+        for key, value in state.items():
+            if key not in ("storages", "port_reservations"):
+                store.set_meta(key, value)
+        store.set_meta("migrated_from", STATE_FILE)
+        try:
+            os.replace(STATE_FILE, STATE_FILE + ".migrated")
+        except FileNotFoundError:
+            pass
+    print(f"Migrated {STATE_FILE} to {STATE_DB} (old file kept as {STATE_FILE}.migrated)")
+    return store
+
+
+class OverlaySizeIndex:
+    # Per-directory totals of an overlay upper/ tree keyed by the directory's
+    # (inode, mtime, ctime). Adding, removing or renaming an entry changes the
+    # directory's mtime, so unchanged directories keep their cached totals and
+    # child list: they cost one lstat and their files are never touched.
+    # Whiteouts (0/0 char devices) and opaque directories are counted apart
+    # from regular content.
+    VERSION = 1
+
+    def __init__(self, storage_path: str, layer: str = "upper"):
+        self.root = os.path.join(storage_path, layer)
+        index_file = SIZE_INDEX_FILE if layer == "upper" else SIZE_INDEX_FILE.replace(".json", f".{layer}.json")
+        self.path = os.path.join(storage_path, index_file)
+        self.entries = {}
+        self.full_scan_at = 0.0
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                self.entries = data.get("dirs", {})
+                self.full_scan_at = data.get("full_scan_at", 0.0)
+        except (OSError, ValueError):
+            pass
 
-    def create(self, name):
-        if name in self.state["storages"]:
-            print(f"Storage '{name}' already exists")
-            return
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({"version": self.VERSION, "full_scan_at": self.full_scan_at,
+                           "dirs": self.entries}, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _is_opaque(self, path: str) -> bool:
+        return layers.is_opaque(path)
+
+    def _scan_dir(self, path: str, st) -> dict:
+        entry = {
+            "key": [st.st_ino, st.st_mtime_ns, st.st_ctime_ns],
+            "bytes": st.st_size,
+            "files": 0,
+            "whiteouts": 0,
+            "opaque": self._is_opaque(path),
+            "dirs": [],
+        }
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        est = e.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(est.st_mode):
+                        entry["dirs"].append(e.name)
+                    elif stat.S_ISCHR(est.st_mode) and est.st_rdev == 0:
+                        entry["whiteouts"] += 1
+                    else:
+                        entry["bytes"] += est.st_size
+                        entry["files"] += 1
+        except OSError:
+            pass
+        return entry
+
+    def scan(self, deadline=None):
+        # Returns the totals, or None if `deadline` (monotonic) passed first.
+        # Partial progress is still saved so the next run resumes cheaper.
+        with TRACE.span("overlay size scan", "fs", path=self.root):
+            return self._scan(deadline)
+
+    def _scan(self, deadline):
+        full = time.time() - self.full_scan_at > SIZE_INDEX_MAX_AGE
+        totals = {"bytes": 0, "files": 0, "dirs": 0, "whiteouts": 0, "opaque_dirs": 0, "rescanned_dirs": 0}
+        seen = {}
+        stack = [""]
+        while stack:
+            if deadline is not None and time.monotonic() > deadline:
+                self.entries.update(seen)
+                self.save()
+                return None
+            rel = stack.pop()
+            path = os.path.join(self.root, rel) if rel else self.root
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            entry = self.entries.get(rel)
+            if full or not entry or entry["key"] != [st.st_ino, st.st_mtime_ns, st.st_ctime_ns]:
+                entry = self._scan_dir(path, st)
+                totals["rescanned_dirs"] += 1
+            seen[rel] = entry
+            totals["bytes"] += entry["bytes"]
+            totals["files"] += entry["files"]
+            totals["dirs"] += 1
+            totals["whiteouts"] += entry["whiteouts"]
+            totals["opaque_dirs"] += 1 if entry["opaque"] else 0
+            stack.extend(os.path.join(rel, d) for d in entry["dirs"])
+        self.entries = seen
+        if full:
+            self.full_scan_at = time.time()
+        self.save()
+        return totals
+
+
+class StatsHistory:
+    # Fixed-size ring buffer of stats samples for one container. Net and block
+    # counters are cumulative, so their rates come from deltas inside a window.
+
+    def __init__(self, seconds: int = TOP_HISTORY):
+        self.seconds = seconds
+        # docker refreshes about once a second; the time cut in window() keeps
+        # the view right if it is faster
+        self.samples = deque(maxlen=max(int(seconds) * 2, 2))
+
+    def add(self, sample, ts=None):
+        self.samples.append((
+            ts if ts is not None else time.monotonic(),
+            sample["cpu_percent"], sample["mem_used"], sample["mem_limit"],
+            sample["net_rx"], sample["net_tx"], sample["blk_read"], sample["blk_write"],
+        ))
+
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def window(self, seconds):
+        if not self.samples:
+            return []
+        since = self.samples[-1][0] - seconds
+        return [s for s in self.samples if s[0] >= since]
+
+    def summary(self, seconds):
+        # {"cpu": (avg, peak), "mem": (avg, peak), "net": (avg_rate, peak_rate), "blk": ...}
+        w = self.window(seconds)
+        if not w:
+            return None
+        out = {
+            "cpu": (sum(s[1] for s in w) / len(w), max(s[1] for s in w)),
+            "mem": (sum(s[2] for s in w) / len(w), max(s[2] for s in w)),
+        }
+        for key, cols in (("net", (4, 5)), ("blk", (6, 7))):
+            rates = []
+            for a, b in zip(w, w[1:]):
+                dt = b[0] - a[0]
+                if dt > 0:
+                    # counters go backwards when the container restarts
+                    rates.append(max(sum(b[c] - a[c] for c in cols), 0) / dt)
+            span = w[-1][0] - w[0][0]
+            total = max(sum(w[-1][c] - w[0][c] for c in cols), 0)
+            out[key] = (total / span if span > 0 else 0.0, max(rates) if rates else 0.0)
+        return out
 
-        storage_path = os.path.abspath(f"storages/{name}")
-        os.makedirs(storage_path, exist_ok=True)
 
-        self.state["storages"][name] = {
+class StorageManager:
+    def __init__(self):
+        self.store = open_state_store()
+        self._docker = None
+
+    @property
+    def docker(self):
+        # resolved lazily so state-only commands never touch the daemon
+        if self._docker is None:
+            self._docker = docker_client.get_backend()
+        return self._docker
+
+    # ==== IMAGES ====
+    def ensure_image(self, variant=DEFAULT_VARIANT, force=False, log=print) -> bool:
+        with TRACE.span("ensure_image", variant=variant):
+            return self._ensure_image(variant, force, log)
+
+    def _image_variant(self, storage) -> str:
+        return (storage or {}).get("variant") or DEFAULT_VARIANT
+
+    def _context_hash(self, variant) -> str:
+        # What `docker build` would be sent, plus the stage built from it
+        spec = IMAGE_VARIANTS[variant]
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{spec['target']}\0".encode())
+        for rel in build_context_files(DOCKERFILE_PATH):
+            path = os.path.join(DOCKERFILE_PATH, rel)
+            h.update(f"{rel}\0{os.lstat(path).st_mode:o}\0".encode())
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def _ensure_image(self, variant, force=False, log=print) -> bool:
+        # The build recorded in meta answers "is the image current?" without
+        # asking docker; any change to the build context means a rebuild,
+        # which docker's layer cache keeps down to the stages that changed.
+        spec = IMAGE_VARIANTS[variant]
+        with TRACE.span("image: hash context"):
+            digest = self._context_hash(variant)
+        built = self.store.get_meta("images", {}).get(variant)
+        if built and built.get("hash") == digest and not force:
+            return True
+        why = "forced" if force else "build context changed" if built else "no recorded build"
+        log(f"Building image {spec['image']} (target {spec['target']}, {why})...")
+        if not self.docker.build_image(spec["image"], DOCKERFILE_PATH, ['--target', spec["target"]]):
+            log(f"Error building image {spec['image']}")
+            return False
+        image_id = self.docker.image_id(spec["image"])
+        with self.store.transaction():
+            images = self.store.get_meta("images", {})
+            images[variant] = {"hash": digest, "id": image_id, "built": time.time()}
+            self.store.set_meta("images", images)
+        log(f"Image built successfully ({(image_id or '?').removeprefix('sha256:')[:12]})")
+        return True
+
+    def _forget_image(self, variant):
+        with self.store.transaction():
+            images = self.store.get_meta("images", {})
+            images.pop(variant, None)
+            self.store.set_meta("images", images)
+
+    def _run_image(self, spec, variant, log=print):
+        # The recorded build stands in for checking that the image exists; if
+        # it was removed behind our back, build it again and retry once.
+        try:
+            return self.docker.run_container(spec)
+        except DockerError as e:
+            if "No such image" not in str(e) and "Unable to find image" not in str(e):
+                raise
+        log(f"Image {spec['image']} is gone, rebuilding it")
+        self._forget_image(variant)
+        if not self.ensure_image(variant, log=log):
+            raise DockerError(f"image {spec['image']} could not be rebuilt")
+        return self.docker.run_container(spec)
+
+    def image_status(self):
+        images = self.store.get_meta("images", {})
+        for variant, spec in IMAGE_VARIANTS.items():
+            built = images.get(variant)
+            if not built:
+                print(f"{variant:<10} {spec['image']:<24} not built yet")
+                continue
+            fresh = "up to date" if built["hash"] == self._context_hash(variant) else "stale, rebuilt on next start"
+            when = datetime.fromtimestamp(built["built"]).strftime("%Y-%m-%d %H:%M")
+            print(f"{variant:<10} {spec['image']:<24} {(built.get('id') or '?').removeprefix('sha256:')[:12]}  "
+                  f"built {when}, {fresh}")
+        users = {}
+        for s in self.store.all().values():
+            users[self._image_variant(s)] = users.get(self._image_variant(s), 0) + 1
+        print("Storages: " + (", ".join(f"{v} {n}" for v, n in sorted(users.items())) or "none"))
+
+    def set_variant(self, name, variant=None, force=False):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        if variant is None:
+            print(f"{name}: {self._image_variant(storage)}")
+            return True
+        if variant not in IMAGE_VARIANTS:
+            print(f"Unknown variant '{variant}' (one of {', '.join(IMAGE_VARIANTS)})")
+            return False
+        if storage.get("status") in ("running", "paused"):
+            print(f"Storage '{name}' is {storage['status']}; stop it before changing its image")
+            return False
+        if variant != self._image_variant(storage) and not force:
+            # upper/ holds changes made on top of the old image; on another
+            # image its whiteouts and copied-up files mean something else
+            if not self._ensure_disk(storage):
+                return False
+            upper = os.path.join(storage["path"], "upper")
+            if os.path.isdir(upper) and any(os.scandir(upper)):
+                print(f"Storage '{name}' has changes in {upper} made on the {self._image_variant(storage)} "
+                      f"image; use --force to move them onto {variant} anyway")
+                return False
+        self.store.update(name, variant=variant)
+        print(f"{name}: {variant} ({IMAGE_VARIANTS[variant]['image']}); "
+              f"its overlay now sits on this image from the next start")
+        return True
+
+    def create(self, name, labels=None, log=print, variant=None, size=None):
+        storage_path = os.path.abspath(f"storages/{name}")
+        data = {
             "path": storage_path,
             "container_id": None,
             "status": "stopped",
             "port": None
         }
-        self.save_state()
-        print(f"Storage '{name}' created at {storage_path}")
+        if labels:
+            data["labels"] = dict(labels)
+        if variant and variant != DEFAULT_VARIANT:
+            data["variant"] = variant
+        if size:
+            data["disk"] = {"backend": "loop", "size": size}
+        created = self.store.insert(name, data)
+        if not created:
+            log(f"Storage '{name}' already exists")
+            return
 
-    def is_port_in_use_system(self, port: int) -> bool:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        os.makedirs(storage_path, exist_ok=True)
+        if size:
+            image = disks.image_path(storage_path)
+            try:
+                if os.listdir(storage_path):
+                    raise ValueError(f"{storage_path} is not empty")
+                with TRACE.span("create disk image", "fs", image=image, size=size):
+                    disks.create(image, size)
+                    disks.mount(image, storage_path)
+            except (OSError, ValueError) as e:
+                if not disks.is_mounted(storage_path):
+                    if os.path.exists(image):
+                        os.unlink(image)
+                    if not os.listdir(storage_path):
+                        os.rmdir(storage_path)
+                self.store.delete(name)
+                log(f"Cannot create a {self._format_bytes(size)} disk for '{name}': {e}")
+                return
+            log(f"Storage '{name}' created at {storage_path} ({self._format_bytes(size)} disk, {image})")
+            return
+        log(f"Storage '{name}' created at {storage_path}")
+
+    # ==== BOUNDED DISKS ====
+    def _ensure_disk(self, storage, log=print) -> bool:
+        # Bounded storages must be mounted before anything touches their
+        # directory; after a reboot nothing is.
+        if not storage.get("disk") or disks.is_mounted(storage["path"]):
+            return True
         try:
-            s.bind(("0.0.0.0", port))
-            s.close()
+            with TRACE.span("mount disk image", "fs", path=storage["path"]):
+                disks.mount(disks.image_path(storage["path"]), storage["path"])
+        except OSError as e:
+            log(f"Cannot mount the disk image of {storage['path']}: {e}")
             return False
+        return True
+
+    def _disk_usage(self, storage):
+        # -> disks.usage() of a mounted bounded storage, else None
+        if not storage.get("disk") or not disks.is_mounted(storage.get("path", "")):
+            return None
+        try:
+            return disks.usage(storage["path"])
         except OSError:
-            return True
+            return None
 
-    def is_port_in_use_docker(self, port: int) -> bool:
-        result = subprocess.run(
-            ['docker', 'ps', '--format', '{{.Ports}}'],
-            capture_output=True, text=True
-        )
-        if result.returncode != 0:
-            return False
-        for line in result.stdout.splitlines():
-            if f":{port}->" in line:
+    def resize(self, name, size):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        if not storage.get("disk"):
+            print(f"Storage '{name}' has no size limit; export it and import it into "
+                  f"a storage made with 'create --size' to bound it")
+            return False
+        if not self._ensure_disk(storage):
+            return False
+        path = storage["path"]
+        image = disks.image_path(path)
+        old = storage["disk"]["size"]
+        grow = size >= old
+        running = storage.get("status") in ("running", "paused")
+        if not grow:
+            if running:
+                print(f"Stop '{name}' before shrinking it (growing works while it runs)")
+                return False
+            used = (self._disk_usage(storage) or {}).get("used", 0)
+            if used >= size:
+                print(f"'{name}' uses {self._format_bytes(used)}, more than {self._format_bytes(size)}")
+                return False
+        t0 = time.monotonic()
+        try:
+            with TRACE.span("resize disk image", "fs", image=image, size=size):
+                if grow and running:
+                    disks.resize(image, path, size)
+                else:
+                    # offline, which needs nothing beyond e2fsck and resize2fs
+                    if disks.is_mounted(path):
+                        disks.umount(path)
+                    try:
+                        disks.resize(image, path, size)
+                    finally:
+                        disks.mount(image, path)
+        except (OSError, ValueError) as e:
+            print(f"Resize failed: {e}")
+            return False
+        self.store.update(name, disk={**storage["disk"], "size": size})
+        print(f"Storage '{name}' resized from {self._format_bytes(old)} to {self._format_bytes(size)} "
+              f"in {time.monotonic() - t0:.2f}s")
+        return True
+
+    def is_port_in_use_system(self, port: int) -> bool:
+        with TRACE.span("bind probe", "socket", port=port):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                s.bind(("0.0.0.0", port))
+                s.close()
+                return False
+            except OSError:
                 return True
-        return False
 
-    def is_port_available(self, port: int) -> bool:
-        return (not self.is_port_in_use_system(port)) and (not self.is_port_in_use_docker(port))
+    def _host_listening_ports(self):
+        ports = set()
+        found = False
+        for path in ('/proc/net/tcp', '/proc/net/tcp6'):
+            try:
+                with open(path) as f:
+                    next(f, None)
+                    for line in f:
+                        parts = line.split()
+                        # st 0A == TCP_LISTEN
+                        if len(parts) > 3 and parts[3] == '0A':
+                            ports.add(int(parts[1].rsplit(':', 1)[1], 16))
+                found = True
+            except (OSError, ValueError):
+                pass
+        return ports if found else set()
+
+    def _docker_published_ports(self):
+        try:
+            return self.docker.published_ports()
+        except DockerError:
+            return set()
+
+    def _state_ports(self, exclude=None):
+        ports = self.store.reserved_ports(exclude)
+        ports.update(m["port"] for m in self.store.get_meta("pool_members", {}).values())
+        for name, storage in self.store.all().items():
+            if name != exclude and storage.get("port"):
+                ports.add(int(storage["port"]))
+        return ports
+
+    def state_trusted(self) -> bool:
+        # a `reconcile --follow` heartbeat is recent: ports in state match docker
+        hb = self.store.get_meta("reconciler")
+        return bool(hb) and time.time() - hb["heartbeat"] < 3 * RECONCILE_HEARTBEAT
+
+    def port_allocator(self, exclude=None) -> PortAllocator:
+        with TRACE.span("port snapshot: /proc/net/tcp", "fs"):
+            taken = self._host_listening_ports()
+        if not self.state_trusted():
+            with TRACE.span("port snapshot: docker"):
+                taken |= self._docker_published_ports()
+        with TRACE.span("port snapshot: state"):
+            taken |= self._state_ports(exclude)
+        return PortAllocator(taken)
 
-    def find_next_free_port(self, start: int = 2000, end: int = 65535) -> int:
-        for p in range(start, end + 1):
-            if self.is_port_available(p):
-                return p
-        return -1
+    def is_port_in_use_docker(self, port: int) -> bool:
+        return port in self._docker_published_ports()
+
+    def is_port_available(self, port: int, allocator=None) -> bool:
+        if allocator is None:
+            allocator = self.port_allocator()
+        # the snapshot only sees listening sockets; one bind catches the rest
+        return allocator.is_free(port) and not self.is_port_in_use_system(port)
 
-    def prompt_port_with_fallback(self, requested: int) -> int:
-        if self.is_port_available(requested):
+    def find_next_free_port(self, start: int = 2000, end: int = 65535, allocator=None) -> int:
+        if allocator is None:
+            allocator = self.port_allocator()
+        while True:
+            p = allocator.next_free(start, end)
+            if p == -1 or not self.is_port_in_use_system(p):
+                return p
+            allocator.claim(p)
+            start = p + 1
+
+    def reserve_port(self, name, port: int, allocator: PortAllocator, log=print) -> int:
+        with self.store.transaction():
+            taken = self._state_ports(exclude=name)
+            for p in taken:
+                allocator.claim(p)
+            if port in taken:
+                nxt = self.find_next_free_port(port + 1, allocator=allocator)
+                if nxt == -1:
+                    return -1
+                log(f"Port {port} was just claimed by another start. Using {nxt} instead.")
+                port = nxt
+            self.store.reserve_port(port, name)
+        return port
+
+    def release_port(self, port: int):
+        self.store.release_port(port)
+
+    def prompt_port_with_fallback(self, requested: int, allocator=None) -> int:
+        if allocator is None:
+            allocator = self.port_allocator()
+        if self.is_port_available(requested, allocator):
             return requested
 
-        nxt = self.find_next_free_port(requested + 1)
+        nxt = self.find_next_free_port(requested + 1, allocator=allocator)
         if nxt == -1:
             print("No free ports found.")
             return -1
@@ -109,7 +985,7 @@ class StorageManager:
             elif ans in ("n", "no"):
                 custom = input("Enter a port number (1024-65535), or 'auto' to pick the next free: ").strip().lower()
                 if custom == "auto":
-                    auto = self.find_next_free_port(2000)
+                    auto = self.find_next_free_port(2000, allocator=allocator)
                     if auto == -1:
                         print("No free ports available.")
                         return -1
@@ -119,7 +995,7 @@ class StorageManager:
                     try:
                         cp = int(custom)
                         if 1024 <= cp <= 65535:
-                            if self.is_port_available(cp):
+                            if self.is_port_available(cp, allocator):
                                 return cp
                             else:
                                 print(f"Port {cp} is in use. Try again.")
@@ -149,8 +1025,12 @@ mkdir -p /storage/upper /storage/work
 mountpoint -q /overlay/lower || mount --bind / /overlay/lower
 mount -o remount,ro /overlay/lower || true
 
-# Mount overlay
-mount -t overlay overlay -o lowerdir=/overlay/lower,upperdir=/storage/upper,workdir=/storage/work /overlay/merged
+# Mount overlay (a cloned storage has its own read-only lower/ layer over the image)
+LOWER=/overlay/lower
+if [ -d /storage/lower ]; then
+  LOWER="/storage/lower:/overlay/lower"
+fi
+mount -t overlay overlay -o lowerdir=$LOWER,upperdir=/storage/upper,workdir=/storage/work /overlay/merged
 
 # Bind critical virtual filesystems (rbind to preserve nested mounts like devpts)
 for m in proc sys dev; do
@@ -171,8 +1051,9 @@ fi
 
 # Fresh tmpfs for /run and /tmp inside the chroot (writable)
 mkdir -p /overlay/merged/run /overlay/merged/tmp
-mount -t tmpfs -o mode=755 tmpfs /overlay/merged/run
-mount -t tmpfs -o mode=1777 tmpfs /overlay/merged/tmp
+# sized from the storage's resource profile (RUN_SIZE/TMP_SIZE), else tmpfs defaults
+mount -t tmpfs -o "mode=755${RUN_SIZE:+,size=$RUN_SIZE}" tmpfs /overlay/merged/run
+mount -t tmpfs -o "mode=1777${TMP_SIZE:+,size=$TMP_SIZE}" tmpfs /overlay/merged/tmp
 mkdir -p /overlay/merged/tmp/.X11-unix
 chmod 1777 /overlay/merged/tmp /overlay/merged/tmp/.X11-unix
 
@@ -190,119 +1071,702 @@ else
 fi
 """
         init_path = f"{storage_path}/init.sh"
-        # ensure storage directory exists (fix FileNotFoundError)
-        os.makedirs(storage_path, exist_ok=True)
-        with open(init_path, 'w') as f:
-            f.write(init_script)
-        os.chmod(init_path, 0o755)
+        with TRACE.span("write init.sh", "fs", path=init_path):
+            # ensure storage directory exists (fix FileNotFoundError)
+            os.makedirs(storage_path, exist_ok=True)
+            with open(init_path, 'w') as f:
+                f.write(init_script)
+            os.chmod(init_path, 0o755)
 
-    def start(self, name, port_or_mode="2000"):
+    def start(self, name, port_or_mode=None, interactive=True, log=print, wait: float = 0,
+              image_checked=False) -> bool:
         container_name = f'{CONTAINER_PREFIX}{name}'
-        subprocess.run(['docker', 'stop', container_name],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['docker', 'rm', container_name],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        self.ensure_image()
-
-        if name not in self.state["storages"]:
-            print(f"Storage '{name}' does not exist, creating it.")
-            self.create(name)
+        if (self.store.get(name) or {}).get("status") == "paused":
+            return self.resume(name, log)
+
+        storage = self.store.get(name)
+        if storage is None:
+            log(f"Storage '{name}' does not exist, creating it.")
+            self.create(name, log=log)
+            storage = self.store.get(name)
+
+        variant = self._image_variant(storage)
+        image = IMAGE_VARIANTS[variant]["image"]
+        if not IMAGE_VARIANTS[variant]["vnc"] and port_or_mode != "terminal":
+            if not (interactive and port_or_mode is None):
+                log(f"Storage '{name}' uses the {variant} image, which has no desktop; "
+                    f"start it with: python main.py start {name} terminal")
+                return False
+            port_or_mode = "terminal"
+        # a hash of the build context and a meta read; bulk runs do it once
+        # per variant up front and pass image_checked
+        if not image_checked and not self.ensure_image(variant, log=log):
+            return False
 
-        storage = self.state["storages"][name]
         storage_path = storage["path"]
+        if not self._ensure_disk(storage, log):
+            return False
 
         # Ensure storage path exists
         if not os.path.isdir(storage_path):
-            print(f"Storage path missing, recreating: {storage_path}")
+            log(f"Storage path missing, recreating: {storage_path}")
             os.makedirs(storage_path, exist_ok=True)
 
         self.write_init_script(storage_path)
 
+        # admitted first: a refused start leaves a running desktop alone
+        with TRACE.span("start: admission"):
+            if not self.admit(name, wait, log):
+                return False
+        with TRACE.span("start: remove old container"):
+            try:
+                self.docker.stop_container(container_name)
+                self.docker.remove_container(container_name)
+            except DockerError:
+                pass
+        limits, limit_env = self._resource_spec(storage)
+        limit_env.update(self._display_env(storage))
+
         # Terminal mode
         if port_or_mode == "terminal":
+            if not interactive:
+                log("Terminal mode needs an interactive start")
+                return False
             print(f"Starting '{name}' in terminal mode with persistent overlay...")
 
-            cmd = [
-                'docker', 'run', '--rm', '-it', '--privileged',
-                '-v', f'{storage_path}:/storage',
-                '--name', container_name,
-                '--hostname', container_name,
-                '--entrypoint', '/storage/init.sh',
-                '-e', 'VNC_SECURITY_TYPES=None',
-                IMAGE_NAME, 'terminal'
-            ]
-            subprocess.run(cmd)
-            return
+            self.docker.run_interactive({
+                "name": container_name,
+                "image": image,
+                "privileged": True,
+                "binds": [f'{storage_path}:/storage'],
+                "entrypoint": '/storage/init.sh',
+                "env": {"VNC_SECURITY_TYPES": "None", **limit_env},
+                "cmd": ['terminal'],
+                **limits,
+            })
+            return True
+
+        # Gateway mode: no published port, reachable through `gateway serve`
+        if port_or_mode == "gateway":
+            log(f"Starting '{name}' behind the gateway (no published port)...")
+            try:
+                with TRACE.span("start: docker run"):
+                    container_id = self._run_image({
+                        "name": container_name,
+                        "image": image,
+                        "privileged": True,
+                        "binds": [f'{storage_path}:/storage'],
+                        "entrypoint": '/storage/init.sh',
+                        "env": {"VNC_SECURITY_TYPES": "None", "PORT": "5901", **limit_env},
+                        **limits,
+                    }, variant, log)
+            except DockerError as e:
+                log(f"Error starting container: {e}")
+                return False
+            token = self.gateway_token(name)
+            self.store.update(name, container_id=container_id, status="running", port=None, gateway=True)
+            log(f"Storage '{name}' started successfully")
+            log(f"Container ID: {container_id[:12]}")
+            log(f"VNC: python main.py connect {name}  (gateway token {token})")
+            return True
 
-        # VNC mode: choose host port
+        # VNC mode: choose host port ('auto' = first free from DEFAULT_PORT)
         try:
-            requested_port = int(port_or_mode)
+            requested_port = DEFAULT_PORT if port_or_mode in (None, "auto") else int(port_or_mode)
         except ValueError:
-            print(f"Invalid port: {port_or_mode}")
-            return
+            log(f"Invalid port: {port_or_mode}")
+            return False
 
-        chosen_port = self.prompt_port_with_fallback(requested_port)
+        with TRACE.span("start: warm pool claim"):
+            # pool members run the default image
+            claimed = variant == DEFAULT_VARIANT and self.claim_pool_member(
+                name, storage_path, port_or_mode, log, storage.get("resources"), limit_env,
+                bool(storage.get("disk")))
+        if claimed:
+            container_id, chosen_port = claimed
+            log(f"Storage '{name}' started successfully (warm pool)")
+            log(f"Container ID: {container_id[:12]}")
+            log(f"VNC: localhost:{chosen_port}")
+            return True
+
+        with TRACE.span("start: choose port"):
+            allocator = self.port_allocator(exclude=name)
+            if interactive and port_or_mode != "auto":
+                chosen_port = self.prompt_port_with_fallback(requested_port, allocator)
+            elif self.is_port_available(requested_port, allocator):
+                chosen_port = requested_port
+            else:
+                chosen_port = self.find_next_free_port(requested_port + 1, allocator=allocator)
+            if chosen_port != -1:
+                chosen_port = self.reserve_port(name, chosen_port, allocator, log)
         if chosen_port == -1:
-            print("Unable to choose a port. Aborting.")
-            return
+            log("Unable to choose a port. Aborting.")
+            return False
 
-        print(f"Starting '{name}' on host port {chosen_port} (container port 5901) with persistent overlay...")
+        log(f"Starting '{name}' on host port {chosen_port} (container port 5901) with persistent overlay...")
 
-        env = ['-e', 'VNC_SECURITY_TYPES=None', '-e', 'PORT=5901']
-        publish = f'0.0.0.0:{chosen_port}:5901'
+        try:
+            with TRACE.span("start: docker run"):
+                container_id = self._run_image({
+                    "name": container_name,
+                    "image": image,
+                    "privileged": True,
+                    "ports": {chosen_port: 5901},
+                    "binds": [f'{storage_path}:/storage'],
+                    "entrypoint": '/storage/init.sh',
+                    "env": {"VNC_SECURITY_TYPES": "None", "PORT": "5901", **limit_env},
+                    **limits,
+                }, variant, log)
+        except DockerError as e:
+            self.release_port(chosen_port)
+            log(f"Error starting container: {e}")
+            return False
 
-        cmd = [
-            'docker', 'run', '-d', '--privileged',
-            '-p', publish,
-            '-v', f'{storage_path}:/storage',
-            '--name', container_name,
-            '--hostname', container_name,
-            '--entrypoint', '/storage/init.sh',
-        ] + env + [
-            IMAGE_NAME
-        ]
+        with self.store.transaction():
+            self.store.release_port(chosen_port)
+            self.store.update(name, container_id=container_id, status="running", port=chosen_port, gateway=False)
+
+        log(f"Storage '{name}' started successfully")
+        log(f"Container ID: {container_id[:12]}")
+        log(f"VNC: localhost:{chosen_port}")
+        if interactive:
+            print(f"Viewer: {self._viewer_hint(storage, f'localhost:{chosen_port}')}")
+            print("")
+            print(f"All changes persist in: {storage_path}/upper (overlay)")
+            print(f"Use 'python main.py stop {name}' to stop")
+        return True
+
+    def stop(self, name, log=print) -> bool:
+        storage = self.store.get(name)
+        if storage is None:
+            log(f"Storage '{name}' does not exist")
+            return False
 
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"Error starting container: {result.stderr.strip()}")
-            return
+        container_id = storage.get("container_id")
+        if storage.get("status") == "suspended":
+            self.store.update(name, status="stopped", port=None, idle_since=None, reclaimed=None)
+            log(f"Storage '{name}' stopped")
+            return True
+        if not container_id:
+            log(f"Storage '{name}' is not running")
+            return False
 
-        container_id = result.stdout.strip()
-        storage["container_id"] = container_id
-        storage["status"] = "running"
-        storage["port"] = chosen_port
-        self.save_state()
-
-        print(f"Storage '{name}' started successfully")
-        print(f"Container ID: {container_id[:12]}")
-        print(f"VNC: localhost:{chosen_port}")
-        print("")
-        print(f"All changes persist in: {storage_path}/upper (overlay)")
-        print(f"Use 'python main.py stop {name}' to stop")
-
-    def stop(self, name):
-        if name not in self.state["storages"]:
+        container_name = f'{CONTAINER_PREFIX}{name}'
+        if storage.get("status") == "paused":
+            try:
+                self.docker.unpause_container(container_name)
+            except DockerError:
+                pass
+        log(f"Stopping '{name}'...")
+        try:
+            with TRACE.span("stop: sync"):
+                self.docker.exec(container_name, ['sync'])
+            with TRACE.span("stop: remove container"):
+                self.docker.remove_container(container_name, force=True)
+        except DockerError as e:
+            log(f"Warning: {e}")
+
+        self.store.update(name, container_id=None, status="stopped", port=None, admitted_at=None,
+                          idle_since=None, reclaimed=None)
+        log(f"Storage '{name}' stopped")
+        return True
+
+    def resume(self, name, log=print) -> bool:
+        try:
+            self.docker.unpause_container(f'{CONTAINER_PREFIX}{name}')
+        except DockerError as e:
+            log(f"Error resuming '{name}': {e}")
+            return False
+        self.store.update(name, status="running", last_active=time.time(), idle_since=None, reclaimed=None)
+        log(f"Storage '{name}' resumed")
+        return True
+
+    def restart(self, name, log=print, image_checked=False) -> bool:
+        storage = self.store.get(name)
+        if storage is None:
+            log(f"Storage '{name}' does not exist")
+            return False
+        port = storage.get("port") or ("gateway" if storage.get("gateway") else "auto")
+        if storage.get("container_id"):
+            self.stop(name, log=log)
+        return self.start(name, str(port), interactive=False, log=log, image_checked=image_checked)
+
+    # ==== WARM POOL ====
+    # Pool members are privileged containers already running from IMAGE_NAME
+    # with the storages directory mounted and a published port. Claiming one
+    # renames it to vnc-<storage>, bind-mounts the storage on /storage and
+    # execs its init.sh, which skips the image check and the cold `docker run`.
+    def _pool_config(self):
+        return self.store.get_meta("pool", {"size": 0})
+
+    def _count_pool(self, key):
+        with self.store.transaction():
+            stats = self.store.get_meta("pool_stats", {"hits": 0, "misses": 0})
+            stats[key] = stats.get(key, 0) + 1
+            self.store.set_meta("pool_stats", stats)
+
+    def claim_pool_member(self, name, storage_path, port_or_mode, log=print, resources=None, env=None,
+                          bounded=False):
+        if not self._pool_config().get("size"):
+            return None
+        resources = resources or {}
+        storages_dir = os.path.abspath(STORAGES_DIR)
+        # Members run with the default shm size and no CPU/memory limits. They
+        # also bound storages/ before any disk image was mounted under it, and
+        # with private propagation never see that mount: a bounded storage
+        # would get the empty directory underneath.
+        if os.path.dirname(os.path.abspath(storage_path)) != storages_dir or bounded or \
+                any(resources.get(k) for k in ("cpus", "memory", "shm_size")):
+            self._count_pool("misses")
+            return None
+
+        with self.store.transaction():
+            members = self.store.get_meta("pool_members", {})
+            pick = None
+            for member, info in sorted(members.items(), key=lambda m: m[1]["created"]):
+                if port_or_mode in (None, "auto") or str(info["port"]) == str(port_or_mode):
+                    pick = member
+                    break
+            if pick is None:
+                info = None
+            else:
+                info = members.pop(pick)
+                self.store.set_meta("pool_members", members)
+        if info is None:
+            self._count_pool("misses")
+            return None
+
+        container_name = f'{CONTAINER_PREFIX}{name}'
+        rel = os.path.basename(os.path.abspath(storage_path))
+        try:
+            self.docker.rename_container(pick, container_name)
+            rc = self.docker.exec(container_name, [
+                '/bin/sh', '-c',
+                f'mkdir -p /storage && mount --bind "/storages/{rel}" /storage && exec /storage/init.sh'
+            ], env={"VNC_SECURITY_TYPES": "None", "PORT": "5901", **(env or {})}, detach=True)
+            if rc != 0:
+                raise DockerError(f"exec init.sh failed ({rc})")
+        except DockerError as e:
+            log(f"Warm pool claim failed ({e}), falling back to a cold start")
+            for n in (pick, container_name):
+                try:
+                    self.docker.remove_container(n, force=True)
+                except DockerError:
+                    pass
+            self._count_pool("misses")
+            return None
+
+        self.store.update(name, container_id=info["id"], status="running", port=info["port"], gateway=False)
+        self._count_pool("hits")
+        self._spawn_pool_fill()
+        return info["id"], info["port"]
+
+    def _spawn_pool_fill(self):
+        # refill in a detached process so `start` returns immediately
+        argv = [sys.executable, os.path.abspath(__file__), "pool", "fill"]
+        with TRACE.span("spawn pool fill", "subprocess", argv=argv):
+            subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def pool_fill(self, log=print):
+        with open(os.path.abspath(STORAGES_DIR + ".pool.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._pool_prune()
+            size = self._pool_config().get("size", 0)
+            members = self.store.get_meta("pool_members", {})
+            for name in sorted(members, key=lambda m: members[m]["created"])[size:]:
+                self._pool_remove(name)
+            missing = size - len(self.store.get_meta("pool_members", {}))
+            if missing <= 0:
+                return
+            if not self.ensure_image(log=log):
+                return
+            os.makedirs(STORAGES_DIR, exist_ok=True)
+            for _ in range(missing):
+                allocator = self.port_allocator()
+                port = self.find_next_free_port(DEFAULT_PORT, allocator=allocator)
+                if port == -1:
+                    log("No free ports for pool members")
+                    return
+                member = f"{POOL_PREFIX}{os.urandom(4).hex()}"
+                port = self.reserve_port(member, port, allocator, log)
+                try:
+                    cid = self.docker.run_container({
+                        "name": member,
+                        "image": IMAGE_NAME,
+                        "privileged": True,
+                        "ports": {port: 5901},
+                        "binds": [f'{os.path.abspath(STORAGES_DIR)}:/storages'],
+                        "shm_size": DEFAULT_SHM_SIZE,
+                        "entrypoint": '/bin/sh',
+                        "cmd": ['-c', f'find {POOL_WARM_PATHS} -type f -exec cat {{}} + >/dev/null 2>&1; '
+                                      'exec sleep infinity'],
+                    })
+                except DockerError as e:
+                    self.release_port(port)
+                    log(f"Error creating pool member: {e}")
+                    return
+                with self.store.transaction():
+                    members = self.store.get_meta("pool_members", {})
+                    members[member] = {"id": cid, "port": port, "created": time.time()}
+                    self.store.set_meta("pool_members", members)
+                    self.store.release_port(port)
+                log(f"Pool member {member} ready on port {port}")
+
+    def _pool_remove(self, member):
+        try:
+            self.docker.remove_container(member, force=True)
+        except DockerError:
+            pass
+        with self.store.transaction():
+            members = self.store.get_meta("pool_members", {})
+            members.pop(member, None)
+            self.store.set_meta("pool_members", members)
+
+    def _pool_prune(self):
+        # forget members whose container disappeared behind our back
+        try:
+            alive = {c["name"] for c in self.docker.containers(POOL_PREFIX) if c["state"] == "running"}
+        except DockerError:
+            return
+        for member in list(self.store.get_meta("pool_members", {})):
+            if member not in alive:
+                self._pool_remove(member)
+
+    def pool_resize(self, size: int):
+        self.store.set_meta("pool", {"size": max(size, 0)})
+        self.pool_fill()
+        self.pool_status()
+
+    def pool_status(self):
+        self._pool_prune()
+        size = self._pool_config().get("size", 0)
+        members = self.store.get_meta("pool_members", {})
+        stats = self.store.get_meta("pool_stats", {"hits": 0, "misses": 0})
+        claims = stats.get("hits", 0) + stats.get("misses", 0)
+        rate = f"{100.0 * stats.get('hits', 0) / claims:.1f}%" if claims else "-"
+        print(f"Warm pool   : {len(members)}/{size} ready")
+        print(f"Claims      : {stats.get('hits', 0)} hits, {stats.get('misses', 0)} misses (hit rate {rate})")
+        for member, info in sorted(members.items(), key=lambda m: m[1]["created"]):
+            age = int(time.time() - info["created"])
+            print(f"  {member:<20} port {info['port']:<6} up {age}s")
+
+    # ==== BULK ====
+    def select_storages(self, patterns=(), all=False, status=None, labels=()):
+        storages = self.store.all()
+        selected = []
+        for name, storage in storages.items():
+            if patterns and not any(fnmatch.fnmatchcase(name, p) for p in patterns):
+                continue
+            if not patterns and not all and not status and not labels:
+                continue
+            if status and storage.get("status") != status:
+                continue
+            have = storage.get("labels", {})
+            if any(have.get(k) != v for k, v in labels):
+                continue
+            selected.append(name)
+        # plain names that don't exist yet are kept so `start` can create them
+        for p in patterns:
+            if not any(ch in p for ch in "*?[") and p not in storages:
+                selected.append(p)
+        return selected
+
+    def bulk(self, action, names, jobs: int = BULK_JOBS):
+        if not names:
+            print("No storages selected")
+            return True
+        storages = self.store.all()
+        # `start` on a running desktop replaces its container; in bulk that
+        # is never what was meant, so those are left alone
+        already = set()
+        if action == "start":
+            already = {n for n in names if (storages.get(n) or {}).get("status") in ("running", "paused")}
+        if action in ("start", "restart"):
+            for variant in sorted({self._image_variant(storages.get(n)) for n in names if n not in already}):
+                if not self.ensure_image(variant):
+                    return False
+        self.docker  # resolve the backend once, before the worker threads
+
+        def run(name):
+            messages = []
+            t0 = time.monotonic()
+            if name in already:
+                status = storages[name]["status"]
+                return True, 0.0, ["already running" + (" (paused)" if status == "paused" else "")]
+            try:
+                if action == "start":
+                    ok = self.start(name, "auto", interactive=False, log=messages.append, image_checked=True)
+                elif action == "stop":
+                    ok = self.stop(name, log=messages.append)
+                else:
+                    ok = self.restart(name, log=messages.append, image_checked=True)
+            except Exception as e:
+                ok = False
+                messages.append(f"{type(e).__name__}: {e}")
+            return ok, time.monotonic() - t0, messages
+
+        verb = {"start": "Starting", "stop": "Stopping", "restart": "Restarting"}[action]
+        print(f"{verb} {len(names)} storage(s), {jobs} at a time...")
+        t0 = time.monotonic()
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {pool.submit(run, n): n for n in names}
+            for fut in as_completed(futures):
+                name = futures[fut]
+                ok, secs, messages = results[name] = fut.result()
+                print(f"  {'ok' if ok else 'FAILED':<7} {name:<24} {secs:6.2f}s  {messages[-1] if messages else ''}")
+                sys.stdout.flush()
+        wall = time.monotonic() - t0
+
+        failed = [n for n, r in results.items() if not r[0]]
+        slowest = max(r[1] for r in results.values())
+        print("-" * 80)
+        skipped = f", {len(already)} already running" if already else ""
+        print(f"{len(names) - len(failed) - len(already)} ok, {len(failed)} failed{skipped} in {wall:.2f}s "
+              f"(slowest {slowest:.2f}s)")
+        for n in failed:
+            for line in results[n][2]:
+                print(f"  {n}: {line}")
+        return not failed
+
+    def set_labels(self, name, assignments):
+        storage = self.store.get(name)
+        if storage is None:
             print(f"Storage '{name}' does not exist")
             return
+        labels = dict(storage.get("labels", {}))
+        for a in assignments:
+            if a.endswith('-') and '=' not in a:
+                labels.pop(a[:-1], None)
+            elif '=' in a:
+                k, v = a.split('=', 1)
+                labels[k] = v
+            else:
+                print(f"Invalid label '{a}'. Use key=value or key- to remove")
+                return
+        self.store.update(name, labels=labels)
+        shown = ", ".join(f"{k}={v}" for k, v in sorted(labels.items())) or "(none)"
+        print(f"Labels for '{name}': {shown}")
+
+    # ==== GATEWAY ====
+    def gateway_token(self, name, rotate=False):
+        with self.store.transaction():
+            storage = self.store.get(name)
+            if storage is None:
+                return None
+            token = storage.get("gateway_token")
+            if rotate or not token:
+                token = os.urandom(16).hex()
+                self.store.update(name, gateway_token=token)
+        return token
+
+    # ==== DISPLAY ====
+    def _display_settings(self, storage):
+        profile = storage.get("display") or {}
+        settings = dict(DISPLAY_PRESETS[profile.get("preset", DEFAULT_DISPLAY_PRESET)])
+        settings.update({k: v for k, v in profile.items() if k in DISPLAY_KEYS})
+        return settings
+
+    def _display_env(self, storage):
+        d = self._display_settings(storage)
+        return {
+            "VNC_GEOMETRY": d["geometry"],
+            "VNC_DEPTH": str(d["depth"]),
+            "VNC_FRAMERATE": str(d["fps"]),
+            # server-side zlib level for ZRLE/Zlib; Tight takes the client's level
+            "VNC_ZLIB_LEVEL": str(d["compress"]),
+        }
 
-        storage = self.state["storages"][name]
-        container_id = storage.get("container_id")
-        if not container_id:
-            print(f"Storage '{name}' is not running")
-            return
+    def _viewer_hint(self, storage, target) -> str:
+        d = self._display_settings(storage)
+        return (f"vncviewer -AutoSelect=0 -PreferredEncoding={d['encodings']} -CompressLevel={d['compress']} "
+                f"-QualityLevel={d['quality']} -FullColor={1 if d['depth'] >= 24 else 0} {target}")
+
+    def _format_display(self, storage) -> str:
+        d = self._display_settings(storage)
+        preset = (storage.get("display") or {}).get("preset", DEFAULT_DISPLAY_PRESET)
+        return (f"{preset}: {d['geometry']}x{d['depth']} @{d['fps']}fps, {d['encodings']} "
+                f"compress {d['compress']} quality {d['quality']}")
+
+    def _parse_display_value(self, key, value):
+        if key == "geometry":
+            if not re.match(r'^\d{3,5}x\d{3,5}$', value):
+                raise ValueError("geometry is WIDTHxHEIGHT")
+            return value
+        if key == "encodings":
+            match = [e for e in VNC_ENCODINGS if e.lower() == value.lower()]
+            if not match:
+                raise ValueError(f"encodings is one of {', '.join(VNC_ENCODINGS)}")
+            return match[0]
+        valid, text = {
+            "depth": ((16, 24, 32), "16, 24 or 32"),
+            "fps": (range(1, 121), "1-120"),
+            "compress": (range(10), "0-9"),
+            "quality": (range(10), "0-9"),
+        }[key]
+        if not value.isdigit() or int(value) not in valid:
+            raise ValueError(f"{key} must be {text}")
+        return int(value)
+
+    def set_display(self, name, args):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        profile = dict(storage.get("display") or {})
+        i = 0
+        while i < len(args):
+            key = args[i][2:] if args[i].startswith("--") else None
+            if key not in DISPLAY_KEYS + ("preset",) or i + 1 >= len(args):
+                print(f"Unknown or incomplete option '{args[i]}'")
+                return False
+            value = args[i + 1]
+            try:
+                if key == "preset":
+                    if value not in DISPLAY_PRESETS:
+                        raise ValueError(f"preset is one of {', '.join(DISPLAY_PRESETS)}")
+                    # a preset replaces earlier individual settings
+                    profile = {"preset": value}
+                elif value == "default":
+                    profile.pop(key, None)
+                else:
+                    profile[key] = self._parse_display_value(key, value)
+            except ValueError as e:
+                print(f"Invalid --{key}: {e}")
+                return False
+            i += 2
+        if not args:
+            print(f"{name}: {self._format_display(storage)}")
+            return True
 
-        container_name = f'{CONTAINER_PREFIX}{name}'
-        print(f"Stopping '{name}'...")
-        subprocess.run(['docker', 'exec', container_name, 'sync'],
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        subprocess.run(['docker', 'rm', '-f', container_name], capture_output=True)
+        old = self._display_settings(storage)
+        self.store.update(name, display=profile)
+        storage["display"] = profile
+        print(f"{name}: {self._format_display(storage)}")
+        if storage.get("status") == "running":
+            self._apply_display_live(name, old, self._display_settings(storage))
+        return True
+
+    def _apply_display_live(self, name, old, new):
+        # Xvnc parameters can be changed at runtime with vncconfig, and the
+        # framebuffer resized through RandR; only the depth needs a restart.
+        cmds = []
+        if new["fps"] != old["fps"]:
+            cmds.append(f"vncconfig -display :1 -set FrameRate={new['fps']}")
+        if new["compress"] != old["compress"]:
+            cmds.append(f"vncconfig -display :1 -set ZlibLevel={new['compress']}")
+        if new["geometry"] != old["geometry"]:
+            cmds.append(f"xrandr -display :1 --fb {new['geometry']}")
+        if cmds:
+            try:
+                rc = self.docker.exec(f"{CONTAINER_PREFIX}{name}", [
+                    'chroot', '/overlay/merged', 'su', '-', 'user', '-c', " && ".join(cmds)
+                ])
+            except DockerError as e:
+                rc = str(e)
+            if rc == 0:
+                print("Applied to the running desktop")
+            else:
+                print(f"Could not apply to the running desktop ({rc}), restart it to use the new profile")
+        if new["depth"] != old["depth"]:
+            print(f"The depth applies from the next start (python main.py restart {name})")
+
+    # ==== RESOURCES ====
+    def _resource_spec(self, storage):
+        # -> (container spec limits, init.sh env) for a storage's profile
+        res = storage.get("resources") or {}
+        limits = {"shm_size": res.get("shm_size") or DEFAULT_SHM_SIZE}
+        if res.get("cpus"):
+            limits["cpus"] = res["cpus"]
+        if res.get("memory"):
+            limits["memory"] = res["memory"]
+        env = {}
+        if res.get("tmp_size"):
+            env["TMP_SIZE"] = str(res["tmp_size"])
+        if res.get("run_size"):
+            env["RUN_SIZE"] = str(res["run_size"])
+        return limits, env
+
+    def _format_resources(self, res) -> str:
+        parts = []
+        if res.get("cpus"):
+            parts.append(f"cpus={res['cpus']:g}")
+        for key in RESOURCE_KEYS[1:]:
+            if res.get(key):
+                parts.append(f"{key.replace('_', '-')}={self._format_bytes(res[key])}")
+        return ", ".join(parts) or "unlimited"
+
+    def set_resources(self, name, args):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        res = dict(storage.get("resources") or {})
+        i = 0
+        while i < len(args):
+            key = args[i][2:].replace('-', '_') if args[i].startswith("--") else None
+            if key not in RESOURCE_KEYS or i + 1 >= len(args):
+                print(f"Unknown or incomplete option '{args[i]}'")
+                return False
+            value = args[i + 1]
+            if value == "none":
+                res.pop(key, None)
+            else:
+                try:
+                    res[key] = float(value) if key == "cpus" else parse_size(value)
+                except ValueError:
+                    print(f"Invalid value for --{key.replace('_', '-')}: {value}")
+                    return False
+            i += 2
+        if args:
+            self.store.update(name, resources=res)
+        print(f"{name}: {self._format_resources(res)}")
+        if args and storage.get("status") == "running":
+            print(f"Applies from the next start (python main.py restart {name})")
+        return True
+
+    def _committed_memory(self, storages, exclude=None):
+        default = parse_size(UNLIMITED_MEMORY)
+        cutoff = time.time() - PORT_RESERVATION_TTL
+        total = 0
+        for n, s in storages.items():
+            if n == exclude:
+                continue
+            # a paused desktop's memory was reclaimed, but resuming takes it
+            # back without asking, so its limit stays committed
+            if s.get("status") in ("running", "paused") or (s.get("admitted_at") or 0) > cutoff:
+                total += (s.get("resources") or {}).get("memory") or default
+        return total
 
-        storage["container_id"] = None
-        storage["status"] = "stopped"
-        storage["port"] = None
-        self.save_state()
-        print(f"Storage '{name}' stopped")
+    def admit(self, name, wait: float = 0, log=print) -> bool:
+        # Admission is recorded on the row (admitted_at) inside the same
+        # transaction as the check, so concurrent starts can't both squeeze in;
+        # like a port reservation it lapses after PORT_RESERVATION_TTL.
+        host_total = cgroup_stats.host_mem_total()
+        if not host_total or MEMORY_COMMIT_RATIO <= 0:
+            return True
+        budget = int(host_total * MEMORY_COMMIT_RATIO)
+        deadline = time.monotonic() + wait
+        announced = False
+        while True:
+            with self.store.transaction():
+                storages = self.store.all()
+                need = (storages.get(name, {}).get("resources") or {}).get("memory") or parse_size(UNLIMITED_MEMORY)
+                committed = self._committed_memory(storages, exclude=name)
+                if committed + need <= budget:
+                    self.store.update(name, admitted_at=time.time())
+                    return True
+            if time.monotonic() >= deadline:
+                log(f"Not starting '{name}': {self._format_bytes(committed)} committed + "
+                    f"{self._format_bytes(need)} would exceed {MEMORY_COMMIT_RATIO:g} of host RAM "
+                    f"({self._format_bytes(budget)}). Use --wait to queue, or lower its --memory")
+                return False
+            if not announced:
+                log(f"Waiting for memory to start '{name}' "
+                    f"({self._format_bytes(committed)} committed, budget {self._format_bytes(budget)})...")
+                announced = True
+            time.sleep(min(2.0, max(deadline - time.monotonic(), 0.1)))
 
     def rename(self, old_new):
         if ':' not in old_new:
@@ -311,39 +1775,473 @@ fi
 
         old_name, new_name = old_new.split(':', 1)
 
-        if old_name not in self.state["storages"]:
+        storage = self.store.get(old_name)
+        if storage is None:
             print(f"Storage '{old_name}' does not exist")
             return
 
-        if new_name in self.state["storages"]:
+        if self.store.get(new_name) is not None:
             print(f"Storage '{new_name}' already exists")
             return
 
-        storage = self.state["storages"][old_name]
 
-        if storage["status"] == "running":
+        if storage["status"] in ("running", "paused"):
             print(f"Stopping '{old_name}' before renaming...")
             self.stop(old_name)
 
         old_path = storage["path"]
         new_path = os.path.abspath(f"storages/{new_name}")
-        if os.path.exists(old_path):
-            shutil.move(old_path, new_path)
-
-        storage["path"] = new_path
-        self.state["storages"][new_name] = storage
-        del self.state["storages"][old_name]
-        self.save_state()
+        with self.store.transaction():
+            if not self.store.rename(old_name, new_name):
+                print(f"Storage '{new_name}' already exists")
+                return
+            # a mount point can't be moved: unmount, move both, mount again
+            bounded = storage.get("disk") and disks.is_mounted(old_path)
+            if bounded:
+                disks.umount(old_path)
+            if os.path.exists(old_path):
+                shutil.move(old_path, new_path)
+            if storage.get("disk"):
+                shutil.move(disks.image_path(old_path), disks.image_path(new_path))
+            if bounded:
+                disks.mount(disks.image_path(new_path), new_path)
+            if os.path.isdir(os.path.join(SNAPSHOTS_DIR, old_name)):
+                shutil.move(os.path.join(SNAPSHOTS_DIR, old_name), os.path.join(SNAPSHOTS_DIR, new_name))
+            self.store.update(new_name, path=new_path)
 
         print(f"Storage renamed from '{old_name}' to '{new_name}'")
 
+    # ==== CLONE / SNAPSHOT ====
+    # Layers are duplicated with reflinks when the filesystem can, else by
+    # hard links: the source's upper/ is first squashed into its lower/ layer
+    # (which needs it stopped), then the copy gets a lower/ of hard links and
+    # an empty upper/. The overlay copies a file up before writing it, so no
+    # storage ever writes to a shared inode. Plain copies are the fallback.
+    def _copy_method(self, requested, running, same_fs=True):
+        # bounded storages are filesystems of their own: nothing links across
+        if not same_fs:
+            if requested in ("link", "reflink"):
+                raise ValueError(f"{requested} copies need both sides on one filesystem (bounded storage)")
+            return "copy"
+        if requested:
+            if requested == "link" and running:
+                raise ValueError("hard-link copies need the source stopped (its upper/ is squashed first)")
+            if requested == "reflink" and not layers.reflink_supported(os.path.abspath(STORAGES_DIR)):
+                raise ValueError("this filesystem does not support reflinks")
+            return requested
+        if layers.reflink_supported(os.path.abspath(STORAGES_DIR)):
+            return "reflink"
+        return "copy" if running else "link"
+
+    @contextmanager
+    def _frozen(self, name, storage):
+        # a running source is paused while its layers are read, for a consistent copy
+        paused = False
+        if storage.get("status") == "running":
+            try:
+                self.docker.pause_container(f"{CONTAINER_PREFIX}{name}")
+                paused = True
+            except DockerError:
+                pass
+        try:
+            yield
+        finally:
+            if paused:
+                try:
+                    self.docker.unpause_container(f"{CONTAINER_PREFIX}{name}")
+                except DockerError:
+                    pass
+
+    def _copy_layers(self, name, storage, dest, method, squash_source=True):
+        # Copies the storage's lower/ and upper/ to dest/, built under a temp
+        # name and renamed into place, so a failed copy leaves nothing behind.
+        # squash_source=False is for sources nobody writes to (snapshots):
+        # both layers are linked and squashed on the copy's side instead.
+        src = storage["path"]
+        tmp = f"{dest}.tmp-{os.getpid()}"
+        os.makedirs(tmp)
+        try:
+            totals = {"files": 0, "bytes": 0}
+            with TRACE.span(f"copy layers ({method})", "fs", src=src, dest=dest):
+                if method == "link" and squash_source:
+                    if os.path.isdir(os.path.join(src, "upper")):
+                        layers.squash(os.path.join(src, "upper"), os.path.join(src, "lower"))
+                        # the upper tree changed wholesale; rebuild its size index
+                        for f in (SIZE_INDEX_FILE, SIZE_INDEX_FILE.replace(".json", ".lower.json")):
+                            try:
+                                os.unlink(os.path.join(src, f))
+                            except OSError:
+                                pass
+                    todo = ["lower"]
+                else:
+                    todo = ["lower", "upper"]
+                with self._frozen(name, storage):
+                    for layer in todo:
+                        if os.path.isdir(os.path.join(src, layer)):
+                            t = layers.copy_tree(os.path.join(src, layer), os.path.join(tmp, layer), method)
+                            totals["files"] += t["files"]
+                            totals["bytes"] += t["bytes"]
+                if method == "link" and os.path.isdir(os.path.join(tmp, "upper")):
+                    layers.squash(os.path.join(tmp, "upper"), os.path.join(tmp, "lower"))
+            os.makedirs(os.path.join(tmp, "upper"), exist_ok=True)
+            os.rename(tmp, dest)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return totals
+
+    def clone(self, src_dst, method=None):
+        if ':' not in src_dst:
+            print("Invalid format. Use: python main.py clone source:new")
+            return False
+        src, dst = src_dst.split(':', 1)
+        storage = self.store.get(src)
+        if storage is None:
+            print(f"Storage '{src}' does not exist")
+            return False
+        dst_path = os.path.abspath(f"{STORAGES_DIR}/{dst}")
+        if self.store.get(dst) is not None or os.path.exists(dst_path):
+            print(f"Storage '{dst}' already exists")
+            return False
+        if not self._ensure_disk(storage):
+            return False
+        try:
+            method = self._copy_method(method, storage.get("status") in ("running", "paused"),
+                                       not storage.get("disk"))
+        except ValueError as e:
+            print(f"Cannot clone '{src}': {e}")
+            return False
+
+        t0 = time.monotonic()
+        try:
+            totals = self._copy_layers(src, storage, dst_path, method)
+        except OSError as e:
+            print(f"Clone failed: {e}")
+            return False
+        data = {"path": dst_path, "container_id": None, "status": "stopped", "port": None, "cloned_from": src}
+        data.update({k: storage[k] for k in CLONED_FIELDS if storage.get(k)})
+        if not self.store.insert(dst, data):
+            shutil.rmtree(dst_path, ignore_errors=True)
+            print(f"Storage '{dst}' already exists")
+            return False
+        print(f"Storage '{dst}' cloned from '{src}' by {method} in {time.monotonic() - t0:.2f}s "
+              f"({totals['files']} files, {self._format_bytes(totals['bytes'])})")
+        if storage.get("disk"):
+            print(f"Note: '{dst}' has no size limit; '{src}' keeps its {self._format_bytes(storage['disk']['size'])} disk")
+        return True
+
+    def _snapshot_dir(self, name, snap=None):
+        base = os.path.abspath(os.path.join(SNAPSHOTS_DIR, name))
+        return os.path.join(base, snap) if snap else base
+
+    def snapshot(self, name, snap, method=None):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        dest = self._snapshot_dir(name, snap)
+        if os.path.exists(dest):
+            print(f"Snapshot '{snap}' of '{name}' already exists")
+            return False
+        if not self._ensure_disk(storage):
+            return False
+        try:
+            method = self._copy_method(method, storage.get("status") in ("running", "paused"),
+                                       not storage.get("disk"))
+        except ValueError as e:
+            print(f"Cannot snapshot '{name}': {e}")
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        t0 = time.monotonic()
+        try:
+            totals = self._copy_layers(name, storage, dest, method)
+        except OSError as e:
+            print(f"Snapshot failed: {e}")
+            return False
+        with open(os.path.join(dest, "snapshot.json"), 'w') as f:
+            json.dump({"storage": name, "created": time.time(), "method": method, **totals}, f)
+        print(f"Snapshot '{snap}' of '{name}' taken by {method} in {time.monotonic() - t0:.2f}s "
+              f"({totals['files']} files, {self._format_bytes(totals['bytes'])})")
+        return True
+
+    def list_snapshots(self, name):
+        base = self._snapshot_dir(name)
+        snaps = sorted(os.listdir(base)) if os.path.isdir(base) else []
+        if not snaps:
+            print(f"No snapshots of '{name}'")
+        for snap in snaps:
+            try:
+                with open(os.path.join(base, snap, "snapshot.json")) as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            created = datetime.fromtimestamp(info["created"]).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{snap:<24} {created}  {info['method']:<8} {info['files']} files, "
+                  f"{self._format_bytes(info['bytes'])}")
+
+    def delete_snapshot(self, name, snap):
+        dest = self._snapshot_dir(name, snap)
+        if not os.path.isfile(os.path.join(dest, "snapshot.json")):
+            print(f"Snapshot '{snap}' of '{name}' does not exist")
+            return False
+        shutil.rmtree(dest)
+        print(f"Snapshot '{snap}' of '{name}' deleted")
+        return True
+
+    def restore(self, name, snap, method=None):
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist")
+            return False
+        source = self._snapshot_dir(name, snap)
+        if not os.path.isfile(os.path.join(source, "snapshot.json")):
+            print(f"Snapshot '{snap}' of '{name}' does not exist")
+            return False
+        if storage.get("status") in ("running", "paused"):
+            print(f"Stop '{name}' before restoring it")
+            return False
+        if storage.get("disk"):
+            # staged and swapped inside the storage's own filesystem
+            if not self._ensure_disk(storage):
+                return False
+            try:
+                method = self._copy_method(method, False, same_fs=False)
+            except ValueError as e:
+                print(f"Cannot restore '{name}': {e}")
+                return False
+        method = method or ("reflink" if layers.reflink_supported(source) else "link")
+        path = storage["path"]
+        staged = os.path.join(path, ".restore") if storage.get("disk") else f"{path}.restore"
+        old = os.path.join(path, f".old-{os.getpid()}") if storage.get("disk") else f"{path}.old-{os.getpid()}"
+        t0 = time.monotonic()
+        try:
+            self._copy_layers(snap, {"path": source}, staged, method, squash_source=False)
+            os.makedirs(old)
+            for layer in ("lower", "upper", "work"):
+                if os.path.exists(os.path.join(path, layer)):
+                    os.rename(os.path.join(path, layer), os.path.join(old, layer))
+            for layer in ("lower", "upper"):
+                if os.path.isdir(os.path.join(staged, layer)):
+                    os.rename(os.path.join(staged, layer), os.path.join(path, layer))
+        except OSError as e:
+            print(f"Restore failed: {e}")
+            # put the layers that were moved aside back; the snapshot's,
+            # if any got in, go back to staged/ and out with it
+            try:
+                for layer in ("lower", "upper", "work"):
+                    if not os.path.exists(os.path.join(old, layer)):
+                        continue
+                    if os.path.exists(os.path.join(path, layer)):
+                        os.rename(os.path.join(path, layer), os.path.join(staged, layer))
+                    os.rename(os.path.join(old, layer), os.path.join(path, layer))
+                if os.path.isdir(old):
+                    os.rmdir(old)
+            except OSError as e2:
+                print(f"Could not put the previous layers back ({e2}); they are in {old}")
+            return False
+        finally:
+            shutil.rmtree(staged, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+        for f in (SIZE_INDEX_FILE, SIZE_INDEX_FILE.replace(".json", ".lower.json")):
+            try:
+                os.unlink(os.path.join(path, f))
+            except OSError:
+                pass
+        print(f"Storage '{name}' restored from snapshot '{snap}' in {time.monotonic() - t0:.2f}s")
+        return True
+
+    # ==== EXPORT / IMPORT ====
+    def export(self, name, dest=None, incremental=False, since=None, compression=None):
+        # dest None or '-' streams to stdout, so everything else goes to stderr
+        to_stdout = dest in (None, "-")
+        out_log = sys.stderr if to_stdout else sys.stdout
+        storage = self.store.get(name)
+        if storage is None:
+            print(f"Storage '{name}' does not exist", file=out_log)
+            return False
+        # Reading a live upper/ gives a torn archive, and pausing the desktop
+        # for the whole stream would freeze its session for as long as that
+        # takes; a paused (idle) desktop is already still.
+        if storage.get("status") == "running":
+            print(f"Stop '{name}' before exporting it", file=out_log)
+            return False
+        if not self._ensure_disk(storage, log=lambda msg: print(msg, file=out_log)):
+            return False
+        sidecar = os.path.join(storage["path"], EXPORT_MANIFEST)
+        previous = since or (sidecar if incremental else None)
+        if previous and not os.path.isfile(previous):
+            print(f"No previous export manifest at {previous}; run a full export first", file=out_log)
+            return False
+        compression = compression or archive.compression_for(None if to_stdout else dest)
+        manifest_tmp = f"{sidecar}.{os.getpid()}.tmp"
+        part = None if to_stdout else f"{dest}.part"
+        t0 = time.monotonic()
+        try:
+            with (open(part, 'wb') if part else nullcontext(sys.stdout.buffer)) as out, \
+                    TRACE.span("export", "fs", storage=name):
+                result = archive.export(storage["path"], out, compression, previous, manifest_tmp, name)
+            if part:
+                os.replace(part, dest)
+            os.replace(manifest_tmp, sidecar)
+        except (OSError, ValueError) as e:
+            for f in (part, manifest_tmp):
+                if f and os.path.exists(f):
+                    os.unlink(f)
+            print(f"Export failed: {e}", file=out_log)
+            return False
+        kind = f"incremental on {result['base'][:12]}" if result["base"] else "full"
+        print(f"Exported '{name}' ({kind}, id {result['id'][:12]}) to {dest if part else 'stdout'} "
+              f"in {time.monotonic() - t0:.2f}s: {result['sent']} of {result['entries']} entries, "
+              f"{self._format_bytes(result['bytes'])} of file data, {result['deleted']} deleted",
+              file=out_log)
+        return True
+
+    def import_storage(self, name, src=None):
+        storage = self.store.get(name)
+        created = storage is None
+        if created:
+            self.create(name, log=lambda msg: None)
+            storage = self.store.get(name)
+        elif storage.get("status") in ("running", "paused"):
+            print(f"Stop '{name}' before importing into it")
+            return False
+        elif not self._ensure_disk(storage):
+            return False
+        elif not storage.get("import_id") and any(
+                os.path.isdir(os.path.join(storage["path"], l)) and os.listdir(os.path.join(storage["path"], l))
+                for l in archive.LAYERS):
+            print(f"Storage '{name}' already has data; import a full export under a new name")
+            return False
+        t0 = time.monotonic()
+        try:
+            with (open(src, 'rb') if src not in (None, "-") else nullcontext(sys.stdin.buffer)) as f, \
+                    TRACE.span("import", "fs", storage=name):
+                result = archive.import_(storage["path"], f, storage.get("import_id"))
+        except (OSError, ValueError, tarfile.TarError) as e:
+            if created:
+                shutil.rmtree(storage["path"], ignore_errors=True)
+                self.store.delete(name)
+            print(f"Import failed: {e}")
+            return False
+        self.store.update(name, import_id=result["id"])
+        os.makedirs(os.path.join(storage["path"], "upper"), exist_ok=True)
+        for f in (SIZE_INDEX_FILE, SIZE_INDEX_FILE.replace(".json", ".lower.json")):
+            try:
+                os.unlink(os.path.join(storage["path"], f))
+            except OSError:
+                pass
+        kind = f"incremental on {result['base'][:12]}" if result["base"] else "full"
+        print(f"Imported {kind} export {result['id'][:12]} of '{result.get('storage')}' into '{name}' "
+              f"in {time.monotonic() - t0:.2f}s: {result['entries']} entries, "
+              f"{self._format_bytes(result['bytes'])} of file data, {result['deleted']} deleted")
+        return True
+
+    # ==== COMPACT ====
+    def compact(self, names, dry_run=False, extra_globs=()):
+        storages = self.store.all()
+        variant_layers = {}
+        globs = compact.CACHE_GLOBS + tuple(extra_globs)
+        grand = {c: [0, 0] for c in compact.CATEGORIES}
+        ok = True
+        for name in names:
+            storage = storages.get(name)
+            if storage is None:
+                print(f"Storage '{name}' does not exist")
+                ok = False
+                continue
+            if storage.get("status") in ("running", "paused"):
+                print(f"{name}: skipped, {storage.get('status')} (compact needs it stopped)")
+                continue
+            if not self._ensure_disk(storage, log=lambda msg: print(f"{name}: skipped, {msg}")):
+                ok = False
+                continue
+            variant = self._image_variant(storage)
+            if variant not in variant_layers:
+                variant_layers[variant] = self.docker.image_layers(IMAGE_VARIANTS[variant]["image"])
+                if not variant_layers[variant]:
+                    print(f"Layers of {IMAGE_VARIANTS[variant]['image']} not readable here (needs the overlay2 "
+                          "driver on this host); only caches, work/ and whiteouts in opaque dirs are handled")
+            image_layers = variant_layers[variant]
+            lower = os.path.join(storage["path"], "lower")
+            roots = ([lower] if os.path.isdir(lower) else []) + image_layers
+            t0 = time.monotonic()
+            try:
+                with TRACE.span("compact", "fs", storage=name, dry_run=dry_run):
+                    totals = compact.compact(storage["path"], roots, bool(image_layers), globs, dry_run)
+            except OSError as e:
+                print(f"{name}: compact failed: {e}")
+                ok = False
+                continue
+            parts = ", ".join(f"{c.replace('_', ' ')} {n} ({self._format_bytes(b)})"
+                              for c, (n, b) in totals.items() if n)
+            print(f"{name}: {parts or 'nothing to do'} in {time.monotonic() - t0:.2f}s")
+            for c, (n, b) in totals.items():
+                grand[c][0] += n
+                grand[c][1] += b
+        reclaimed = sum(b for _, b in grand.values())
+        print(f"{'Reclaimable' if dry_run else 'Reclaimed'}: {self._format_bytes(reclaimed)} "
+              f"(" + ", ".join(f"{c.replace('_', ' ')} {self._format_bytes(b)}" for c, (_, b) in grand.items()) + ")")
+        return ok
+
+    # ==== DEDUP ====
+    def _dedup_layers(self):
+        # Layers of running (or paused) storages are mounted: only reflinks,
+        # which leave the inodes in place, are used there.
+        out = []
+        for name, storage in self.store.all().items():
+            if not self._ensure_disk(storage, log=lambda msg: print(f"{name}: skipped, {msg}")):
+                continue
+            stopped = storage.get("status") not in ("running", "paused")
+            path = storage.get("path", "")
+            out.append(dedup.Layer(os.path.join(path, "lower"), f"{name}/lower", "all" if stopped else None))
+            out.append(dedup.Layer(os.path.join(path, "upper"), f"{name}/upper", "globs" if stopped else None))
+        if os.path.isdir(SNAPSHOTS_DIR):
+            for name in sorted(os.listdir(SNAPSHOTS_DIR)):
+                for snap in sorted(os.listdir(self._snapshot_dir(name))):
+                    for layer in ("lower", "upper"):
+                        out.append(dedup.Layer(os.path.join(self._snapshot_dir(name, snap), layer),
+                                               f"{name}@{snap}/{layer}", "all"))
+        return [l for l in out if os.path.isdir(l.root)]
+
+    def dedup(self, dry_run=False):
+        layer_list = self._dedup_layers()
+        if not layer_list:
+            print("No storages found")
+            return True
+        index = dedup.HashIndex()
+        t0 = time.monotonic()
+        try:
+            with TRACE.span("dedup", "fs", layers=len(layer_list), dry_run=dry_run):
+                totals = dedup.run(layer_list, index, dry_run=dry_run)
+        finally:
+            index.close()
+        fb = self._format_bytes
+        verb = "Would reclaim" if dry_run else "Reclaimed"
+        print(f"Scanned {totals['files']} files ({fb(totals['bytes'])}) in {len(layer_list)} layers "
+              f"in {time.monotonic() - t0:.2f}s")
+        print(f"  hashed {totals['hashed']} ({fb(totals['hashed_bytes'])}), "
+              f"{totals['reused']} unchanged since the last run")
+        print(f"  {totals['groups']} sets of identical files, {fb(totals['duplicate_bytes'])} duplicated")
+        print(f"  {verb} {fb(totals['reflinked_bytes'])} by reflink ({totals['reflinked']} files), "
+              f"{fb(totals['linked_bytes'])} by hard link ({totals['linked']} files)")
+        if totals["skipped_bytes"]:
+            print(f"  {fb(totals['skipped_bytes'])} left duplicated (no reflink support, not immutable)")
+        if totals["errors"]:
+            print(f"  {totals['errors']} file(s) failed")
+        if not dry_run:
+            self.store.set_meta("dedup_last", {"at": time.time(), "reclaimed": totals["reflinked_bytes"]
+                                               + totals["linked_bytes"], "duplicate": totals["duplicate_bytes"]})
+        return not totals["errors"]
+
     def delete(self, name):
-        if name not in self.state["storages"]:
+        storage = self.store.get(name)
+        if storage is None:
             print(f"Storage '{name}' does not exist")
             return
 
-        storage = self.state["storages"][name]
-        running = storage.get("status") == "running"
+        # a paused container still holds the storage's mounts; a suspended
+        # one has none, and the idle watcher drops its listener with the record
+        status = storage.get("status")
         container_name = f'{CONTAINER_PREFIX}{name}'
 
         confirmation = input("Type 'DELETE' to permanently delete: ")
@@ -351,48 +2249,177 @@ fi
             print("Deletion cancelled")
             return
 
-        if running:
-            print(f"Force deleting running storage '{name}' (no save)...")
-            subprocess.run(['docker', 'rm', '-f', container_name],
-                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if status in ("running", "paused"):
+            print(f"Force deleting {status} storage '{name}' (no save)...")
+            try:
+                self.docker.remove_container(container_name, force=True)
+            except DockerError:
+                pass
 
+        # The tree is renamed into the trash and the reaper frees it in the
+        # background, so deleting never waits on millions of unlinks.
         storage_path = storage["path"]
-        if os.path.exists(storage_path):
-            print(f"Deleting {storage_path}...")
+        entry = f"{name}.{int(time.time())}.{os.getpid()}"
+        trash_path = os.path.join(os.path.abspath(TRASH_DIR), entry)
+        pending = self._indexed_bytes(storage_path)
+        if storage.get("disk"):
+            # the whole storage is one file; unmounted, it is freed by one unlink
+            pending = disks.allocated(disks.image_path(storage_path))
+            try:
+                if disks.is_mounted(storage_path):
+                    disks.umount(storage_path)
+            except OSError as e:
+                print(f"Cannot unmount {storage_path}: {e}")
+                return
+        try:
+            os.makedirs(trash_path)
+            if storage.get("disk") and os.path.exists(disks.image_path(storage_path)):
+                os.rename(disks.image_path(storage_path), os.path.join(trash_path, "storage.img"))
+            if os.path.exists(storage_path):
+                os.rename(storage_path, os.path.join(trash_path, "storage"))
+            if os.path.isdir(self._snapshot_dir(name)):
+                os.rename(self._snapshot_dir(name), os.path.join(trash_path, "snapshots"))
+        except OSError as e:
+            # e.g. EXDEV with storages/ on another filesystem
+            print(f"Cannot move to {TRASH_DIR} ({e}); deleting {storage_path}...")
             shutil.rmtree(storage_path, ignore_errors=True)
+            if storage.get("disk") and os.path.exists(disks.image_path(storage_path)):
+                os.unlink(disks.image_path(storage_path))
+            shutil.rmtree(self._snapshot_dir(name), ignore_errors=True)
+            # whatever did move before the failure stays for the reaper
+            try:
+                os.rmdir(trash_path)
+            except OSError:
+                pass
+
+        with self.store.transaction():
+            self.store.delete(name)
+            if os.path.isdir(trash_path):
+                trash = self.store.get_meta("trash", {})
+                trash[entry] = {"name": name, "at": time.time(), "bytes": pending, "freed": 0}
+                self.store.set_meta("trash", trash)
+        if os.path.isdir(trash_path):
+            self._spawn_reaper()
+            print(f"Storage '{name}' deleted permanently "
+                  f"({self._format_bytes(pending) if pending else 'its space'} reclaimed in the background)")
+        else:
+            print(f"Storage '{name}' deleted permanently")
+
+    # ==== TRASH ====
+    def _indexed_bytes(self, storage_path):
+        # what the size indexes last saw, without walking anything
+        total = 0
+        for layer in ("upper", "lower"):
+            try:
+                total += sum(d["bytes"] for d in OverlaySizeIndex(storage_path, layer).entries.values())
+            except (KeyError, TypeError):
+                pass
+        return total
+
+    def _spawn_reaper(self):
+        argv = [sys.executable, os.path.abspath(__file__), "reap"]
+        with TRACE.span("spawn reaper", "subprocess", argv=argv):
+            subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def _reaper_running(self):
+        with open(os.path.abspath(STORAGES_DIR + ".reap.lock"), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
 
-        del self.state["storages"][name]
-        self.save_state()
-        print(f"Storage '{name}' deleted permanently")
+    def _reap_progress(self, entry, freed, done=False):
+        with self.store.transaction():
+            trash = self.store.get_meta("trash", {})
+            if done:
+                trash.pop(entry, None)
+            elif entry in trash:
+                trash[entry]["freed"] = freed
+            self.store.set_meta("trash", trash)
+
+    def _reap_entry(self, entry, pool, jobs, throttle, log):
+        path = os.path.join(os.path.abspath(TRASH_DIR), entry)
+        freed = [0]
+        lock = threading.Lock()
+        reported = [time.monotonic()]
+
+        def unlink(root, names):
+            n = 0
+            for name in names:
+                p = os.path.join(root, name)
+                try:
+                    st = os.lstat(p)
+                    os.unlink(p)
+                except FileNotFoundError:
+                    continue
+                if st.st_nlink == 1:
+                    # sparse files (disk images) free only what they allocated
+                    n += min(st.st_size, st.st_blocks * 512)
+                throttle.take()
+            with lock:
+                freed[0] += n
+
+        t0 = time.monotonic()
+        # bottom-up, so a directory is empty by the time it is removed; each
+        # directory's files are split across the pool
+        for root, dirs, files in os.walk(path, topdown=False):
+            chunk = max(64, len(files) // jobs + 1)
+            list(pool.map(lambda part: unlink(root, part), (files[i:i + chunk] for i in range(0, len(files), chunk))))
+            for d in dirs:
+                p = os.path.join(root, d)
+                try:
+                    os.unlink(p) if os.path.islink(p) else os.rmdir(p)
+                except OSError:
+                    shutil.rmtree(p, ignore_errors=True)
+            if time.monotonic() - reported[0] > 2:
+                self._reap_progress(entry, freed[0])
+                reported[0] = time.monotonic()
+        try:
+            os.rmdir(path)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+        self._reap_progress(entry, freed[0], done=True)
+        log(f"Reclaimed {self._format_bytes(freed[0])} from {entry} in {time.monotonic() - t0:.1f}s")
+
+    def reap(self, jobs=REAP_JOBS, rate=REAP_RATE, log=print):
+        # Empties the trash. One reaper at a time; later deletes just leave
+        # their entry for it to pick up.
+        with open(os.path.abspath(STORAGES_DIR + ".reap.lock"), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                log("A reaper is already running")
+                return
+            # lowest CPU and I/O priority, set before the worker threads inherit it
+            try:
+                os.nice(19)
+            except OSError:
+                pass
+            if REAP_IONICE and shutil.which("ionice"):
+                subprocess.run(["ionice", "-c", REAP_IONICE, "-p", str(os.getpid())],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            throttle = Throttle(rate)
+            trash_dir = os.path.abspath(TRASH_DIR)
+            with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+                while True:
+                    entries = sorted(os.listdir(trash_dir)) if os.path.isdir(trash_dir) else []
+                    if not entries:
+                        break
+                    for entry in entries:
+                        with TRACE.span("reap", "fs", entry=entry):
+                            self._reap_entry(entry, pool, max(1, jobs), throttle, log)
+            # drop entries whose directory is gone; a delete racing with the
+            # end of this loop keeps its entry for the next reaper
+            with self.store.transaction():
+                left = set(os.listdir(trash_dir)) if os.path.isdir(trash_dir) else set()
+                trash = self.store.get_meta("trash", {})
+                self.store.set_meta("trash", {k: v for k, v in trash.items() if k in left})
 
     # ==== LIST (advanced) ====
     def _parse_hsize_to_bytes(self, s: str) -> int:
-        s = s.strip()
-        m = re.match(r'^([\d\.]+)\s*([KMGTP]?i?B)$', s, re.IGNORECASE)
-        if not m:
-            s = s.split('/')[0].strip()
-            m = re.match(r'^([\d\.]+)\s*([KMGTP]?i?B)$', s, re.IGNORECASE)
-            if not m:
-                try:
-                    return int(float(s))
-                except Exception:
-                    return 0
-        val = float(m.group(1))
-        unit = m.group(2).lower()
-        mult = {
-            'b': 1,
-            'kb': 1000,
-            'kib': 1024,
-            'mb': 1000**2,
-            'mib': 1024**2,
-            'gb': 1000**3,
-            'gib': 1024**3,
-            'tb': 1000**4,
-            'tib': 1024**4,
-            'pb': 1000**5,
-            'pib': 1024**5,
-        }.get(unit, 1)
-        return int(val * mult)
+        return docker_client.parse_human_size(s)
 
     def _format_bytes(self, n: int) -> str:
         for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']:
@@ -400,71 +2427,240 @@ fi
                 return f"{n:.2f} {unit}"
             n /= 1024.0
 
-    def _dir_size_bytes(self, path: str) -> int:
-        try:
-            r = subprocess.run(['du', '-sb', path], capture_output=True, text=True)
-            if r.returncode == 0:
-                return int(r.stdout.split()[0])
-        except Exception:
-            pass
-        total = 0
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                try:
-                    fp = os.path.join(root, f)
-                    total += os.path.getsize(fp)
-                except OSError:
-                    pass
-        return total
-
-    def _docker_stats_map(self):
-        cmd = [
-            'docker', 'stats', '--no-stream',
-            '--format', '{{.ID}}|{{.Name}}|{{.CPUPerc}}|{{.MemUsage}}|{{.NetIO}}|{{.BlockIO}}|{{.PIDs}}'
-        ]
-        r = subprocess.run(cmd, capture_output=True, text=True)
+    def _overlay_usage(self, storage_path: str, deadline=None, layer="upper"):
+        if not os.path.isdir(os.path.join(storage_path, layer)):
+            return {"bytes": 0, "files": 0, "dirs": 0, "whiteouts": 0, "opaque_dirs": 0, "rescanned_dirs": 0}
+        return OverlaySizeIndex(storage_path, layer).scan(deadline)
+
+    def _docker_stats_map(self, names):
+        with TRACE.span("docker stats sample", count=len(names)):
+            try:
+                return self.docker.stats(names)
+            except DockerError:
+                return {}
+
+    def _container_stats(self, names, docs):
+        # Exact counters from each container's cgroup when the host runs cgroup
+        # v2; `docker stats` only for whatever could not be read that way.
         out = {}
-        if r.returncode != 0:
-            return out
-        for line in r.stdout.splitlines():
-            parts = line.split('|')
-            if len(parts) != 7:
-                continue
-            cid, name, cpu, mem, netio, blockio, pids = parts
-            out[name.strip()] = {
-                "id": cid.strip(),
-                "cpu": cpu.strip(),
-                "mem": mem.strip(),
-                "netio": netio.strip(),
-                "blockio": blockio.strip(),
-                "pids": pids.strip()
+        if names and cgroup_stats.available():
+            targets = {
+                n: (docs[n].get("Id", ""), docs[n].get("State", {}).get("Pid", 0))
+                for n in names if n in docs
             }
+            with TRACE.span("cgroup sample", count=len(targets)):
+                out = cgroup_stats.CgroupSampler().sample(targets)
+        missing = [n for n in names if n not in out]
+        if missing:
+            out.update(self._docker_stats_map(missing))
         return out
 
     def _docker_inspect(self, name_or_id: str):
-        r = subprocess.run(['docker', 'inspect', name_or_id], capture_output=True, text=True)
-        if r.returncode != 0:
-            return None
+        return self._docker_inspect_many([name_or_id]).get(name_or_id)
+
+    def _docker_inspect_many(self, names):
+        with TRACE.span("docker inspect", count=len(names)):
+            try:
+                return self.docker.inspect(names)
+            except DockerError:
+                return {}
+
+    def _uptime_str(self, insp) -> str:
+        if not insp or not insp.get("State", {}).get("Running"):
+            return "-"
         try:
-            data = json.loads(r.stdout)
-            if data:
-                return data[0]
+            started = insp["State"].get("StartedAt")
+            dt = datetime.fromisoformat(started.replace('Z', '+00:00'))
+            secs = int((datetime.now(timezone.utc) - dt).total_seconds())
         except Exception:
+            return "-"
+        d = secs // 86400
+        h = (secs % 86400) // 3600
+        m = (secs % 3600) // 60
+        s = secs % 60
+        return f"{d}d {h}h {m}m {s}s"
+
+    def _watch_stats(self, names, history, stop):
+        try:
+            for name, sample in self.docker.stream_stats(names, stop):
+                if name in history:
+                    history[name].add(sample)
+        except DockerError:
             pass
-        return None
-
-    def list_storages(self):
-        storages = self.state.get("storages", {})
-        stats_map = self._docker_stats_map()
 
+    def top(self, interval: float = TOP_INTERVAL, seconds: int = TOP_HISTORY):
+        # One streaming stats feed for all running vnc-* containers, redrawn in
+        # place. Instead of one two-second `docker stats --no-stream` sample per
+        # refresh, samples accumulate in per-container ring buffers.
+        history = {}
+        stop = None
+        names = []
+        rescan_at = 0.0
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= rescan_at:
+                    try:
+                        current = sorted(c["name"] for c in self.docker.containers(CONTAINER_PREFIX)
+                                         if c["state"] == "running")
+                    except DockerError as e:
+                        print(f"Error listing containers: {e}")
+                        return
+                    if current != names:
+                        if stop:
+                            stop.set()
+                        names = current
+                        for n in names:
+                            history.setdefault(n, StatsHistory(seconds))
+                        for n in list(history):
+                            if n not in names:
+                                del history[n]
+                        stop = threading.Event()
+                        threading.Thread(target=self._watch_stats, args=(names, history, stop), daemon=True).start()
+                    rescan_at = now + TOP_RESCAN
+                self._render_top(names, history)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if stop:
+                stop.set()
+
+    def _render_top(self, names, history):
+        rate = lambda n: self._format_bytes(n) + "/s"
+        lines = [
+            f"vnc desktops - {datetime.now().strftime('%H:%M:%S')} - {len(names)} running"
+            "  (avg/peak over 1m and 5m, Ctrl-C to quit)",
+            "",
+            f"{'STORAGE':<20} {'CPU now':>8} {'1m':>15} {'5m':>15} {'RAM now':>12} {'1m avg/peak':>25}"
+            f" {'NET 1m':>25} {'BLOCK 1m':>25}",
+        ]
+        totals = [0.0, 0]
+        for name in names:
+            h = history.get(name)
+            cur = h.latest() if h else None
+            label = name[len(CONTAINER_PREFIX):]
+            if not cur:
+                lines.append(f"{label:<20} (waiting for samples)")
+                continue
+            m1, m5 = h.summary(60), h.summary(300)
+            totals[0] += cur[1]
+            totals[1] += cur[2]
+            lines.append(
+                f"{label:<20} {cur[1]:>7.1f}% {m1['cpu'][0]:>6.1f}/{m1['cpu'][1]:>6.1f}% "
+                f"{m5['cpu'][0]:>6.1f}/{m5['cpu'][1]:>6.1f}% {self._format_bytes(cur[2]):>12} "
+                f"{self._format_bytes(m1['mem'][0]):>12}/{self._format_bytes(m1['mem'][1]):<12} "
+                f"{rate(m1['net'][0]):>12}/{rate(m1['net'][1]):<12} "
+                f"{rate(m1['blk'][0]):>12}/{rate(m1['blk'][1]):<12}"
+            )
+        lines.append("")
+        lines.append(f"Total CPU {totals[0]:.1f}%  RAM {self._format_bytes(totals[1])}")
+        sys.stdout.write("\x1b[H\x1b[2J" + "\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+    def list_records(self, names, fields, deadline: float = LIST_DEADLINE):
+        # One dict per selected storage with just `fields`. Collectors whose
+        # fields are not asked for never run, so state-only fields are a read
+        # of the state store and nothing else.
+        all_storages = self.store.all()
+        storages = {n: all_storages[n] for n in names if n in all_storages}
+        needed = {LIST_FIELDS[f] for f in fields}
+        deadline_at = time.monotonic() + deadline
+        running = [f"{CONTAINER_PREFIX}{n}" for n, s in storages.items() if s.get("status") == "running"]
+        pool = ThreadPoolExecutor(max_workers=LIST_WORKERS + 2)
+        inspect_f = stats_f = None
+        if needed & {"inspect", "stats"}:
+            inspect_f = pool.submit(self._docker_inspect_many, running)
+        if "stats" in needed:
+            stats_f = pool.submit(lambda: self._container_stats(running, inspect_f.result()))
+        disk = {name: self._disk_usage(s) for name, s in storages.items()
+                if s.get("disk")} if needed & {"size", "lower", "disk"} else {}
+        size_f = {name: pool.submit(self._overlay_usage, s.get("path", ""), deadline_at)
+                  for name, s in storages.items() if name not in disk} if "size" in needed else {}
+        lower_f = {name: pool.submit(self._overlay_usage, s["path"], deadline_at, "lower")
+                   for name, s in storages.items() if name not in disk
+                   and os.path.isdir(os.path.join(s.get("path", ""), "lower"))} if "lower" in needed else {}
+
+        def wait(fut, default):
+            try:
+                return fut.result(timeout=max(deadline_at - time.monotonic(), 0))
+            except FutureTimeout:
+                return default
+
+        records = []
+        for name, s in storages.items():
+            row = {k: s.get(k) for k, c in LIST_FIELDS.items() if c == "state"}
+            row.update(name=name, labels=s.get("labels") or {}, gateway=bool(s.get("gateway")),
+                       variant=self._image_variant(s))
+            cname = f"{CONTAINER_PREFIX}{name}"
+            if name in disk:
+                # the whole filesystem: both layers and the storage's own files
+                d = disk[name] or {}
+                row.update(disk_bytes=d.get("used"), disk_files=d.get("files"), whiteouts=None,
+                           opaque_dirs=None, lower_bytes=None, lower_files=None, disk_size=d.get("size"),
+                           disk_free=d.get("free"))
+            elif "size" in needed:
+                usage = wait(size_f[name], None) or {}
+                row.update(disk_bytes=usage.get("bytes"), disk_files=usage.get("files"),
+                           whiteouts=usage.get("whiteouts"), opaque_dirs=usage.get("opaque_dirs"))
+            if "disk" in needed and name not in disk:
+                row.update(disk_size=None, disk_free=None)
+            if "lower" in needed and name not in disk:
+                lower = wait(lower_f[name], None) or {} if name in lower_f else {"bytes": 0, "files": 0}
+                row.update(lower_bytes=lower.get("bytes"), lower_files=lower.get("files"))
+            if stats_f:
+                stat = wait(stats_f, {}).get(cname) or {}
+                row.update({k: stat.get(k) for k, c in LIST_FIELDS.items() if c == "stats"})
+            if "inspect" in needed:
+                doc = wait(inspect_f, {}).get(cname)
+                row["started_at"] = (doc or {}).get("State", {}).get("StartedAt") if doc else None
+                row["uptime"] = self._uptime_str(doc) if doc else None
+            records.append({f: row[f] for f in fields})
+        pool.shutdown(wait=False, cancel_futures=True)
+        return records
+
+    def list_storages(self, deadline: float = LIST_DEADLINE, names=None):
+        storages = self.store.all()
+        if names is not None:
+            storages = {n: s for n, s in storages.items() if n in names}
         if not storages:
             print("No storages found")
             print("Create one with: python main.py create <name>")
             return
 
+        deadline_at = time.monotonic() + deadline
+        running = [f"{CONTAINER_PREFIX}{n}" for n, s in storages.items() if s.get("status") == "running"]
+
+        # Everything is collected concurrently: one batched inspect and one stats
+        # sample (cgroup reads, else docker stats) for all running containers,
+        # plus bounded parallel size scans.
+        # Rows are still printed in state order as soon as their data is ready.
+        pool = ThreadPoolExecutor(max_workers=LIST_WORKERS + 2)
+        inspect_f = pool.submit(self._docker_inspect_many, running)
+        stats_f = pool.submit(lambda: self._container_stats(running, inspect_f.result()))
+        # bounded storages answer with one statfs, nothing to walk
+        disk = {name: self._disk_usage(storage) for name, storage in storages.items() if storage.get("disk")}
+        size_f = {
+            name: pool.submit(self._overlay_usage, storage.get("path", ""), deadline_at)
+            for name, storage in storages.items() if name not in disk
+        }
+        lower_f = {
+            name: pool.submit(self._overlay_usage, storage["path"], deadline_at, "lower")
+            for name, storage in storages.items()
+            if name not in disk and os.path.isdir(os.path.join(storage.get("path", ""), "lower"))
+        }
+
+        def wait(fut, default):
+            try:
+                return fut.result(timeout=max(deadline_at - time.monotonic(), 0))
+            except FutureTimeout:
+                return default
+
         total_mem_bytes = 0
         total_disk_bytes = 0
+        total_reclaimed = 0
         running_count = 0
+        timed_out = 0
 
         print("\n" + "="*80)
         print("STORAGES (managed)")
@@ -477,9 +2673,15 @@ fi
             storage_path = storage.get("path", "-")
             container_name = f"{CONTAINER_PREFIX}{name}"
 
-            upper_path = os.path.join(storage_path, "upper")
-            upper_size = self._dir_size_bytes(upper_path) if os.path.exists(upper_path) else 0
-            total_disk_bytes += upper_size
+            if name in disk:
+                usage = None
+                total_disk_bytes += (disk[name] or {}).get("used", 0)
+            else:
+                usage = wait(size_f[name], None)
+                if usage is None:
+                    timed_out += 1
+                else:
+                    total_disk_bytes += usage["bytes"]
 
             print(f"\n{name}")
             print(f"  Status      : {status}")
@@ -492,50 +2694,702 @@ fi
             else:
                 print(f"  Container   : -")
             print(f"  Path        : {storage_path}")
-            print(f"  Overlay size: {self._format_bytes(upper_size)}")
+            if storage.get("labels"):
+                print(f"  Labels      : {', '.join(f'{k}={v}' for k, v in sorted(storage['labels'].items()))}")
+            if storage.get("resources"):
+                print(f"  Resources   : {self._format_resources(storage['resources'])}")
+            if storage.get("display"):
+                print(f"  Display     : {self._format_display(storage)}")
+            if self._image_variant(storage) != DEFAULT_VARIANT:
+                print(f"  Image       : {self._image_variant(storage)} "
+                      f"({IMAGE_VARIANTS[self._image_variant(storage)]['image']})")
+            if port and status == "running":
+                print(f"  Viewer      : {self._viewer_hint(storage, f'localhost:{port}')}")
+            if storage.get("gateway") and status == "running":
+                print(f"  Gateway     : python main.py connect {name}")
+            if storage.get("gateway_stats"):
+                g = storage["gateway_stats"]
+                print(f"  Gateway I/O : {g['sessions']} sessions, in {self._format_bytes(g['bytes_in'])}, "
+                      f"out {self._format_bytes(g['bytes_out'])}, last connect {g['last_connect_ms']} ms")
+            if status in ("paused", "suspended") and storage.get("idle_since"):
+                idle = int(time.time() - storage["idle_since"])
+                reclaimed = storage.get("reclaimed") or 0
+                total_reclaimed += reclaimed
+                print(f"  Idle        : {status} for {idle // 3600}h {idle % 3600 // 60}m, "
+                      f"reclaimed {self._format_bytes(reclaimed)}")
+            if name in disk:
+                d = disk[name]
+                if d is None:
+                    print(f"  Disk        : {self._format_bytes(storage['disk']['size'])} image, not mounted")
+                else:
+                    image = disks.image_path(storage_path)
+                    print(f"  Disk        : {self._format_bytes(d['used'])} of {self._format_bytes(d['size'])} "
+                          f"used ({d['used'] * 100 // max(d['size'], 1)}%), {d['files']} inodes, "
+                          f"image takes {self._format_bytes(disks.allocated(image))} on the host")
+            elif usage is None:
+                print(f"  Overlay size: (timed out after {deadline:g}s)")
+            else:
+                print(f"  Overlay size: {self._format_bytes(usage['bytes'])} ({usage['files']} files)")
+                if usage["whiteouts"] or usage["opaque_dirs"]:
+                    print(f"  Deletions   : {usage['whiteouts']} whiteouts, {usage['opaque_dirs']} opaque dirs")
+            if name in lower_f:
+                lower = wait(lower_f[name], None)
+                origin = f", cloned from {storage['cloned_from']}" if storage.get("cloned_from") else ""
+                if lower is None:
+                    print(f"  Lower layer : (timed out after {deadline:g}s)")
+                else:
+                    print(f"  Lower layer : {self._format_bytes(lower['bytes'])} ({lower['files']} files, "
+                          f"hard links shared with clones{origin})")
 
             if status == "running":
                 running_count += 1
-                stat = stats_map.get(container_name)
+                stat = wait(stats_f, {}).get(container_name)
                 if stat:
-                    mem_used_part = stat["mem"].split('/')[0].strip()
-                    mem_used_bytes = self._parse_hsize_to_bytes(mem_used_part)
+                    mem_used_bytes = stat["mem_used"]
                     total_mem_bytes += mem_used_bytes
-
-                    insp = self._docker_inspect(container_name)
-                    uptime_str = "-"
-                    if insp and "State" in insp and insp["State"].get("Running"):
-                        started = insp["State"].get("StartedAt")
-                        try:
-                            dt = datetime.fromisoformat(started.replace('Z', '+00:00'))
-                            delta = datetime.now(timezone.utc) - dt
-                            secs = int(delta.total_seconds())
-                            d = secs // 86400
-                            h = (secs % 86400) // 3600
-                            m = (secs % 3600) // 60
-                            s = secs % 60
-                            uptime_str = f"{d}d {h}h {m}m {s}s"
-                        except Exception:
-                            pass
+                    uptime_str = self._uptime_str(wait(inspect_f, {}).get(container_name))
 
                     print("  Live stats  :")
-                    print(f"    CPU       : {stat['cpu']}")
-                    print(f"    RAM       : {mem_used_part} ({mem_used_bytes} bytes)")
-                    print(f"    Net I/O   : {stat['netio']}")
-                    print(f"    Block I/O : {stat['blockio']}")
+                    print(f"    CPU       : {stat['cpu_percent']:.2f}%")
+                    print(f"    RAM       : {self._format_bytes(mem_used_bytes)} ({mem_used_bytes} bytes)")
+                    if "mem_anon" in stat:
+                        print(f"                anon {self._format_bytes(stat['mem_anon'])}, "
+                              f"page cache {self._format_bytes(stat['mem_file'])}")
+                    print(f"    Net I/O   : {self._format_bytes(stat['net_rx'])} / {self._format_bytes(stat['net_tx'])}")
+                    print(f"    Block I/O : {self._format_bytes(stat['blk_read'])} / {self._format_bytes(stat['blk_write'])}")
                     print(f"    PIDs      : {stat['pids']}")
                     print(f"    Uptime    : {uptime_str}")
                 else:
                     print("  Live stats  : (not available)")
+            sys.stdout.flush()
+
+        # scans that blew the deadline stop at their next directory; don't wait
+        pool.shutdown(wait=False, cancel_futures=True)
 
         print("\n" + "-"*80)
         print(f"Running storages : {running_count}/{len(storages)}")
         print(f"Total RAM (running): {self._format_bytes(total_mem_bytes)} ({total_mem_bytes} bytes)")
-        print(f"Total overlay disk: {self._format_bytes(total_disk_bytes)} ({total_disk_bytes} bytes)")
+        if total_reclaimed:
+            print(f"Reclaimed by idle  : {self._format_bytes(total_reclaimed)} ({total_reclaimed} bytes)")
+        host_total = cgroup_stats.host_mem_total()
+        if host_total and MEMORY_COMMIT_RATIO > 0:
+            print(f"Committed memory  : {self._format_bytes(self._committed_memory(storages))} of "
+                  f"{self._format_bytes(int(host_total * MEMORY_COMMIT_RATIO))} admission budget")
+        disk_note = f" ({timed_out} scan(s) timed out)" if timed_out else ""
+        trash = self.store.get_meta("trash", {})
+        if trash:
+            pending = sum(max(t["bytes"] - t["freed"], 0) for t in trash.values())
+            note = "" if self._reaper_running() else " (reaper not running: python main.py reap)"
+            print(f"Pending reclaim   : {self._format_bytes(pending)} in {len(trash)} deleted storage(s){note}")
+        if self.state_trusted():
+            print("State             : followed live by `reconcile --follow`")
+        elif self.store.get_meta("reconciled_at"):
+            at = datetime.fromtimestamp(self.store.get_meta("reconciled_at")).strftime('%Y-%m-%d %H:%M')
+            print(f"State             : last reconciled {at}")
+        last_dedup = self.store.get_meta("dedup_last")
+        if last_dedup:
+            print(f"Last dedup        : {datetime.fromtimestamp(last_dedup['at']).strftime('%Y-%m-%d %H:%M')}, "
+                  f"reclaimed {self._format_bytes(last_dedup['reclaimed'])}")
+        print(f"Total overlay disk: {self._format_bytes(total_disk_bytes)} ({total_disk_bytes} bytes){disk_note}")
         print("-" * 80)
         print("\n")
 
 
+class Reconciler:
+    # Brings the state store in line with docker for vnc-* containers: one full
+    # pass over `docker ps -a` (reconcile), then, with follow, docker's event
+    # stream. Each event for vnc-<name> re-reads that one container and fixes
+    # its row, so nothing is polled. The event stream is opened from just
+    # before the full pass, so nothing that happens during it is missed.
+    # While it follows, a heartbeat in meta tells other commands they can trust
+    # the state's ports instead of asking docker (port_allocator).
+    EVENT_ACTIONS = ("create", "start", "restart", "die", "stop", "pause", "unpause", "destroy", "rename")
+
+    def __init__(self, manager, log=print):
+        self.manager = manager
+        self.store = manager.store
+        self.log = log
+        self.events = 0
+        self.following = False
+        self.started = time.time()
+
+    def _fix(self, name, container):
+        # -> the fields changed in name's row, given its container (or None)
+        with self.store.transaction():
+            storage = self.store.get(name)
+            if storage is None:
+                return {}
+            status = storage.get("status")
+            state = container["state"] if container else None
+            fields = {}
+            if state in ("running", "paused"):
+                if status != state:
+                    fields["status"] = state
+                if storage.get("container_id") != container["id"]:
+                    fields["container_id"] = container["id"]
+                if container["ports"] and storage.get("port") not in container["ports"]:
+                    fields["port"] = container["ports"][0]
+            elif status in ("running", "paused"):
+                # crashed, stopped or removed behind our back
+                fields = {"status": "stopped", "container_id": None, "port": None, "admitted_at": None,
+                          "idle_since": None, "reclaimed": None}
+            if fields:
+                self.store.update(name, **fields)
+        return fields
+
+    def _report(self, name, fields, why):
+        if fields:
+            self.log(f"{name}: {why}: " + ", ".join(f"{k}={v if k != 'container_id' or not v else v[:12]}"
+                                                   for k, v in fields.items()))
+
+    def reconcile(self):
+        # Full pass. Returns the number of rows fixed.
+        containers = {c["name"][len(CONTAINER_PREFIX):]: c for c in self.manager.docker.containers(CONTAINER_PREFIX)}
+        fixed = 0
+        for name in self.store.all():
+            fields = self._fix(name, containers.pop(name, None))
+            self._report(name, fields, "reconciled")
+            fixed += bool(fields)
+        for name, c in containers.items():
+            self.log(f"{c['name']}: container without a storage ({c['state']}), left alone")
+        self.store.set_meta("reconciled_at", time.time())
+        return fixed
+
+    def handle(self, event):
+        actor = event.get("Actor") or {}
+        cname = (actor.get("Attributes") or {}).get("name", "")
+        action = (event.get("Action") or event.get("status") or "").split(":")[0]
+        if not cname.startswith(CONTAINER_PREFIX) or action not in self.EVENT_ACTIONS:
+            return
+        self.events += 1
+        name = cname[len(CONTAINER_PREFIX):]
+        if action == "destroy":
+            container = None
+        else:
+            container = next((c for c in self.manager.docker.containers(cname) if c["name"] == cname), None)
+        self._report(name, self._fix(name, container), action)
+
+    def _beat(self):
+        self.store.set_meta("reconciler", {"pid": os.getpid(), "started": self.started,
+                                           "heartbeat": time.time(), "events": self.events})
+
+    def _heartbeat(self, stop):
+        while not stop.wait(RECONCILE_HEARTBEAT):
+            if self.following:
+                self._beat()
+
+    def run(self):
+        self.log("Following docker events for vnc-* containers (Ctrl-C to quit)")
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(stop,), daemon=True).start()
+        backoff = 1.0
+        try:
+            while True:
+                since = time.time() - 1
+                try:
+                    fixed = self.reconcile()
+                    self.log(f"Full reconcile: {fixed} storage(s) fixed")
+                    self.following = True
+                    self._beat()
+                    for event in self.manager.docker.events(stop, since=since):
+                        self.handle(event)
+                        backoff = 1.0
+                except DockerError as e:
+                    self.log(f"Event stream failed: {e}")
+                self.following = False
+                self.store.set_meta("reconciler", None)
+                # the stream ended (daemon restart?); resync, then follow again
+                self.log(f"Event stream closed, reconnecting in {backoff:g}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            self.store.set_meta("reconciler", None)
+
+
+class IdleWatcher:
+    # Long-running reconciler behind `idle-watch`. Every IDLE_INTERVAL seconds
+    # it looks at running desktops: an ESTABLISHED connection on 5901 in the
+    # container's network namespace, or CPU at or above the threshold, counts as
+    # activity (last_active in state). Desktops idle for longer than the timeout
+    # are paused, with their cgroup memory reclaimed, or stopped with their port
+    # kept ("suspended").
+    #
+    # Waking up: a paused container still owns its published port, and its
+    # kernel completes TCP handshakes while the processes are frozen, so paused
+    # desktops are polled once a second for connections to 5901 and unpaused.
+    # For suspended desktops the watcher listens on the recorded port itself;
+    # the first client triggers a start and is relayed to the new container.
+
+    def __init__(self, manager, timeout=IDLE_TIMEOUT, cpu_threshold=IDLE_CPU_THRESHOLD,
+                 action=IDLE_ACTION, interval=IDLE_INTERVAL, log=print):
+        self.manager = manager
+        self.store = manager.store
+        self.timeout = timeout
+        self.cpu_threshold = cpu_threshold
+        self.action = action
+        self.interval = interval
+        self.log = log
+        self.selector = selectors.DefaultSelector()
+        self.listeners = {}  # storage name -> listening socket, for suspended desktops
+        self.pids = {}  # storage name -> container init pid, for paused desktops
+
+    def _connections(self, pid, host_port=None):
+        # ESTABLISHED (01) or SYN_RECV (03) sockets on VNC_PORT inside the
+        # container, else on the published port on the host (docker-proxy).
+        # None when neither can be read, which counts as "active".
+        paths = []
+        if pid:
+            paths.append((f"/proc/{pid}/net/tcp", f"/proc/{pid}/net/tcp6", VNC_PORT))
+        if host_port:
+            paths.append(("/proc/net/tcp", "/proc/net/tcp6", int(host_port)))
+        for tcp, tcp6, port in paths:
+            count, found = 0, False
+            for path in (tcp, tcp6):
+                try:
+                    with open(path) as f:
+                        next(f, None)
+                        for line in f:
+                            parts = line.split()
+                            if len(parts) > 3 and parts[3] in ('01', '03') and \
+                                    int(parts[1].rsplit(':', 1)[1], 16) == port:
+                                count += 1
+                    found = True
+                except (OSError, ValueError):
+                    pass
+            if found:
+                return count
+        return None
+
+    def check(self):
+        storages = self.store.all()
+        watched = [n for n, s in storages.items() if s.get("status") in ("running", "paused")]
+        docs = self.manager._docker_inspect_many([f"{CONTAINER_PREFIX}{n}" for n in watched])
+        running = [n for n in watched if storages[n].get("status") == "running"]
+        stats = self.manager._container_stats([f"{CONTAINER_PREFIX}{n}" for n in running], docs)
+        now = time.time()
+        for name in watched:
+            doc = docs.get(f"{CONTAINER_PREFIX}{name}") or {}
+            pid = doc.get("State", {}).get("Pid", 0)
+            if name not in running:
+                self.pids[name] = pid
+                continue
+            conns = self._connections(pid, storages[name].get("port"))
+            cpu = (stats.get(f"{CONTAINER_PREFIX}{name}") or {}).get("cpu_percent", 0.0)
+            last = storages[name].get("last_active")
+            if conns is None or conns > 0 or cpu >= self.cpu_threshold or not last:
+                self.store.update(name, last_active=now)
+            elif now - last >= self.timeout:
+                self.suspend(name, storages[name], doc, stats.get(f"{CONTAINER_PREFIX}{name}"))
+
+    def suspend(self, name, storage, doc, stat):
+        container_name = f"{CONTAINER_PREFIX}{name}"
+        idle = int(time.time() - storage["last_active"])
+        if self.action == "stop":
+            port = storage.get("port")
+            reclaimed = (stat or {}).get("mem_used", 0)
+            if not self.manager.stop(name, log=lambda m: None):
+                return
+            self.store.update(name, status="suspended", port=port, idle_since=time.time(), reclaimed=reclaimed)
+            self.log(f"{name}: idle for {idle}s, stopped (port {port} kept, wakes on connect)")
+            return
+        try:
+            self.manager.docker.pause_container(container_name)
+        except DockerError as e:
+            self.log(f"{name}: pause failed: {e}")
+            return
+        reclaimed = 0
+        path = None
+        if cgroup_stats.available():
+            path = cgroup_stats.CgroupSampler().cgroup_path(doc.get("Id", ""), doc.get("State", {}).get("Pid", 0))
+        if path:
+            reclaimed = cgroup_stats.reclaim(path)
+        self.pids[name] = doc.get("State", {}).get("Pid", 0)
+        self.store.update(name, status="paused", idle_since=time.time(), reclaimed=reclaimed)
+        self.log(f"{name}: idle for {idle}s, paused (reclaimed {self.manager._format_bytes(reclaimed)})")
+
+    def poll_paused(self, storages):
+        for name, storage in storages.items():
+            if storage.get("status") != "paused":
+                continue
+            if self._connections(self.pids.get(name), storage.get("port")):
+                self.log(f"{name}: connection while paused, resuming")
+                self.manager.resume(name, log=self.log)
+
+    def arm_listeners(self, storages):
+        for name in list(self.listeners):
+            if storages.get(name, {}).get("status") != "suspended":
+                self._disarm(name)
+        for name, storage in storages.items():
+            if storage.get("status") != "suspended" or name in self.listeners or not storage.get("port"):
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(("0.0.0.0", int(storage["port"])))
+                sock.listen(8)
+            except OSError as e:
+                sock.close()
+                self.log(f"{name}: can't listen on port {storage['port']} ({e}), use start to wake it")
+                self.store.update(name, status="stopped", port=None, idle_since=None, reclaimed=None)
+                continue
+            sock.setblocking(False)
+            self.listeners[name] = sock
+            self.selector.register(sock, selectors.EVENT_READ, name)
+
+    def _disarm(self, name):
+        sock = self.listeners.pop(name)
+        self.selector.unregister(sock)
+        sock.close()
+
+    def wake(self, name):
+        try:
+            client, _ = self.listeners[name].accept()
+        except BlockingIOError:
+            return
+        port = self.store.get(name)["port"]
+        # the port has to be free before docker can publish it again
+        self._disarm(name)
+        self.log(f"{name}: connection on port {port}, starting")
+        self.store.update(name, status="stopped", port=None, idle_since=None, reclaimed=None)
+        if not self.manager.start(name, str(port), interactive=False, log=self.log):
+            client.close()
+            return
+        self.store.update(name, last_active=time.time())
+        threading.Thread(target=self._relay, args=(client, int(self.store.get(name)["port"])), daemon=True).start()
+
+    def _relay(self, client, port, timeout=120.0):
+        # The server speaks first in RFB ("RFB 003.008\n"), so a connection
+        # that yields its greeting means the VNC server is really up rather
+        # than just the published port.
+        deadline = time.monotonic() + timeout
+        upstream = greeting = None
+        while time.monotonic() < deadline:
+            try:
+                upstream = socket.create_connection(("127.0.0.1", port), timeout=5)
+                greeting = upstream.recv(4096)
+                if greeting:
+                    break
+            except OSError:
+                pass
+            if upstream:
+                upstream.close()
+                upstream = None
+            time.sleep(0.5)
+        if not greeting:
+            client.close()
+            return
+        upstream.settimeout(None)
+        client.sendall(greeting)
+
+        def pump(src, dst):
+            try:
+                while True:
+                    data = src.recv(65536)
+                    if not data:
+                        break
+                    dst.sendall(data)
+            except OSError:
+                pass
+            finally:
+                for s in (src, dst):
+                    try:
+                        s.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        t = threading.Thread(target=pump, args=(upstream, client), daemon=True)
+        t.start()
+        pump(client, upstream)
+        t.join()
+        client.close()
+        upstream.close()
+
+    def run(self):
+        self.log(f"Watching for idle desktops: {self.action} after {self.timeout:g}s without a VNC "
+                 f"connection and under {self.cpu_threshold:g}% CPU (Ctrl-C to quit)")
+        next_check = 0.0
+        try:
+            while True:
+                if time.monotonic() >= next_check:
+                    with TRACE.span("idle check"):
+                        self.check()
+                    next_check = time.monotonic() + self.interval
+                storages = self.store.all()
+                self.arm_listeners(storages)
+                self.poll_paused(storages)
+                for key, _ in self.selector.select(timeout=1.0):
+                    self.wake(key.data)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for name in list(self.listeners):
+                self._disarm(name)
+
+
+def _splice_pump(src, dst, counter, key):
+    # Zero-copy relay: socket -> pipe -> socket with os.splice, the data never
+    # enters user space. Runs in a thread on blocking sockets.
+    r, w = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, 1 << 20)
+        except (OSError, AttributeError):
+            pass
+        while True:
+            n = os.splice(src.fileno(), w, 1 << 20)
+            if n == 0:
+                break
+            counter[key] += n
+            while n:
+                n -= os.splice(r, dst.fileno(), n)
+    except OSError:
+        pass
+    finally:
+        os.close(r)
+        os.close(w)
+        try:
+            dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class VNCGateway:
+    # Single-port VNC proxy (`gateway serve`). A client first sends one line
+    # with the storage's gateway token; the gateway resolves it to the
+    # vnc-<name> container, connects to <container ip>:5901 on the docker
+    # network and relays the rest. Storages started with `start <name> gateway`
+    # publish no port at all, so nothing needs allocating or opening per
+    # desktop. Paused or stopped desktops are woken on connect.
+    #
+    # Stock VNC clients can't send the token line, `connect` runs a local
+    # listener that adds it.
+
+    def __init__(self, manager, port=GATEWAY_PORT, bind="0.0.0.0", log=print):
+        self.manager = manager
+        self.store = manager.store
+        self.port = port
+        self.bind = bind
+        self.log = log
+        self.splice = hasattr(os, "splice")
+        self.sessions = 0
+
+    def _route(self, token):
+        for name, storage in self.store.all().items():
+            if storage.get("gateway_token") == token:
+                return name, storage
+        return None, None
+
+    def _upstream_addr(self, name, storage):
+        # blocking: may start or resume the desktop first
+        if storage.get("status") == "paused":
+            self.manager.resume(name, log=self.log)
+        elif storage.get("status") != "running":
+            self.log(f"{name}: not running, starting it for a gateway client")
+            mode = "gateway" if storage.get("gateway") or not storage.get("port") else str(storage["port"])
+            if not self.manager.start(name, mode, interactive=False, log=lambda m: None):
+                return None
+        insp = self.manager._docker_inspect(f"{CONTAINER_PREFIX}{name}") or {}
+        net = insp.get("NetworkSettings", {})
+        ip = net.get("IPAddress") or next(
+            (n.get("IPAddress") for n in (net.get("Networks") or {}).values() if n.get("IPAddress")), None)
+        return (ip, VNC_PORT) if ip else None
+
+    async def _connect(self, loop, addr, timeout=120.0):
+        # A just-started desktop takes a while to listen; the RFB greeting
+        # ("RFB 003.008\n", the server speaks first) says it is really up.
+        deadline = time.monotonic() + timeout
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, addr), 5)
+                greeting = await asyncio.wait_for(loop.sock_recv(sock, 4096), 10)
+                if greeting:
+                    return sock, greeting
+            except (OSError, asyncio.TimeoutError):
+                pass
+            sock.close()
+            if time.monotonic() >= deadline:
+                return None, None
+            await asyncio.sleep(0.5)
+
+    def _in_thread(self, loop, fn, *args):
+        # A thread of its own per relay direction: a session lasts as long as
+        # the client stays connected, and parking it in the default executor
+        # (min(32, cpus + 4) workers) would starve _upstream_addr and _record
+        # and stall every later session once that many were open.
+        fut = loop.create_future()
+
+        def done(result, error):
+            if not fut.done():
+                fut.set_exception(error) if error else fut.set_result(result)
+
+        def run():
+            result, error = None, None
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(done, result, error)
+            except RuntimeError:
+                pass  # the gateway's loop is gone already
+
+        threading.Thread(target=run, daemon=True).start()
+        return fut
+
+    async def _pump(self, loop, src, dst, counter, key):
+        try:
+            while True:
+                data = await loop.sock_recv(src, 65536)
+                if not data:
+                    break
+                counter[key] += len(data)
+                await loop.sock_sendall(dst, data)
+        except OSError:
+            pass
+        finally:
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    async def _handle(self, loop, client, peer):
+        t0 = time.monotonic()
+        upstream = None
+        session = {"storage": None, "client": f"{peer[0]}:{peer[1]}", "bytes_in": 0, "bytes_out": 0}
+        try:
+            buf = b""
+            while b"\n" not in buf and len(buf) < 256:
+                chunk = await asyncio.wait_for(loop.sock_recv(client, 256 - len(buf)), GATEWAY_PREAMBLE_TIMEOUT)
+                if not chunk:
+                    return
+                buf += chunk
+            token, _, rest = buf.partition(b"\n")
+            name, storage = self._route(token.decode(errors="replace").strip())
+            if name is None:
+                self.log(f"{session['client']}: unknown token, closing")
+                return
+            session["storage"] = name
+            addr = await loop.run_in_executor(None, self._upstream_addr, name, storage)
+            if addr is None:
+                self.log(f"{session['client']}: '{name}' has no reachable container")
+                return
+            upstream, greeting = await self._connect(loop, addr)
+            if upstream is None:
+                self.log(f"{session['client']}: '{name}' did not answer on {addr[0]}:{addr[1]}")
+                return
+            session["connect_ms"] = round((time.monotonic() - t0) * 1000, 1)
+            await loop.sock_sendall(client, greeting)
+            if rest:
+                await loop.sock_sendall(upstream, rest)
+            session["bytes_out"] += len(greeting)
+            session["bytes_in"] += len(rest)
+            self.log(f"{session['client']} -> {name} ({addr[0]}) connected in {session['connect_ms']} ms")
+            if self.splice:
+                for s in (client, upstream):
+                    s.setblocking(True)
+                await asyncio.gather(
+                    self._in_thread(loop, _splice_pump, client, upstream, session, "bytes_in"),
+                    self._in_thread(loop, _splice_pump, upstream, client, session, "bytes_out"),
+                )
+            else:
+                await asyncio.gather(
+                    self._pump(loop, client, upstream, session, "bytes_in"),
+                    self._pump(loop, upstream, client, session, "bytes_out"),
+                )
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            client.close()
+            if upstream:
+                upstream.close()
+            if session["storage"] and "connect_ms" in session:
+                session["duration_s"] = round(time.monotonic() - t0, 1)
+                session["ended"] = time.time()
+                await loop.run_in_executor(None, self._record, session)
+
+    def _record(self, session):
+        self.log(f"{session['client']} -> {session['storage']} closed after {session['duration_s']}s, "
+                 f"in {self.manager._format_bytes(session['bytes_in'])}, "
+                 f"out {self.manager._format_bytes(session['bytes_out'])}")
+        with self.store.transaction():
+            recent = self.store.get_meta("gateway_sessions", [])
+            recent = (recent + [session])[-GATEWAY_SESSION_LOG:]
+            self.store.set_meta("gateway_sessions", recent)
+            storage = self.store.get(session["storage"])
+            if storage is not None:
+                totals = dict(storage.get("gateway_stats") or {"sessions": 0, "bytes_in": 0, "bytes_out": 0})
+                totals["sessions"] += 1
+                totals["bytes_in"] += session["bytes_in"]
+                totals["bytes_out"] += session["bytes_out"]
+                totals["last_connect_ms"] = session["connect_ms"]
+                totals["last_session"] = session["ended"]
+                self.store.update(session["storage"], gateway_stats=totals)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.bind, self.port))
+        listener.listen(128)
+        listener.setblocking(False)
+        self.log(f"VNC gateway on {self.bind}:{self.port} "
+                 f"({'splice' if self.splice else 'userspace'} relay, Ctrl-C to quit)")
+        tasks = set()
+        with listener:
+            while True:
+                client, peer = await loop.sock_accept(listener)
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                task = loop.create_task(self._handle(loop, client, peer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+
+def gateway_connect(token, gateway=("127.0.0.1", GATEWAY_PORT), local_port=5901):
+    # Local side of the gateway for stock VNC clients: listens on
+    # 127.0.0.1:local_port and prefixes every connection with the token line.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", local_port))
+    listener.listen(8)
+    print(f"Point your VNC client at localhost:{local_port} (via {gateway[0]}:{gateway[1]}, Ctrl-C to quit)")
+
+    def relay(client):
+        try:
+            upstream = socket.create_connection(gateway, timeout=10)
+            upstream.settimeout(None)
+            upstream.sendall(token.encode() + b"\n")
+        except OSError as e:
+            print(f"Gateway unreachable: {e}")
+            client.close()
+            return
+        counter = {"in": 0, "out": 0}
+        t = threading.Thread(target=_splice_pump, args=(upstream, client, counter, "in"), daemon=True)
+        t.start()
+        _splice_pump(client, upstream, counter, "out")
+        t.join()
+        client.close()
+        upstream.close()
+
+    try:
+        with listener:
+            while True:
+                client, _ = listener.accept()
+                threading.Thread(target=relay, args=(client,), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+
+
 def print_usage():
     print("""
 ================================================================
@@ -543,13 +3397,101 @@ def print_usage():
 ================================================================
 
 USAGE:
-  python main.py create <name>          Create storage
-  python main.py start <name> [port]    Start VNC (default 2000)
+  python main.py create <name>          Create storage [--label key=value]... [--variant terminal]
+        [--size 20g]                    Bounded: a sparse ext4 image mounted on the storage dir;
+                                        writes past the size fail in that desktop only, and
+                                        list reads its usage with one statfs
+  python main.py resize <name> <size>   Grow (also while running) or shrink (stopped) a bounded storage
+  python main.py start <name> [port]    Start VNC (default 2000, 'auto' = next free)
   python main.py start <name> terminal  Terminal mode (persistent)
+  python main.py variant <name> [v]     Show or set the storage's image: desktop | terminal
+                                        (terminal: shell tools only, no X/VNC or GUI apps);
+                                        --force if the overlay already has changes
+  python main.py image [status]         Image variants, recorded build and whether it is current
+  python main.py image build [v] [--force]  Build now; start rebuilds (cached) when the
+                                        Dockerfile or .dockerignore changed
+  python main.py start <name> gateway   No published port, reached through the gateway
   python main.py stop <name>            Stop
+  python main.py label <name> k=v|k-    Set or remove storage labels
+  python main.py display <name>         Show or set the display profile, live when running:
+        [--preset lan|wan|low] [--geometry 1280x720] [--depth 16|24|32] [--fps 30]
+        [--encodings Tight|ZRLE|Hextile|Raw] [--compress 0-9] [--quality 0-9]
+  python main.py resources <name>       Show or set limits, 'none' clears one:
+        [--cpus 2] [--memory 4g] [--shm-size 1g] [--tmp-size 2g] [--run-size 64m]
+  python main.py start <name> --wait s  Queue up to s seconds for memory admission
+  python main.py pool resize <n>        Keep n warm containers for fast starts
+  python main.py pool status            Pool size and claim hit/miss rate
+  python main.py pool drain             Remove all warm containers
+
+BULK (start/stop/restart, automatic ports, no prompts):
+  python main.py start a b c            Several storages at once
+  python main.py stop --all             Everything
+  python main.py stop --status running  By status
+  python main.py restart 'web-*'        By glob
+  python main.py start --label team=qa  By label
+      --jobs N                          Parallelism (default 8, DESKTOP_BULK_JOBS)
   python main.py rename <old>:<new>     Rename storage
-  python main.py delete <name>          Delete storage (force if running)
-  python main.py list                   Detailed status and metrics
+  python main.py clone <src>:<new>      Copy-on-write copy [--reflink|--link|--copy]
+  python main.py snapshot <name> [snap] Take a snapshot, or list them without [snap]
+                                        (--delete <snap> removes one)
+  python main.py restore <name> <snap>  Roll a stopped storage back to a snapshot
+  python main.py export <name> [file|-]  Stream lower/ and upper/ as a tar (gz, or by
+        [--incremental] [--since manifest]   extension) of a stopped or paused storage to a
+        [--compress gz|xz|bz2|none]          file or stdout; --incremental only sends changes
+                                             since the last export
+  python main.py import <name> [file|-]  Apply a full export to a new storage, or the
+                                        next incremental one to a stopped storage
+  python main.py compact <name>|--all   Shrink stopped overlays: prune caches, drop files
+        [--dry-run] [--cache glob]      identical to the image, useless whiteouts, work/
+  python main.py dedup [--dry-run]      Share identical files across storages and
+                                        snapshots (reflinks; hard links if immutable)
+  python main.py delete <name>          Delete storage (force if running); its files are
+                                        freed in the background
+  python main.py reap [--jobs N] [--rate n]  Free deleted storages now (started by delete)
+  python main.py list [--deadline s]    Detailed status and metrics (default 30s budget)
+        [name|glob] [--status s] [--label k=v]   only these storages, filtered first
+        [--json | --format '{{.name}}\t{{.port}}'] [--fields name,status,port|all]
+                                        Machine-readable; only the requested fields are
+                                        collected (name/status/port = state only)
+  python main.py gateway serve [--port]  Single-port VNC proxy routing by token (5900)
+  python main.py gateway token <name> [--rotate]
+  python main.py gateway sessions       Recent sessions: bytes, connect latency
+  python main.py connect <name> [--gateway host:port] [--local port] [--token t]
+                                        Local listener for VNC clients (adds the token)
+  python main.py reconcile [--follow]   Sync state with docker once (cron), or keep it
+                                        in sync from docker's event stream
+  python main.py idle-watch            Pause idle desktops, resume them on connect
+        [--timeout s] [--cpu pct] [--action pause|stop] [--interval s]
+  python main.py top [--interval s]     Live CPU/RAM/net/block with 1m and 5m
+                     [--history s]      averages and peaks (alias: watch)
+
+  --trace[=file]                        Any command: record docker calls, probes and
+                                        scans as Chrome trace JSON (desktop-trace.json)
+
+ENVIRONMENT:
+  DESKTOP_DOCKER_BACKEND=auto|api|cli   Docker Engine socket API (default when
+                                        reachable) or the docker CLI
+  DESKTOP_LIST_DEADLINE=<seconds>       Time budget for `list` collectors
+  DESKTOP_TRACE=<file>                  Same as --trace=<file>
+  DESKTOP_MEMORY_COMMIT_RATIO=0.9       Refuse starts past this share of host RAM (0 = off)
+  DESKTOP_UNLIMITED_MEMORY=0            Counted for desktops without --memory (0 = not counted)
+  DESKTOP_GATEWAY_PORT=5900             Port for `gateway serve` and `connect`
+  DESKTOP_IDLE_TIMEOUT=1800             Seconds without a VNC client before idle-watch acts
+  DESKTOP_IDLE_CPU=5                    CPU % below which a desktop counts as idle
+  DESKTOP_IDLE_ACTION=pause|stop        pause (memory reclaimed) or stop, port kept
+  DESKTOP_CGROUP_ROOT=<dir>             cgroup v2 mount read for `list` metrics
+                                        (default /sys/fs/cgroup; docker stats on v1)
+  DESKTOP_COMPACT_CACHE=<globs>         ':'-separated cache paths `compact` prunes
+                                        (defaults: browser, thumbnail, apt caches, ...)
+  DESKTOP_DEDUP_MIN_SIZE=65536         Smaller files are left to `dedup`
+  DESKTOP_DEDUP_IMMUTABLE=<globs>       ':'-separated paths `dedup` may hard-link
+                                        (default: the pip http and npm content caches)
+  DESKTOP_REAP_JOBS=4                   Parallel unlinkers freeing deleted storages
+  DESKTOP_REAP_RATE=5000                Unlinks per second for the reaper (0 = no limit)
+  DESKTOP_REAP_IONICE=3                 ionice class for the reaper ('' = unchanged)
+  DESKTOP_STATE_BACKEND=sqlite|json     State store: storages.db (default, an
+                                        existing storages.json is migrated) or
+                                        the legacy storages.json
 
 EXAMPLES:
   python main.py create dev
@@ -559,33 +3501,347 @@ EXAMPLES:
 """)
 
 
+def build_context_files(context):
+    # Files `docker build` sends from context, sorted: .dockerignore patterns
+    # (the last one matching a path or one of its parents wins, '!' re-includes)
+    # minus pruned directories. Dockerfile and .dockerignore always go.
+    patterns = []
+    try:
+        with open(os.path.join(context, ".dockerignore")) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append((line.startswith("!"), os.path.normpath(line.lstrip("!").strip())))
+    except FileNotFoundError:
+        pass
+
+    def ignored(rel):
+        parts = rel.split("/")
+        out = False
+        for negated, pat in patterns:
+            if any(fnmatch.fnmatchcase("/".join(parts[:k]), pat) for k in range(1, len(parts) + 1)):
+                out = not negated
+        return out
+
+    files = []
+    for root, dirs, names in os.walk(context, onerror=lambda e: None):
+        rel_root = os.path.relpath(root, context)
+        prefix = "" if rel_root == "." else rel_root + "/"
+        # skip ignored directories nothing is re-included from
+        dirs[:] = [d for d in dirs if not ignored(prefix + d)
+                   or any(neg and pat.startswith(prefix + d + "/") for neg, pat in patterns)]
+        files.extend(prefix + n for n in names
+                     if prefix + n in ("Dockerfile", ".dockerignore") or not ignored(prefix + n))
+    return sorted(files)
+
+
+def parse_selection(args):
+    # Splits bulk-command arguments into name/glob patterns and options.
+    patterns = []
+    opts = {"all": False, "status": None, "labels": [], "jobs": BULK_JOBS}
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a == "--all":
+            opts["all"] = True
+        elif a in ("--status", "--label", "--jobs", "-j"):
+            if i + 1 >= len(args):
+                raise ValueError(f"{a} needs a value")
+            i += 1
+            if a == "--status":
+                opts["status"] = args[i]
+            elif a == "--label":
+                if '=' not in args[i]:
+                    raise ValueError("--label needs key=value")
+                opts["labels"].append(tuple(args[i].split('=', 1)))
+            else:
+                opts["jobs"] = int(args[i])
+        elif a.startswith("-"):
+            raise ValueError(f"Unknown option {a}")
+        else:
+            patterns.append(a)
+        i += 1
+    return patterns, opts
+
+
+def run_bulk(manager, action, args):
+    try:
+        patterns, opts = parse_selection(args)
+    except ValueError as e:
+        print(e)
+        print(f"Usage: python main.py {action} <name|glob>... [--all] [--status S] [--label k=v] [--jobs N]")
+        sys.exit(1)
+    names = manager.select_storages(patterns, opts["all"], opts["status"], opts["labels"])
+    if not manager.bulk(action, names, opts["jobs"]):
+        sys.exit(1)
+
+
 def main():
+    # --trace[=file] may appear anywhere; DESKTOP_TRACE=file does the same
+    for arg in list(sys.argv[1:]):
+        if arg == "--trace" or arg.startswith("--trace="):
+            TRACE.path = arg.partition("=")[2] or "desktop-trace.json"
+            sys.argv.remove(arg)
+    if TRACE.enabled:
+        docker_client.tracer = TRACE
+        atexit.register(TRACE.finish)
+
     if len(sys.argv) < 2:
         print_usage()
         sys.exit(1)
 
     command = sys.argv[1].lower()
+    with TRACE.span(command, "command", argv=" ".join(sys.argv[1:])):
+        run_command(command)
+
+
+def run_command(command):
     manager = StorageManager()
 
     if command == "create":
         if len(sys.argv) < 3:
-            print("Usage: python main.py create <name>")
+            print("Usage: python main.py create <name> [--label key=value]... [--variant desktop|terminal] "
+                  "[--size 20g]")
+            sys.exit(1)
+        args, variant, size = sys.argv[3:], None, None
+        if "--variant" in args:
+            i = args.index("--variant")
+            variant = args[i + 1] if i + 1 < len(args) else None
+            if variant not in IMAGE_VARIANTS:
+                print(f"--variant is one of {', '.join(IMAGE_VARIANTS)}")
+                sys.exit(1)
+            args = args[:i] + args[i + 2:]
+        if "--size" in args:
+            i = args.index("--size")
+            try:
+                size = parse_size(args[i + 1])
+            except (IndexError, ValueError) as e:
+                print(f"--size needs a size like 20g ({e})" if isinstance(e, ValueError) else "--size needs a value")
+                sys.exit(1)
+            args = args[:i] + args[i + 2:]
+        try:
+            _, opts = parse_selection(args)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        bulk_only = [a for a in args if a in ("--all", "--status", "--jobs", "-j")]
+        if bulk_only:
+            print(f"{bulk_only[0]} only applies to start, stop and restart; create takes one name")
             sys.exit(1)
-        manager.create(sys.argv[2])
+        manager.create(sys.argv[2], opts["labels"], variant=variant, size=size)
 
     elif command == "start":
         if len(sys.argv) < 3:
-            print("Usage: python main.py start <name> [port|terminal]")
+            print("Usage: python main.py start <name> [port|terminal|auto|gateway]")
+            print("       python main.py start <name|glob>... [--all] [--status S] [--label k=v] [--jobs N]")
             sys.exit(1)
-        name = sys.argv[2]
-        port_or_mode = sys.argv[3] if len(sys.argv) > 3 else "2000"
-        manager.start(name, port_or_mode)
+        args = sys.argv[2:]
+        wait = 0
+        if "--wait" in args:
+            i = args.index("--wait")
+            try:
+                wait = float(args[i + 1])
+            except (IndexError, ValueError):
+                print("Usage: python main.py start <name> [port|auto] --wait seconds")
+                sys.exit(1)
+            del args[i:i + 2]
+        single = len(args) == 1 and not args[0].startswith("-") and not any(c in args[0] for c in "*?[")
+        if len(args) == 2 and (args[1].isdigit() or args[1] in ("terminal", "auto", "gateway")):
+            single = True
+        if single:
+            port_or_mode = args[1] if len(args) > 1 else None
+            if not manager.start(args[0], port_or_mode, wait=wait):
+                sys.exit(1)
+        else:
+            run_bulk(manager, "start", args)
 
     elif command == "stop":
         if len(sys.argv) < 3:
-            print("Usage: python main.py stop <name>")
+            print("Usage: python main.py stop <name|glob>... [--all] [--status S] [--label k=v] [--jobs N]")
+            sys.exit(1)
+        args = sys.argv[2:]
+        if len(args) == 1 and not args[0].startswith("-") and not any(c in args[0] for c in "*?["):
+            manager.stop(args[0])
+        else:
+            run_bulk(manager, "stop", args)
+
+    elif command == "restart":
+        if len(sys.argv) < 3:
+            print("Usage: python main.py restart <name|glob>... [--all] [--status S] [--label k=v] [--jobs N]")
+            sys.exit(1)
+        run_bulk(manager, "restart", sys.argv[2:])
+
+    elif command == "pool":
+        sub = sys.argv[2] if len(sys.argv) > 2 else "status"
+        if sub == "status":
+            manager.pool_status()
+        elif sub == "fill":
+            manager.pool_fill()
+        elif sub == "resize" and len(sys.argv) > 3 and sys.argv[3].isdigit():
+            manager.pool_resize(int(sys.argv[3]))
+        elif sub == "drain":
+            manager.pool_resize(0)
+        else:
+            print("Usage: python main.py pool [status|fill|resize <n>|drain]")
+            sys.exit(1)
+
+    elif command == "label":
+        if len(sys.argv) < 4:
+            print("Usage: python main.py label <name> key=value|key- ...")
+            sys.exit(1)
+        manager.set_labels(sys.argv[2], sys.argv[3:])
+
+    elif command == "display":
+        if len(sys.argv) < 3:
+            print("Usage: python main.py display <name> [--preset P] [--geometry WxH] [--depth N] [--fps N] "
+                  "[--encodings E] [--compress 0-9] [--quality 0-9]")
+            sys.exit(1)
+        if not manager.set_display(sys.argv[2], sys.argv[3:]):
+            sys.exit(1)
+
+    elif command == "resize":
+        try:
+            size = parse_size(sys.argv[3])
+        except (IndexError, ValueError):
+            print("Usage: python main.py resize <name> <size>   (e.g. 40g; shrinking needs it stopped)")
+            sys.exit(1)
+        if not manager.resize(sys.argv[2], size):
+            sys.exit(1)
+
+    elif command == "variant":
+        args = [a for a in sys.argv[2:] if a != "--force"]
+        if len(args) not in (1, 2):
+            print(f"Usage: python main.py variant <name> [{'|'.join(IMAGE_VARIANTS)}] [--force]")
+            sys.exit(1)
+        if not manager.set_variant(args[0], args[1] if len(args) == 2 else None, force="--force" in sys.argv):
+            sys.exit(1)
+
+    elif command == "image":
+        sub = sys.argv[2] if len(sys.argv) > 2 else "status"
+        if sub == "status":
+            manager.image_status()
+        elif sub == "build":
+            variants = [a for a in sys.argv[3:] if not a.startswith("--")] or list(IMAGE_VARIANTS)
+            unknown = [v for v in variants if v not in IMAGE_VARIANTS]
+            if unknown:
+                print(f"Unknown variant(s): {', '.join(unknown)} (one of {', '.join(IMAGE_VARIANTS)})")
+                sys.exit(1)
+            for variant in variants:
+                if not manager.ensure_image(variant, force="--force" in sys.argv):
+                    sys.exit(1)
+        else:
+            print("Usage: python main.py image [status|build [variant...] [--force]]")
+            sys.exit(1)
+
+    elif command == "resources":
+        if len(sys.argv) < 3:
+            print("Usage: python main.py resources <name> [--cpus N] [--memory SIZE] [--shm-size SIZE] "
+                  "[--tmp-size SIZE] [--run-size SIZE]")
+            sys.exit(1)
+        if not manager.set_resources(sys.argv[2], sys.argv[3:]):
+            sys.exit(1)
+
+    elif command in ("clone", "snapshot", "restore"):
+        methods = [a[2:] for a in sys.argv[3:] if a[2:] in layers.METHODS and a.startswith("--")]
+        args = [a for a in sys.argv[2:] if not a.startswith("--")]
+        method = methods[0] if methods else None
+        if command == "clone" and len(args) == 1:
+            ok = manager.clone(args[0], method)
+        elif command == "snapshot" and len(args) == 1:
+            manager.list_snapshots(args[0])
+            ok = True
+        elif command == "snapshot" and len(args) == 2 and "--delete" in sys.argv:
+            ok = manager.delete_snapshot(args[0], args[1])
+        elif command == "snapshot" and len(args) == 2:
+            ok = manager.snapshot(args[0], args[1], method)
+        elif command == "restore" and len(args) == 2:
+            ok = manager.restore(args[0], args[1], method)
+        else:
+            print("Usage: python main.py clone <src>:<new> [--reflink|--link|--copy]")
+            print("       python main.py snapshot <name> [<snap> [--delete]]")
+            print("       python main.py restore <name> <snap>")
+            sys.exit(1)
+        if not ok:
+            sys.exit(1)
+
+    elif command == "export":
+        args, opts, i = [], {"incremental": False, "since": None, "compression": None}, 2
+        while i < len(sys.argv):
+            a = sys.argv[i]
+            if a == "--incremental":
+                opts["incremental"] = True
+            elif a in ("--since", "--compress") and i + 1 < len(sys.argv):
+                i += 1
+                opts["since" if a == "--since" else "compression"] = sys.argv[i]
+            else:
+                args.append(a)
+            i += 1
+        if len(args) not in (1, 2) or opts["compression"] not in (None, *archive.COMPRESSION):
+            print("Usage: python main.py export <name> [file|-] [--incremental] [--since manifest] "
+                  "[--compress gz|xz|bz2|none]")
+            sys.exit(1)
+        if not manager.export(args[0], args[1] if len(args) > 1 else None, **opts):
+            sys.exit(1)
+
+    elif command == "import":
+        if len(sys.argv) not in (3, 4):
+            print("Usage: python main.py import <name> [file|-]")
+            sys.exit(1)
+        if not manager.import_storage(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None):
+            sys.exit(1)
+
+    elif command == "compact":
+        args, globs, i = [], [], 2
+        while i < len(sys.argv):
+            if sys.argv[i] == "--cache" and i + 1 < len(sys.argv):
+                i += 1
+                globs.append(sys.argv[i])
+            elif sys.argv[i] != "--dry-run":
+                args.append(sys.argv[i])
+            i += 1
+        try:
+            patterns, opts = parse_selection(args)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        names = manager.select_storages(patterns, opts["all"], opts["status"], opts["labels"])
+        if not names:
+            print("Usage: python main.py compact <name|glob>...|--all [--dry-run] [--cache glob]...")
+            sys.exit(1)
+        if not manager.compact(names, "--dry-run" in sys.argv, globs):
+            sys.exit(1)
+
+    elif command == "reconcile":
+        if sys.argv[2:] not in ([], ["--follow"]):
+            print("Usage: python main.py reconcile [--follow]")
+            sys.exit(1)
+        reconciler = Reconciler(manager)
+        if sys.argv[2:]:
+            reconciler.run()
+        else:
+            print(f"{reconciler.reconcile()} storage(s) fixed")
+
+    elif command == "reap":
+        opts, i = {"jobs": REAP_JOBS, "rate": REAP_RATE}, 2
+        while i < len(sys.argv):
+            if sys.argv[i] in ("--jobs", "--rate") and i + 1 < len(sys.argv):
+                try:
+                    opts[sys.argv[i][2:]] = (int if sys.argv[i] == "--jobs" else float)(sys.argv[i + 1])
+                except ValueError:
+                    print(f"Invalid value for {sys.argv[i]}: {sys.argv[i + 1]}")
+                    sys.exit(1)
+                i += 2
+            else:
+                print("Usage: python main.py reap [--jobs N] [--rate unlinks/s]")
+                sys.exit(1)
+        manager.reap(**opts)
+
+    elif command == "dedup":
+        if any(a != "--dry-run" for a in sys.argv[2:]):
+            print("Usage: python main.py dedup [--dry-run]")
+            sys.exit(1)
+        if not manager.dedup(dry_run="--dry-run" in sys.argv[2:]):
             sys.exit(1)
-        manager.stop(sys.argv[2])
 
     elif command == "rename":
         if len(sys.argv) < 3:
@@ -600,7 +3856,123 @@ def main():
         manager.delete(sys.argv[2])
 
     elif command == "list":
-        manager.list_storages()
+        usage = ("Usage: python main.py list [name|glob ...] [--status s] [--label k=v] [--deadline seconds]\n"
+                 "                           [--json | --format '{{.name}} {{.port}}'] [--fields a,b|all]")
+        deadline, output, template, fields, rest, i = LIST_DEADLINE, None, None, None, [], 2
+        try:
+            while i < len(sys.argv):
+                a = sys.argv[i]
+                if a == "--json":
+                    output = "json"
+                elif a in ("--deadline", "--format", "--fields"):
+                    value = sys.argv[i + 1]
+                    i += 1
+                    if a == "--deadline":
+                        deadline = float(value)
+                    elif a == "--format":
+                        output, template = ("json", None) if value == "json" else ("format", value)
+                    else:
+                        fields = list(LIST_FIELDS) if value == "all" else [f for f in value.split(",") if f]
+                else:
+                    rest.append(a)
+                i += 1
+            patterns, opts = parse_selection(rest)
+        except (IndexError, ValueError) as e:
+            if isinstance(e, ValueError):
+                print(e)
+            print(usage)
+            sys.exit(1)
+        names = None
+        if patterns or opts["status"] or opts["labels"]:
+            names = manager.select_storages(patterns, True, opts["status"], opts["labels"])
+        if output is None:
+            manager.list_storages(deadline, names)
+        else:
+            if fields is None:
+                fields = re.findall(r"\{\{\s*\.(\w+)\s*\}\}", template) if template else list(DEFAULT_LIST_FIELDS)
+            unknown = [f for f in fields if f not in LIST_FIELDS]
+            if unknown:
+                print(f"Unknown field(s): {', '.join(unknown)}. Available: {', '.join(LIST_FIELDS)}")
+                sys.exit(1)
+            records = manager.list_records(names if names is not None else list(manager.store.all()),
+                                           fields, deadline)
+            if output == "json":
+                print(json.dumps(records, indent=2))
+            else:
+                for rec in records:
+                    print(re.sub(r"\{\{\s*\.(\w+)\s*\}\}", lambda m: "" if rec.get(m.group(1)) is None else (
+                        json.dumps(rec[m.group(1)]) if isinstance(rec[m.group(1)], (dict, list))
+                        else str(rec[m.group(1)])), template.replace("\\t", "\t")))
+
+    elif command == "gateway":
+        sub = sys.argv[2] if len(sys.argv) > 2 else "serve"
+        if sub == "serve":
+            port = GATEWAY_PORT
+            if "--port" in sys.argv:
+                try:
+                    port = int(sys.argv[sys.argv.index("--port") + 1])
+                except (IndexError, ValueError):
+                    print("Usage: python main.py gateway serve [--port N]")
+                    sys.exit(1)
+            VNCGateway(manager, port).run()
+        elif sub == "token" and len(sys.argv) > 3:
+            token = manager.gateway_token(sys.argv[3], rotate="--rotate" in sys.argv)
+            if token is None:
+                print(f"Storage '{sys.argv[3]}' does not exist")
+                sys.exit(1)
+            print(token)
+        elif sub == "sessions":
+            sessions = manager.store.get_meta("gateway_sessions", [])
+            if not sessions:
+                print("No gateway sessions recorded")
+            for s in sessions:
+                ended = datetime.fromtimestamp(s["ended"]).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"{ended}  {s['storage']:<20} {s['client']:<22} connect {s['connect_ms']:>7} ms  "
+                      f"{s['duration_s']:>8}s  in {manager._format_bytes(s['bytes_in']):>12}  "
+                      f"out {manager._format_bytes(s['bytes_out']):>12}")
+        else:
+            print("Usage: python main.py gateway [serve [--port N]|token <name> [--rotate]|sessions]")
+            sys.exit(1)
+
+    elif command == "connect":
+        if len(sys.argv) < 3:
+            print("Usage: python main.py connect <name> [--gateway host:port] [--local port] [--token t]")
+            sys.exit(1)
+        opts = dict(zip(sys.argv[3::2], sys.argv[4::2]))
+        token = opts.get("--token") or manager.gateway_token(sys.argv[2])
+        if not token:
+            print(f"Storage '{sys.argv[2]}' does not exist here, pass --token")
+            sys.exit(1)
+        host, _, port = opts.get("--gateway", f"127.0.0.1:{GATEWAY_PORT}").rpartition(":")
+        gateway_connect(token, (host or "127.0.0.1", int(port)), int(opts.get("--local", 5901)))
+
+    elif command == "idle-watch":
+        opts = {"--timeout": IDLE_TIMEOUT, "--cpu": IDLE_CPU_THRESHOLD, "--action": IDLE_ACTION,
+                "--interval": IDLE_INTERVAL}
+        args = sys.argv[2:]
+        try:
+            for i in range(0, len(args), 2):
+                if args[i] not in opts:
+                    raise ValueError(args[i])
+                opts[args[i]] = args[i + 1] if args[i] == "--action" else float(args[i + 1])
+            if opts["--action"] not in ("pause", "stop"):
+                raise ValueError(opts["--action"])
+        except (IndexError, ValueError):
+            print("Usage: python main.py idle-watch [--timeout s] [--cpu pct] [--action pause|stop] [--interval s]")
+            sys.exit(1)
+        IdleWatcher(manager, opts["--timeout"], opts["--cpu"], opts["--action"], opts["--interval"]).run()
+
+    elif command in ("top", "watch"):
+        interval, seconds = TOP_INTERVAL, TOP_HISTORY
+        try:
+            if "--interval" in sys.argv:
+                interval = float(sys.argv[sys.argv.index("--interval") + 1])
+            if "--history" in sys.argv:
+                seconds = int(sys.argv[sys.argv.index("--history") + 1])
+        except (IndexError, ValueError):
+            print("Usage: python main.py top [--interval seconds] [--history seconds]")
+            sys.exit(1)
+        manager.top(interval, seconds)
 
     elif command == "help":
         print_usage()
@@ -0,0 +1,33 @@
+import main
+
+
+def _manager(monkeypatch, statuses):
+    monkeypatch.setattr(main.cgroup_stats, "host_mem_total", lambda: 8 << 30)
+    monkeypatch.setattr(main, "MEMORY_COMMIT_RATIO", 1.0)
+    manager = main.StorageManager()
+    for name, status in statuses.items():
+        manager.create(name, log=lambda msg: None)
+        manager.store.update(name, status=status, resources={"memory": 3 << 30})
+    manager.create("new", log=lambda msg: None)
+    manager.store.update("new", resources={"memory": 3 << 30})
+    return manager
+
+
+def test_admits_within_budget(workdir, monkeypatch):
+    manager = _manager(monkeypatch, {"a": "running", "b": "stopped"})
+    assert manager.admit("new", log=lambda msg: None)
+
+
+def test_paused_desktops_stay_committed(workdir, monkeypatch):
+    manager = _manager(monkeypatch, {"a": "running", "b": "paused"})
+    messages = []
+    assert not manager.admit("new", log=messages.append)
+    assert "would exceed" in messages[0]
+
+
+def test_unlimited_desktops_count_nothing_by_default(workdir, monkeypatch):
+    manager = _manager(monkeypatch, {"a": "running"})
+    for name in ("b", "c", "d"):
+        manager.create(name, log=lambda msg: None)
+        manager.store.update(name, status="running")
+    assert manager.admit("new", log=lambda msg: None)
@@ -0,0 +1,183 @@
+import io
+import json
+import os
+import stat
+import tarfile
+
+import pytest
+
+import archive
+
+
+def _tree(root):
+    # {relative path: (kind, content or link target, mode, mtime_ns)}
+    out = {}
+    for dirpath, dirs, files in os.walk(root):
+        for n in dirs + files:
+            p = os.path.join(dirpath, n)
+            st = os.lstat(p)
+            rel = os.path.relpath(p, root)
+            if stat.S_ISLNK(st.st_mode):
+                out[rel] = ("l", os.readlink(p), None, None)
+            elif stat.S_ISDIR(st.st_mode):
+                out[rel] = ("d", None, stat.S_IMODE(st.st_mode), st.st_mtime_ns)
+            else:
+                with open(p, 'rb') as f:
+                    out[rel] = ("f", f.read(), stat.S_IMODE(st.st_mode), st.st_mtime_ns)
+    return out
+
+
+def _write(path, data=b"x", mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def _export(src, tmp_path, tag, previous=None):
+    buf = io.BytesIO()
+    manifest = str(tmp_path / f"manifest-{tag}.jsonl")
+    result = archive.export(str(src), buf, "gz", previous, manifest, "s")
+    buf.seek(0)
+    return buf, manifest, result
+
+
+def test_full_round_trip(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "upper/home/user/a.txt"), b"hello", 0o600)
+    _write(str(src / "upper/bin/tool"), b"#!/bin/sh\n", 0o755)
+    _write(str(src / "lower/etc/conf"), b"lower")
+    os.symlink("a.txt", src / "upper/home/user/link")
+    os.link(src / "upper/bin/tool", src / "upper/bin/tool2")
+    os.utime(src / "upper/home/user/a.txt", ns=(1_600_000_000_123_456_789, 1_600_000_000_123_456_789))
+
+    buf, _, result = _export(src, tmp_path, 1)
+    assert result["base"] is None
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    imported = archive.import_(str(dst), buf)
+    assert imported["id"] == result["id"]
+    assert _tree(dst / "upper") == _tree(src / "upper")
+    assert _tree(dst / "lower") == _tree(src / "lower")
+    assert os.stat(dst / "upper/bin/tool").st_ino == os.stat(dst / "upper/bin/tool2").st_ino
+
+
+def test_incremental_chain(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "upper/keep"), b"same")
+    _write(str(src / "upper/change"), b"v1")
+    _write(str(src / "upper/gone/deep/file"), b"bye")
+    buf1, manifest1, first = _export(src, tmp_path, 1)
+
+    _write(str(src / "upper/change"), b"version 2")
+    os.unlink(src / "upper/gone/deep/file")
+    os.rmdir(src / "upper/gone/deep")
+    os.rmdir(src / "upper/gone")
+    _write(str(src / "upper/new"), b"new")
+    buf2, _, second = _export(src, tmp_path, 2, previous=manifest1)
+    assert second["base"] == first["id"]
+    assert second["deleted"] == 3
+    # unchanged files are not sent again
+    assert second["sent"] < second["entries"]
+
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    archive.import_(str(dst), buf1)
+    archive.import_(str(dst), buf2, expect_base=first["id"])
+    assert _tree(dst / "upper") == _tree(src / "upper")
+
+
+def test_incremental_directory_replaced_by_file(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "upper/x/a"), b"child")
+    _write(str(src / "upper/x/b/c"), b"grandchild")
+    buf1, manifest1, first = _export(src, tmp_path, 1)
+
+    for p in ("x/a", "x/b/c"):
+        os.unlink(src / "upper" / p)
+    os.rmdir(src / "upper/x/b")
+    os.rmdir(src / "upper/x")
+    _write(str(src / "upper/x"), b"now a file")
+    buf2, _, second = _export(src, tmp_path, 2, previous=manifest1)
+
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    archive.import_(str(dst), buf1)
+    result = archive.import_(str(dst), buf2, expect_base=first["id"])
+    assert result["id"] == second["id"]
+    assert _tree(dst / "upper") == _tree(src / "upper")
+
+
+def test_import_refuses_out_of_order(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "upper/f"), b"1")
+    _, manifest1, _ = _export(src, tmp_path, 1)
+    buf2, _, _ = _export(src, tmp_path, 2, previous=manifest1)
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    try:
+        archive.import_(str(dst), buf2)
+    except ValueError as e:
+        assert "builds on" in str(e)
+    else:
+        raise AssertionError("an incremental export applied to an empty storage")
+
+
+def _crafted(members, base=None):
+    # an export stream built by hand: (name, kind, data or link target)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w|") as tar:
+        for name, kind, data in [(archive.HEADER_MEMBER, "f", json.dumps({"id": "x", "base": base}))] + members:
+            info = tarfile.TarInfo(name)
+            if kind == "f":
+                data = data.encode()
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                continue
+            info.type = {"d": tarfile.DIRTYPE, "l": tarfile.SYMTYPE, "h": tarfile.LNKTYPE}[kind]
+            info.mode = 0o755
+            info.linkname = data or ""
+            tar.addfile(info)
+    buf.seek(0)
+    return buf
+
+
+@pytest.mark.parametrize("members", [
+    # through a symlink that came earlier in the stream
+    [("upper", "d", None), ("upper/evil", "l", "{outside}"), ("upper/evil/pwned", "f", "x")],
+    # through a symlinked layer
+    [("upper", "l", "{outside}"), ("upper/pwned", "f", "x")],
+    # a hard link to a file reached through a symlink
+    [("upper", "d", None), ("upper/evil", "l", "{outside}"), ("upper/pwned", "h", "upper/evil/victim")],
+])
+def test_import_stays_inside_the_storage(tmp_path, members):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    _write(str(outside / "victim"), b"host file")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    members = [(n, k, d.format(outside=outside) if d else d) for n, k, d in members]
+    with pytest.raises(ValueError, match="refusing"):
+        archive.import_(str(dst), _crafted(members))
+    assert sorted(os.listdir(outside)) == ["victim"]
+    assert os.stat(outside / "victim").st_nlink == 1
+
+
+def test_deletions_stay_inside_the_storage(tmp_path):
+    outside = tmp_path / "outside"
+    _write(str(outside / "victim"), b"host file")
+    dst = tmp_path / "dst"
+    _write(str(dst / "upper/keep"), b"keep")
+    os.symlink(outside, dst / "upper/evil")
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w|") as tar:
+        for name, data in ((archive.HEADER_MEMBER, {"id": "y", "base": "x"}),
+                           (archive.DELETED_MEMBER, "upper/evil/victim")):
+            data = json.dumps(data).encode() + b"\n"
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    with pytest.raises(ValueError, match="refusing"):
+        archive.import_(str(dst), buf, expect_base="x")
+    assert os.path.exists(outside / "victim")
@@ -0,0 +1,43 @@
+import os
+
+import dedup
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _run(tmp_path, rels):
+    # each path gets its own content, the same in both layers
+    for rel in rels:
+        data = os.urandom(dedup.MIN_SIZE)
+        for layer in ("a", "b"):
+            _write(os.path.join(tmp_path, layer, rel), data)
+    index = dedup.HashIndex(str(tmp_path / "dedup.db"))
+    try:
+        layer_list = [dedup.Layer(str(tmp_path / n), n, "globs") for n in ("a", "b")]
+        return dedup.run(layer_list, index, log=lambda msg: None)
+    finally:
+        index.close()
+
+
+def _same(tmp_path, rel):
+    return os.path.samefile(tmp_path / "a" / rel, tmp_path / "b" / rel)
+
+
+def test_content_caches_are_linked(tmp_path):
+    npm = "root/.npm/_cacache/content-v2/sha512/ab/cd/ef"
+    pip = "home/u/.cache/pip/http-v2/a/b/c/d/e/0123.body"
+    totals = _run(tmp_path, [npm, pip])
+    assert totals["linked"] == 2
+    assert _same(tmp_path, npm) and _same(tmp_path, pip)
+
+
+def test_writable_files_are_not_linked(tmp_path):
+    rels = ["root/.vscode/extensions/x/dist/main.js", "root/dl/pkg-1.0-py3-none-any.whl",
+            "root/.cache/ms-playwright/chromium/chrome"]
+    totals = _run(tmp_path, rels)
+    assert totals["linked"] == 0
+    assert not any(_same(tmp_path, rel) for rel in rels)
@@ -0,0 +1,100 @@
+import json
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import docker_client
+
+CONTAINERS = {f"vnc-{i}": {"Id": f"{i:064x}", "Name": f"/vnc-{i}", "State": {"Running": True}} for i in range(20)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # just enough of the Engine API, one keep-alive connection per client socket
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, obj):
+        body = obj if isinstance(obj, bytes) else json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.connections.add(id(self.connection))
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            path = self.path.split("?")[0]
+            if path == "/_ping":
+                return self._send(200, b"OK")
+            if path == "/containers/json":
+                return self._send(200, [{"Id": c["Id"], "Names": [c["Name"]], "State": "running",
+                                         "Ports": [{"PrivatePort": 5901, "PublicPort": 2000 + i}]}
+                                        for i, c in enumerate(CONTAINERS.values())])
+            if path.startswith("/containers/") and path.endswith("/json"):
+                doc = CONTAINERS.get(path.split("/")[2])
+                if doc is None:
+                    return self._send(404, {"message": f"No such container: {path.split('/')[2]}"})
+                return self._send(200, doc)
+            self._send(500, {"message": "unexpected request"})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def engine(tmp_path):
+    server = _Server(str(tmp_path / "docker.sock"), _Handler)
+    server.lock = threading.Lock()
+    server.requests, server.connections = [], set()
+    server.in_flight = server.peak = 0
+    server.delay = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = docker_client.DockerAPI(server.server_address, pool_size=4)
+    yield server, api
+    api.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_ping_and_containers(engine):
+    server, api = engine
+    assert api.ping()
+    listed = api.containers("vnc-")
+    assert len(listed) == 20
+    assert listed[3] == {"id": CONTAINERS["vnc-3"]["Id"], "name": "vnc-3", "state": "running", "ports": [2003]}
+    # both requests went over one keep-alive connection
+    assert len(server.connections) == 1
+
+
+def test_inspect_fans_out_over_the_pool(engine):
+    server, api = engine
+    server.delay = 0.05
+    names = list(CONTAINERS) + ["vnc-missing"]
+    docs = api.inspect(names)
+    assert docs == CONTAINERS
+    assert len(server.requests) == len(names)
+    assert 1 < server.peak <= api.pool_size
+    assert len(server.connections) <= api.pool_size
+
+
+def test_not_found(engine):
+    _, api = engine
+    with pytest.raises(docker_client.NotFound):
+        api.request("GET", "/containers/nope/json")
+    assert api.inspect([]) == {}
@@ -0,0 +1,96 @@
+import asyncio
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import main
+
+SESSIONS = 8
+GREETING = b"RFB 003.008\n"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _echo_upstream():
+    # a VNC server stand-in: greets, then echoes everything back
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def serve(conn):
+        with conn:
+            conn.sendall(GREETING)
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def _start_gateway(workdir, upstream_addr, workers):
+    store = main.SQLiteStateStore(str(workdir / "storages.db"))
+    store.insert("d1", {"path": str(workdir / "d1"), "status": "running", "gateway_token": "tok"})
+    manager = SimpleNamespace(store=store, _format_bytes=lambda n: f"{n} B")
+    gw = main.VNCGateway(manager, port=_free_port(), bind="127.0.0.1", log=lambda msg: None)
+    gw._upstream_addr = lambda name, storage: upstream_addr
+    loop = asyncio.new_event_loop()
+    # as small as asyncio's default on a 1-CPU host
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    threading.Thread(target=loop.run_until_complete, args=(gw.serve(),), daemon=True).start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", gw.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return gw, store
+
+
+def test_concurrent_sessions_all_relay(workdir):
+    upstream = _echo_upstream()
+    gw, store = _start_gateway(workdir, upstream.getsockname(), workers=2)
+    clients = []
+    try:
+        for i in range(SESSIONS):
+            c = socket.create_connection(("127.0.0.1", gw.port), timeout=5)
+            c.sendall(b"tok\n")
+            assert c.recv(len(GREETING)) == GREETING, f"session {i} got no greeting"
+            clients.append(c)
+        # every session stays open while all of them relay
+        for i, c in enumerate(clients):
+            msg = f"hello {i}".encode()
+            c.sendall(msg)
+            got = b""
+            while len(got) < len(msg):
+                chunk = c.recv(64)
+                assert chunk, f"session {i} closed"
+                got += chunk
+            assert got == msg
+    finally:
+        for c in clients:
+            c.close()
+        upstream.close()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and len(store.get_meta("gateway_sessions", [])) < SESSIONS:
+        time.sleep(0.05)
+    sessions = store.get_meta("gateway_sessions", [])
+    assert len(sessions) == SESSIONS
+    assert all(s["bytes_out"] >= len(GREETING) for s in sessions)
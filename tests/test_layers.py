@@ -0,0 +1,78 @@
+import os
+import stat
+
+import pytest
+
+import layers
+
+
+def _write(path, data=b"x", mode=0o644):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def _whiteout(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.mknod(path, stat.S_IFCHR | 0o000, os.makedev(0, 0))
+    except PermissionError:
+        pytest.skip("whiteouts need CAP_MKNOD")
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _tree(tmp_path):
+    src = tmp_path / "src"
+    _write(str(src / "etc" / "conf"), b"conf", 0o600)
+    _write(str(src / "bin" / "tool"), b"#!/bin/sh\n", 0o755)
+    os.link(src / "bin" / "tool", src / "bin" / "tool2")
+    os.symlink("tool", src / "bin" / "alias")
+    _whiteout(str(src / "etc" / "gone"))
+    os.utime(src / "etc", ns=(1_000_000_000, 1_000_000_000))
+    return src
+
+
+@pytest.mark.parametrize("method", ["copy", "link"])
+def test_copy_tree(tmp_path, method):
+    src = _tree(tmp_path)
+    dst = tmp_path / "dst"
+    totals = layers.copy_tree(str(src), str(dst), method)
+    assert totals == {"files": 4, "dirs": 3, "bytes": 4 + 10 + 10 + 4, "whiteouts": 1}
+    assert _read(dst / "etc" / "conf") == b"conf"
+    assert stat.S_IMODE(os.stat(dst / "etc" / "conf").st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(dst / "bin" / "tool").st_mode) == 0o755
+    assert os.readlink(dst / "bin" / "alias") == "tool"
+    assert layers.is_whiteout(os.lstat(dst / "etc" / "gone"))
+    assert os.stat(dst / "etc").st_mtime_ns == 1_000_000_000
+    # hard links inside the tree stay hard links
+    assert os.path.samefile(dst / "bin" / "tool", dst / "bin" / "tool2")
+    assert os.path.samefile(src / "etc" / "conf", dst / "etc" / "conf") == (method == "link")
+
+
+def test_squash(tmp_path):
+    upper, lower = tmp_path / "upper", tmp_path / "lower"
+    _write(str(lower / "etc" / "a"), b"old a")
+    _write(str(lower / "etc" / "b"), b"b")
+    _write(str(lower / "opt" / "app" / "old"), b"old")
+    _write(str(lower / "var" / "file-then-dir"), b"file")
+    _write(str(upper / "etc" / "a"), b"new a")
+    _write(str(upper / "etc" / "c"), b"c")
+    _whiteout(str(upper / "etc" / "b"))
+    _write(str(upper / "opt" / "app" / "new"), b"new")
+    os.setxattr(upper / "opt" / "app", "user.overlay.opaque", b"y")
+    _write(str(upper / "var" / "file-then-dir" / "x"), b"x")
+
+    assert layers.squash(str(upper), str(lower)) == 5
+    assert os.listdir(upper) == []
+    assert _read(lower / "etc" / "a") == b"new a"
+    assert _read(lower / "etc" / "c") == b"c"
+    # whiteouts and opaque directories stay: lower/ still sits on the image
+    assert layers.is_whiteout(os.lstat(lower / "etc" / "b"))
+    assert os.listdir(lower / "opt" / "app") == ["new"]
+    assert layers.is_opaque(str(lower / "opt" / "app"))
+    assert _read(lower / "var" / "file-then-dir" / "x") == b"x"
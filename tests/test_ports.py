@@ -0,0 +1,49 @@
+import socket
+
+import main
+
+
+def test_allocator_bitmap():
+    allocator = main.PortAllocator({2000, 2001, 2003, 0, 70000})
+    assert not allocator.is_free(2000)
+    assert allocator.is_free(2002)
+    assert not allocator.is_free(0) and not allocator.is_free(65536)
+    assert allocator.next_free(2000) == 2002
+    allocator.claim(2002)
+    assert allocator.next_free(2000) == 2004
+    assert allocator.next_free(2000, 2003) == -1
+    assert allocator.next_free(10, 5) == -1
+
+
+def test_allocator_top_of_range():
+    allocator = main.PortAllocator(range(65000, 65536))
+    assert allocator.next_free(65000) == -1
+    assert main.PortAllocator().next_free(65535) == 65535
+
+
+def test_next_free_port_skips_bound_sockets(workdir):
+    # a bound socket that is not listening is invisible to the snapshot;
+    # the bind probe has to catch it
+    held = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    held.bind(("0.0.0.0", 0))
+    port = held.getsockname()[1]
+    try:
+        manager = main.StorageManager()
+        allocator = main.PortAllocator()
+        assert allocator.is_free(port)
+        assert manager.find_next_free_port(port, allocator=allocator) > port
+    finally:
+        held.close()
+
+
+def test_reserve_port_moves_past_other_reservations(workdir):
+    manager = main.StorageManager()
+    manager.store.reserve_port(23000, "a")
+    messages = []
+    got = manager.reserve_port("b", 23000, main.PortAllocator(), log=messages.append)
+    assert got > 23000
+    assert "just claimed" in messages[0]
+    assert manager.store.reserved_ports(exclude="b") == {23000}
+    assert manager.store.reserved_ports() == {23000, got}
+    # the storage's own reservation does not count against it
+    assert manager.reserve_port("a", 23000, main.PortAllocator()) == 23000
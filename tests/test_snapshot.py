@@ -0,0 +1,51 @@
+import os
+
+import main
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _storage(workdir, capsys):
+    manager = main.StorageManager()
+    manager.create("s")
+    path = manager.store.get("s")["path"]
+    _write(os.path.join(path, "lower", "etc", "g"), "lower")
+    _write(os.path.join(path, "upper", "home", "f"), "before")
+    assert manager.snapshot("s", "snap", method="copy")
+    _write(os.path.join(path, "upper", "home", "f"), "after")
+    capsys.readouterr()
+    return manager, path
+
+
+def test_restore(workdir, capsys):
+    manager, path = _storage(workdir, capsys)
+    assert manager.restore("s", "snap", method="copy")
+    assert _read(os.path.join(path, "upper", "home", "f")) == "before"
+    assert not [n for n in os.listdir(workdir / "storages") if n != "s"]
+
+
+def test_failed_restore_keeps_the_storage(workdir, capsys, monkeypatch):
+    manager, path = _storage(workdir, capsys)
+    rename = os.rename
+
+    def failing(src, dst):
+        # the snapshot's upper/ cannot be moved in, after lower/ already was
+        if src.endswith(os.path.join(".restore", "upper")):
+            raise OSError(5, "Input/output error")
+        rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", failing)
+    assert not manager.restore("s", "snap", method="copy")
+    assert _read(os.path.join(path, "upper", "home", "f")) == "after"
+    assert _read(os.path.join(path, "lower", "etc", "g")) == "lower"
+    assert "Restore failed" in capsys.readouterr().out
+    assert sorted(os.listdir(workdir / "storages")) == ["s"]
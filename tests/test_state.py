@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+
+import main
+
+from conftest import ROOT
+
+LEGACY = {
+    "storages": {
+        "a": {"created": "2024-01-01T00:00:00", "vnc_port": 5901, "labels": {"team": "x"}},
+        "b": {"created": "2024-01-02T00:00:00", "vnc_port": 5902},
+    },
+    "templates": {"base": {"storage": "a"}},
+}
+
+
+def _write_legacy():
+    with open(main.STATE_FILE, 'w') as f:
+        json.dump(LEGACY, f)
+
+
+def test_first_run_migrates_json(workdir, capsys):
+    _write_legacy()
+    store = main.open_state_store()
+    assert store.all() == LEGACY["storages"]
+    assert store.get_meta("templates") == LEGACY["templates"]
+    assert not os.path.exists(main.STATE_FILE)
+    assert os.path.exists(main.STATE_FILE + ".migrated")
+    assert "Migrated" in capsys.readouterr().out
+
+
+def test_migration_does_not_repeat(workdir, capsys):
+    _write_legacy()
+    main.open_state_store()
+    store = main.open_state_store()
+    store.delete("b")
+    # a storages.json that reappears later is not imported over the database
+    _write_legacy()
+    store = main.open_state_store()
+    assert sorted(store.all()) == ["a"]
+    assert os.path.exists(main.STATE_FILE)
+
+
+def test_concurrent_first_runs(workdir):
+    _write_legacy()
+    code = "import main; main.open_state_store(); print('ok')"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    procs = [subprocess.Popen([sys.executable, "-c", code], cwd=workdir, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+             for _ in range(6)]
+    results = [p.communicate(timeout=60) + (p.returncode,) for p in procs]
+    for out, err, rc in results:
+        assert rc == 0, err
+        assert "ok" in out
+    assert sum("Migrated" in out for out, _, _ in results) == 1
+    assert main.SQLiteStateStore().all() == LEGACY["storages"]
+
+
+def test_json_snapshot_is_a_copy(workdir):
+    _write_legacy()
+    legacy = main.JSONStateStore()
+    snap = legacy.snapshot()
+    snap["storages"]["a"]["vnc_port"] = 1
+    assert legacy.get("a")["vnc_port"] == 5901